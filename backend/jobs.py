@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+ジョブキュー - 時間のかかるインタビュー・分析を HTTP リクエストから切り離して実行する
+
+- 投入するとすぐにジョブ ID を返し、ワーカーがバックグラウンドで実行する（同時に実行するのはワーカー数まで）
+- 実行中のジョブは進捗のカウンター（回答済みの質問数・完了したペルソナ数など）を更新し、状態と一緒に参照できる
+- 状態・進捗・結果は SQLite に保存し、クライアントが接続し直しても結果を取得できる
+  （サーバーの再起動で中断したジョブは失敗として記録する）
+- 待機中・実行中のジョブは取り消せる（実行中の LLM 呼び出しも取り消される）
+"""
+
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field, replace
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOB_STORE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "jobs.sqlite3")
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATUSES = (SUCCEEDED, FAILED, CANCELLED)
+
+_current_job: contextvars.ContextVar[Optional["Job"]] = contextvars.ContextVar("current_job", default=None)
+
+
+@dataclass
+class Job:
+    """1 件のジョブの状態・進捗・結果"""
+    id: str
+    kind: str
+    session_id: str
+    status: str = QUEUED
+    progress: Dict[str, Any] = field(default_factory=dict)
+    result: Any = None
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATUSES
+
+    def to_dict(self, include_result: bool = False) -> Dict:
+        data = {
+            "job_id": self.id,
+            "kind": self.kind,
+            "session_id": self.session_id,
+            "status": self.status,
+            "progress": dict(self.progress),
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+        if include_result:
+            data["result"] = self.result
+        return data
+
+
+def update_job_progress(**values) -> None:
+    """実行中のジョブの進捗を設定する（ジョブの外から呼ばれた場合は何もしない）"""
+    job = _current_job.get()
+    if job is not None:
+        job.progress.update(values)
+
+
+def add_job_progress(**increments) -> None:
+    """実行中のジョブの進捗のカウンターに加算する（ジョブの外から呼ばれた場合は何もしない）"""
+    job = _current_job.get()
+    if job is not None:
+        for key, amount in increments.items():
+            job.progress[key] = job.progress.get(key, 0) + amount
+
+
+class JobStore:
+    """ジョブを SQLite に保存する"""
+
+    def __init__(self, path: str = DEFAULT_JOB_STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                session_id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                progress TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_created_at ON jobs(created_at)")
+        self._conn.commit()
+
+    def save(self, job: Job) -> None:
+        result = json.dumps(job.result, ensure_ascii=False, default=str) if job.result is not None else None
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO jobs (id, kind, session_id, status, progress, result, error, "
+                "created_at, started_at, finished_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job.id, job.kind, job.session_id, job.status, json.dumps(job.progress, ensure_ascii=False),
+                 result, job.error, job.created_at, job.started_at, job.finished_at)
+            )
+            self._conn.commit()
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return _row_to_job(row) if row is not None else None
+
+    def list(self, limit: int = 50, session_id: Optional[str] = None, status: Optional[str] = None,
+             kind: Optional[str] = None) -> List[Job]:
+        """新しい順にジョブを返す（結果は読み込まない）"""
+        conditions, params = [], []
+        for column, value in (("session_id", session_id), ("status", status), ("kind", kind)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, kind, session_id, status, progress, NULL, error, created_at, started_at, finished_at "
+                f"FROM jobs {where} ORDER BY created_at DESC LIMIT ?", (*params, limit)
+            ).fetchall()
+        return [_row_to_job(row) for row in rows]
+
+    def fail_unfinished(self, message: str) -> int:
+        """前回の起動で終わらなかったジョブを失敗にする"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE status IN (?, ?)",
+                (FAILED, message, time.time(), QUEUED, RUNNING)
+            )
+            self._conn.commit()
+            return cursor.rowcount
+
+    def delete_older_than(self, seconds: float) -> int:
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM jobs WHERE created_at < ?", (time.time() - seconds,))
+            self._conn.commit()
+            return cursor.rowcount
+
+
+def _row_to_job(row) -> Job:
+    job_id, kind, session_id, status, progress, result, error, created_at, started_at, finished_at = row
+    return Job(id=job_id, kind=kind, session_id=session_id, status=status, progress=json.loads(progress),
+               result=json.loads(result) if result is not None else None, error=error,
+               created_at=created_at, started_at=started_at, finished_at=finished_at)
+
+
+class JobQueue:
+    """ジョブを受け付け、ワーカーで順に実行する"""
+
+    def __init__(self, store: Optional[JobStore] = None, workers: int = 2, progress_save_interval: float = 1.0):
+        self.store = store or JobStore(":memory:")
+        self.workers = max(1, workers)
+        self.progress_save_interval = progress_save_interval  # 進捗を保存する最短の間隔（秒）
+        self._jobs: Dict[str, Job] = {}  # 待機中・実行中のジョブ
+        self._handlers: Dict[str, Callable[[], Awaitable[Any]]] = {}
+        self._tasks: Dict[str, asyncio.Future] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Future] = []
+        self._save_lock: Optional[asyncio.Lock] = None
+        self.stats = {"submitted": 0, "succeeded": 0, "failed": 0, "cancelled": 0}
+
+    async def submit(self, kind: str, handler: Callable[[], Awaitable[Any]], session_id: str) -> Job:
+        """ジョブを投入する（handler の戻り値が結果になり、JSON にして保存する）"""
+        self._ensure_workers()
+        job = Job(id=uuid.uuid4().hex, kind=kind, session_id=session_id)
+        self._jobs[job.id] = job
+        self._handlers[job.id] = handler
+        await self._save(job)
+        self._queue.put_nowait(job.id)
+        self.stats["submitted"] += 1
+        logger.info(f"ジョブを受け付けました: {kind} {job.id}")
+        return job
+
+    def _ensure_workers(self) -> None:
+        if self._workers and not all(worker.done() for worker in self._workers):
+            return
+        loop = asyncio.get_running_loop()
+        self._queue = self._queue or asyncio.Queue()
+        self._save_lock = self._save_lock or asyncio.Lock()
+        # ワーカーは投入したリクエストのコンテキスト（セッション・期限・トレース）を引き継がない
+        self._workers = [contextvars.Context().run(loop.create_task, self._work())
+                         for _ in range(self.workers)]
+
+    async def _work(self) -> None:
+        while True:
+            job_id = await self._queue.get()
+            job = self._jobs.get(job_id)
+            handler = self._handlers.pop(job_id, None)
+            if job is None or handler is None or job.finished:
+                continue
+            await self._run(job, handler)
+
+    async def _run(self, job: Job, handler: Callable[[], Awaitable[Any]]) -> None:
+        job.status = RUNNING
+        job.started_at = time.time()
+        token = _current_job.set(job)
+        try:
+            task = asyncio.ensure_future(handler())
+        finally:
+            _current_job.reset(token)
+        self._tasks[job.id] = task
+
+        stop_saving = asyncio.Event()
+        saver = asyncio.ensure_future(self._save_progress(job, stop_saving))
+        try:
+            await self._save(job)
+            job.result = await task
+            job.status = SUCCEEDED
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                # ワーカー自体が止められた（サーバーの終了など）
+                task.cancel()
+                job.status = FAILED
+                job.error = "サーバーの終了により中断されました"
+                raise
+            job.status = CANCELLED
+        except Exception as e:
+            job.status = FAILED
+            job.error = str(getattr(e, "detail", "") or e) or type(e).__name__
+            logger.error(f"ジョブが失敗しました: {job.kind} {job.id}: {job.error}")
+        finally:
+            job.finished_at = time.time()
+            self.stats[job.status] = self.stats.get(job.status, 0) + 1
+            self._tasks.pop(job.id, None)
+            # 進捗の保存が終わってから最終状態を保存する（古い進捗で上書きしないため）
+            stop_saving.set()
+            await asyncio.gather(saver, return_exceptions=True)
+            await self._save(job)
+            self._jobs.pop(job.id, None)
+            logger.info(f"ジョブが終了しました: {job.kind} {job.id} {job.status}")
+
+    async def _save(self, job: Job) -> None:
+        """ジョブを保存する（JSON 化と SQLite への書き込みはスレッドで行い、イベントループを止めない）"""
+        snapshot = replace(job, progress=dict(job.progress))
+        async with self._save_lock:
+            await asyncio.to_thread(self.store.save, snapshot)
+
+    async def _save_progress(self, job: Job, stop: asyncio.Event) -> None:
+        """実行中のジョブの進捗を stop が設定されるまで定期的に保存する"""
+        saved = None
+        while True:
+            try:
+                await asyncio.wait_for(stop.wait(), self.progress_save_interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+            if job.progress != saved:
+                saved = dict(job.progress)
+                await self._save(job)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """ジョブを返す（待機中・実行中はメモリ上の最新の進捗、終了後は保存した結果を含む）"""
+        return self._jobs.get(job_id) or self.store.get(job_id)
+
+    def list(self, limit: int = 50, session_id: Optional[str] = None, status: Optional[str] = None,
+             kind: Optional[str] = None) -> List[Job]:
+        return [self._jobs.get(job.id, job) for job in self.store.list(limit, session_id, status, kind)]
+
+    async def cancel(self, job_id: str) -> Optional[Job]:
+        """ジョブを取り消す（見つからなければ None、終了済みならそのまま返す）"""
+        job = self._jobs.get(job_id)
+        if job is None:
+            return await asyncio.to_thread(self.store.get, job_id)
+        task = self._tasks.get(job_id)
+        if task is not None:
+            # 実行中のジョブは取り消しが反映されたときに _run が状態を更新する
+            task.cancel()
+            return job
+        job.status = CANCELLED
+        job.finished_at = time.time()
+        self.stats["cancelled"] += 1
+        self._jobs.pop(job_id, None)
+        self._handlers.pop(job_id, None)
+        await self._save(job)
+        return job
+
+    def get_stats(self) -> Dict:
+        return {
+            **self.stats,
+            "workers": self.workers,
+            "queued": sum(1 for job in self._jobs.values() if job.status == QUEUED),
+            "running": sum(1 for job in self._jobs.values() if job.status == RUNNING),
+        }
+
+
+def create_job_queue_from_env() -> JobQueue:
+    """環境変数 JOB_* からジョブキューを作成する
+
+    保存先を開けない場合は、結果をメモリ上にだけ保持する（再起動すると失われる）。
+    """
+    try:
+        store = JobStore(os.getenv("JOB_STORE_PATH", DEFAULT_JOB_STORE_PATH))
+    except (sqlite3.Error, OSError) as e:
+        logger.error(f"ジョブの保存先を開けないため、メモリ上に保持します: {e}")
+        store = JobStore(":memory:")
+    interrupted = store.fail_unfinished("サーバーの再起動により中断されました")
+    if interrupted:
+        logger.warning(f"前回の起動で終わらなかったジョブ {interrupted} 件を失敗にしました")
+    store.delete_older_than(float(os.getenv("JOB_RETENTION_SECONDS", str(7 * 24 * 3600))))
+    return JobQueue(store, workers=int(os.getenv("JOB_WORKERS", "2")))
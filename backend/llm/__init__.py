@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+LLM 呼び出しレイヤー
+"""
+
+from .agreement import CandidateDistribution, score_candidates
+from .budget import BudgetResult, InterviewBudgeter, create_budgeter_from_env, format_interview
+from .cache import ResponseCache, create_cache_from_env
+from .cassette import CassetteMissError, RecordingProvider, ReplayProvider
+from .compaction import HistoryCompactor, create_compactor_from_env
+from .concurrency import AdaptiveConcurrency, AdaptiveLimiter, create_concurrency_from_env
+from .context import call_context, get_call_context, get_remaining_time, request_deadline
+from .context_cache import ContextCacheMeter, ContextCacheStore, ContextPrefix, make_context_prefix
+from .gateway import (
+    DEFAULT_MODEL,
+    ChatSession,
+    DeadlineExceededError,
+    GenerationResult,
+    LLMError,
+    LLMGateway,
+    LLMOverloadedError,
+    LLMUnavailableError,
+    StructuredOutputError,
+)
+from .hedging import HedgePolicy, create_hedge_policy_from_env
+from .keypool import KeyPool, PooledProvider
+from .ledger import CostLedger, Usage
+from .packing import PromptPacker, create_packer_from_env
+from .profiles import ProfileRegistry, TaskProfile, create_profile_registry_from_env
+from .providers import GeminiProvider, LLMProvider, ProviderResponse, create_provider_from_env
+from .retry import CircuitBreaker, RetryPolicy
+from .scheduler import Priority, RateLimitScheduler, create_scheduler_from_env
+from .simulator import SimulatedProvider
+from .singleflight import SingleFlight
+from .streaming import SectionTracker, StreamSink, bind_stream_sink, get_stream_sink, sse_event
+from .tracing import Span, Tracer, create_tracer_from_env, current_span
+
+__all__ = [
+    "DEFAULT_MODEL",
+    "AdaptiveConcurrency",
+    "AdaptiveLimiter",
+    "BudgetResult",
+    "CandidateDistribution",
+    "CassetteMissError",
+    "ChatSession",
+    "CircuitBreaker",
+    "ContextCacheMeter",
+    "ContextCacheStore",
+    "ContextPrefix",
+    "CostLedger",
+    "DeadlineExceededError",
+    "GeminiProvider",
+    "GenerationResult",
+    "HedgePolicy",
+    "HistoryCompactor",
+    "InterviewBudgeter",
+    "KeyPool",
+    "LLMError",
+    "LLMGateway",
+    "LLMProvider",
+    "LLMOverloadedError",
+    "LLMUnavailableError",
+    "PooledProvider",
+    "Priority",
+    "ProfileRegistry",
+    "PromptPacker",
+    "ProviderResponse",
+    "RateLimitScheduler",
+    "RecordingProvider",
+    "ReplayProvider",
+    "ResponseCache",
+    "RetryPolicy",
+    "SectionTracker",
+    "SimulatedProvider",
+    "SingleFlight",
+    "Span",
+    "StreamSink",
+    "StructuredOutputError",
+    "TaskProfile",
+    "Tracer",
+    "Usage",
+    "bind_stream_sink",
+    "call_context",
+    "create_budgeter_from_env",
+    "create_cache_from_env",
+    "create_compactor_from_env",
+    "create_concurrency_from_env",
+    "create_hedge_policy_from_env",
+    "create_packer_from_env",
+    "create_profile_registry_from_env",
+    "create_provider_from_env",
+    "create_scheduler_from_env",
+    "create_tracer_from_env",
+    "current_span",
+    "format_interview",
+    "get_call_context",
+    "get_remaining_time",
+    "get_stream_sink",
+    "make_context_prefix",
+    "request_deadline",
+    "score_candidates",
+    "sse_event",
+]
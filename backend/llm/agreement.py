@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+候補の一致度 - 1 回の呼び出しで得た複数の候補から、回答のばらつきを推定する
+
+API は呼ばずにローカルで計算する。候補間の類似度は文字 bigram の Jaccard 係数で測る。
+- agreement: 全候補ペアの類似度の平均（1 に近いほど回答が安定している）
+- support: 各候補と他の候補との類似度の平均
+- representative: support が最も高い候補（メドイド）。チャットの履歴にはこの候補を残す
+- clusters: 類似度がしきい値以上の候補をまとめた回答の分布
+"""
+
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Set
+
+# 同じクラスタとみなす類似度の下限
+CLUSTER_THRESHOLD = 0.5
+
+_IGNORED_CHARS = re.compile(r"[\s、。，．,.!?！？「」『』（）()・…]+")
+
+
+def _bigrams(text: str) -> Set[str]:
+    normalized = _IGNORED_CHARS.sub("", text)
+    if len(normalized) < 2:
+        return {normalized} if normalized else set()
+    return {normalized[i:i + 2] for i in range(len(normalized) - 1)}
+
+
+def similarity(a: str, b: str) -> float:
+    """2 つの回答の類似度（0〜1）"""
+    grams_a, grams_b = _bigrams(a), _bigrams(b)
+    if not grams_a and not grams_b:
+        return 1.0
+    return len(grams_a & grams_b) / len(grams_a | grams_b)
+
+
+@dataclass
+class CandidateDistribution:
+    """候補の集合とその一致度"""
+    candidates: List[str]
+    similarity: List[List[float]]
+    agreement: float
+    support: List[float]
+    representative_index: int
+    clusters: List[Dict]
+
+    @property
+    def representative(self) -> str:
+        return self.candidates[self.representative_index]
+
+    @property
+    def dispersion(self) -> float:
+        """ばらつきの推定値（1 - agreement）"""
+        return 1.0 - self.agreement
+
+    def to_dict(self) -> Dict:
+        return {
+            "candidates": self.candidates,
+            "representative_index": self.representative_index,
+            "agreement": round(self.agreement, 4),
+            "dispersion": round(self.dispersion, 4),
+            "support": [round(value, 4) for value in self.support],
+            "clusters": self.clusters,
+        }
+
+
+def score_candidates(candidates: List[str]) -> CandidateDistribution:
+    """候補間の類似度から一致度・代表候補・分布を求める"""
+    if not candidates:
+        raise ValueError("候補が 1 つもありません")
+    count = len(candidates)
+    matrix = [[1.0] * count for _ in range(count)]
+    for i in range(count):
+        for j in range(i + 1, count):
+            matrix[i][j] = matrix[j][i] = similarity(candidates[i], candidates[j])
+
+    if count == 1:
+        support = [1.0]
+        agreement = 1.0
+    else:
+        support = [(sum(row) - 1.0) / (count - 1) for row in matrix]
+        agreement = sum(support) / count
+    representative_index = max(range(count), key=lambda i: support[i])
+
+    # support の高い候補から順に、既存のクラスタの代表と十分に似ていればそこへ入れる
+    clusters: List[Dict] = []
+    for i in sorted(range(count), key=lambda i: -support[i]):
+        for cluster in clusters:
+            if matrix[cluster["representative_index"]][i] >= CLUSTER_THRESHOLD:
+                cluster["members"].append(i)
+                break
+        else:
+            clusters.append({"representative_index": i, "members": [i]})
+    for cluster in clusters:
+        cluster["share"] = round(len(cluster["members"]) / count, 4)
+
+    return CandidateDistribution(
+        candidates=list(candidates),
+        similarity=matrix,
+        agreement=agreement,
+        support=support,
+        representative_index=representative_index,
+        clusters=clusters,
+    )
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+プロンプトのトークン予算 - インタビュー内容を予算内に収めてからプロンプトに埋め込む
+
+送信前にトークン数を概算し、予算を超える場合は次の順に圧縮する。
+1. drop_follow_ups: 更問と更問回答を除く
+2. truncate_answers: さらに各回答を一定の文字数で切り詰める
+3. map_reduce: 全内容をチャンクに分けて要約し、要約を連結したものを使う
+どの段階で収まったかは BudgetResult.strategy で報告する。
+"""
+
+import asyncio
+import logging
+import os
+from dataclasses import asdict, dataclass
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from .tokens import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+STRATEGY_FULL = "full"
+STRATEGY_DROP_FOLLOW_UPS = "drop_follow_ups"
+STRATEGY_TRUNCATE_ANSWERS = "truncate_answers"
+STRATEGY_MAP_REDUCE = "map_reduce"
+
+# 切り詰め段階で順に試す回答の最大文字数
+ANSWER_LIMITS = (400, 200, 100, 50)
+
+# map_reduce で要約を繰り返す最大回数
+MAX_REDUCE_ROUNDS = 3
+
+
+@dataclass
+class BudgetResult:
+    """予算内に収めたインタビュー内容と、適用した圧縮方法"""
+    content: str
+    strategy: str
+    original_tokens: int
+    final_tokens: int
+    budget_tokens: int
+    chunks: int = 0  # map_reduce で要約したチャンク数
+
+    def to_dict(self) -> Dict:
+        result = asdict(self)
+        del result["content"]
+        return result
+
+
+def format_interview(history: List[Dict], include_follow_ups: bool = True,
+                     answer_limit: Optional[int] = None) -> str:
+    """インタビュー履歴（question / main_answer / follow_ups）をプロンプト用のテキストにする"""
+    def clip(text: str) -> str:
+        if answer_limit is not None and len(text) > answer_limit:
+            return text[:answer_limit] + "…"
+        return text
+
+    content = ""
+    for result in history:
+        content += f"質問: {result['question']}\n"
+        content += f"回答: {clip(result['main_answer'])}\n"
+        if include_follow_ups:
+            for follow_up in result.get('follow_ups', []):
+                content += f"更問: {follow_up['question']}\n"
+                content += f"更問回答: {clip(follow_up['answer'])}\n"
+        content += "\n"
+    return content
+
+
+def split_into_chunks(blocks: List[str], chunk_tokens: int) -> List[str]:
+    """ブロック（質問単位のテキスト）を順に詰めて、chunk_tokens 以下のチャンクにする"""
+    chunks, current, current_tokens = [], "", 0
+    for block in blocks:
+        tokens = estimate_tokens(block)
+        if current and current_tokens + tokens > chunk_tokens:
+            chunks.append(current)
+            current, current_tokens = "", 0
+        current += block
+        current_tokens += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class InterviewBudgeter:
+    """インタビュー内容を段階的に圧縮してトークン予算内に収める"""
+
+    def __init__(self, max_tokens: int = 8000, chunk_tokens: Optional[int] = None):
+        self.max_tokens = max_tokens
+        self.chunk_tokens = chunk_tokens or max_tokens
+        self.stats = {strategy: 0 for strategy in (
+            STRATEGY_FULL, STRATEGY_DROP_FOLLOW_UPS, STRATEGY_TRUNCATE_ANSWERS, STRATEGY_MAP_REDUCE
+        )}
+
+    def _result(self, content: str, strategy: str, original_tokens: int, chunks: int = 0) -> BudgetResult:
+        self.stats[strategy] += 1
+        result = BudgetResult(content=content, strategy=strategy, original_tokens=original_tokens,
+                              final_tokens=estimate_tokens(content), budget_tokens=self.max_tokens,
+                              chunks=chunks)
+        if strategy != STRATEGY_FULL:
+            logger.info(f"インタビュー内容を圧縮しました: {strategy}（{original_tokens} → {result.final_tokens} トークン）")
+        return result
+
+    async def fit(self, history: List[Dict], summarize: Callable[[str], Awaitable[str]]) -> BudgetResult:
+        """history を予算内のテキストにする（summarize はチャンクを要約する非同期関数）"""
+        content = format_interview(history)
+        original_tokens = estimate_tokens(content)
+        if original_tokens <= self.max_tokens:
+            return self._result(content, STRATEGY_FULL, original_tokens)
+
+        content = format_interview(history, include_follow_ups=False)
+        if estimate_tokens(content) <= self.max_tokens:
+            return self._result(content, STRATEGY_DROP_FOLLOW_UPS, original_tokens)
+
+        for limit in ANSWER_LIMITS:
+            content = format_interview(history, include_follow_ups=False, answer_limit=limit)
+            if estimate_tokens(content) <= self.max_tokens:
+                return self._result(content, STRATEGY_TRUNCATE_ANSWERS, original_tokens)
+
+        # 切り詰めても収まらない場合は、更問も含めた全内容をチャンクごとに要約する
+        blocks = [format_interview([result]) for result in history]
+        total_chunks = 0
+        for _ in range(MAX_REDUCE_ROUNDS):
+            chunks = split_into_chunks(blocks, self.chunk_tokens)
+            total_chunks += len(chunks)
+            summaries = await asyncio.gather(*[summarize(chunk) for chunk in chunks])
+            blocks = [f"（質問{i + 1}群の要約）\n{summary}\n\n" for i, summary in enumerate(summaries)]
+            content = "".join(blocks)
+            if estimate_tokens(content) <= self.max_tokens or len(chunks) == 1:
+                break
+        return self._result(content, STRATEGY_MAP_REDUCE, original_tokens, chunks=total_chunks)
+
+    def get_stats(self) -> Dict:
+        return {"max_tokens": self.max_tokens, "chunk_tokens": self.chunk_tokens, "strategies": dict(self.stats)}
+
+
+def create_budgeter_from_env() -> InterviewBudgeter:
+    """環境変数 LLM_INTERVIEW_CONTEXT_TOKENS / LLM_INTERVIEW_CHUNK_TOKENS から作成する"""
+    chunk_tokens = os.getenv("LLM_INTERVIEW_CHUNK_TOKENS")
+    return InterviewBudgeter(
+        max_tokens=int(os.getenv("LLM_INTERVIEW_CONTEXT_TOKENS", "8000")),
+        chunk_tokens=int(chunk_tokens) if chunk_tokens else None
+    )
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+LLM レスポンスキャッシュ - (モデル名, 生成設定, プロンプト) のハッシュをキーに SQLite へ保存する
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "llm_cache.sqlite3")
+
+
+def make_cache_key(model_name: str, generation_config: Dict, prompt: str) -> str:
+    """キャッシュキー（SHA-256）を生成する（出力長の上限や停止文字列が違えば別の応答として扱う）"""
+    payload = json.dumps([model_name, generation_config, prompt], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """SQLite をバックエンドとした LRU + TTL 付きのレスポンスキャッシュ"""
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_entries: int = 5000,
+                 ttl_seconds: float = 7 * 24 * 3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0, "expired": 0}
+        self._lock = threading.Lock()
+
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model_name TEXT NOT NULL,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_accessed REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_accessed ON responses(last_accessed)")
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        """キャッシュを参照する（期限切れは削除してミス扱い）"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+
+            response, created_at = row
+            if self.ttl_seconds and now - created_at > self.ttl_seconds:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+
+            self._conn.execute("UPDATE responses SET last_accessed = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.stats["hits"] += 1
+            return response
+
+    def set(self, key: str, model_name: str, response: str) -> None:
+        """レスポンスを保存し、上限を超えた分を最終アクセスの古い順に削除する"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model_name, response, created_at, last_accessed) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, model_name, response, now, now)
+            )
+            self.stats["writes"] += 1
+
+            count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            excess = count - self.max_entries
+            if excess > 0:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN "
+                    "(SELECT key FROM responses ORDER BY last_accessed ASC LIMIT ?)",
+                    (excess,)
+                )
+                self.stats["evictions"] += excess
+            self._conn.commit()
+
+    def clear(self) -> int:
+        """全エントリを削除し、削除件数を返す"""
+        with self._lock:
+            deleted = self._conn.execute("DELETE FROM responses").rowcount
+            self._conn.commit()
+            return deleted
+
+    def get_stats(self) -> Dict:
+        """ヒット・ミス数などの統計を返す"""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            stats = dict(self.stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["entries"] = entries
+        stats["max_entries"] = self.max_entries
+        stats["ttl_seconds"] = self.ttl_seconds
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+def create_cache_from_env() -> Optional[ResponseCache]:
+    """環境変数の設定からキャッシュを作成する（LLM_CACHE_ENABLED=false で無効）"""
+    if os.getenv("LLM_CACHE_ENABLED", "true").lower() in ("0", "false", "no"):
+        logger.info("LLMレスポンスキャッシュは無効です")
+        return None
+
+    try:
+        return ResponseCache(
+            path=os.getenv("LLM_CACHE_PATH", DEFAULT_CACHE_PATH),
+            max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "5000")),
+            ttl_seconds=float(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+        )
+    except (sqlite3.Error, OSError, ValueError) as e:
+        logger.error(f"LLMレスポンスキャッシュの初期化に失敗しました: {e}")
+        return None
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+カセット（記録・再生）- LLM 呼び出しのプロンプトと応答を JSONL に記録し、決定的に再生する
+
+- 記録: 実プロバイダーを包み、成功した generate / チャット送信を 1 行 1 件で追記する
+- 再生: API を呼ばずにカセットから応答を返す（必要なら記録時のレイテンシも再現する）
+- 照合キーは generate が (モデル名, 生成設定, プロンプト)、チャットが (モデル名, 送信前の履歴, メッセージ)、
+  複数候補のサンプリングが (モデル名, 生成設定, 履歴, メッセージ)
+  共通の前置き（ContextPrefix）を使う呼び出しは、前置きの内容のハッシュもキーに含める
+  同じキーが複数回記録されている場合は記録順に返し、使い切った後は最後の応答を返し続ける
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import asdict
+from typing import AsyncIterator, Deque, Dict, List, Optional
+
+from .context_cache import ContextPrefix
+from .ledger import Usage
+from .providers import LLMProvider, LocalChat, ProviderResponse, history_to_dicts
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CASSETTE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "llm_cassette.jsonl")
+
+
+class CassetteMissError(LookupError):
+    """再生時に一致する記録がカセットに存在しない"""
+
+
+def _hash_key(items: List, context: Optional[ContextPrefix]) -> str:
+    # 前置きのない呼び出しは従来と同じキーになるよう、前置きがある場合のみ末尾に加える
+    if context is not None:
+        items = [*items, {"context": context.key}]
+    payload = json.dumps(items, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def generate_key(model_name: str, prompt: str, generation_config: Optional[Dict],
+                 context: Optional[ContextPrefix] = None) -> str:
+    return _hash_key(["generate", model_name, generation_config or {}, prompt], context)
+
+
+def chat_key(model_name: str, history: List[Dict], message: str,
+             context: Optional[ContextPrefix] = None) -> str:
+    return _hash_key(["chat", model_name, history, message], context)
+
+
+def sample_key(model_name: str, generation_config: Optional[Dict], history: List[Dict], message: str,
+               context: Optional[ContextPrefix] = None) -> str:
+    return _hash_key(["sample", model_name, generation_config or {}, history, message], context)
+
+
+class Cassette:
+    """JSONL 形式のカセットファイル"""
+
+    def __init__(self, path: str = DEFAULT_CASSETTE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def append(self, record: Dict) -> None:
+        with self._lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def load(self) -> Dict[str, Deque[Dict]]:
+        """キーごとに記録順のキューを返す"""
+        records: Dict[str, Deque[Dict]] = {}
+        if not os.path.exists(self.path):
+            logger.warning(f"カセットファイルが見つかりません: {self.path}")
+            return records
+        with open(self.path, encoding="utf-8") as f:
+            for line_number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"カセットの {line_number} 行目を読み込めませんでした")
+                    continue
+                records.setdefault(record["key"], deque()).append(record)
+        return records
+
+
+def _usage_to_dict(usage: Optional[Usage]) -> Optional[Dict]:
+    return asdict(usage) if usage is not None else None
+
+
+class RecordingProvider(LLMProvider):
+    """実プロバイダーへの呼び出しをカセットに記録するプロバイダー"""
+
+    def __init__(self, inner: LLMProvider, cassette: Cassette):
+        self.inner = inner
+        self.cassette = cassette
+        self.name = f"{inner.name}+record"
+        self.recorded = 0
+
+    @property
+    def stats(self) -> Dict:
+        return {**getattr(self.inner, "stats", {}), "recorded": self.recorded}
+
+    async def _record(self, record: Dict) -> None:
+        try:
+            await asyncio.to_thread(self.cassette.append, record)
+            self.recorded += 1
+        except OSError as e:
+            logger.error(f"カセットへの記録に失敗しました: {e}")
+
+    async def generate(self, model_name: str, prompt: str, generation_config: Dict,
+                       context: Optional[ContextPrefix] = None) -> ProviderResponse:
+        started = time.monotonic()
+        response = await self.inner.generate(model_name, prompt, generation_config, context)
+        await self._record({
+            "key": generate_key(model_name, prompt, generation_config, context),
+            "kind": "generate",
+            "model": model_name,
+            "generation_config": generation_config,
+            "prompt": prompt,
+            "text": response.text,
+            "candidates": response.candidates,
+            "usage": _usage_to_dict(response.usage),
+            "latency": time.monotonic() - started,
+            "recorded_at": time.time(),
+        })
+        return response
+
+    async def stream_generate(self, model_name: str, prompt: str, generation_config: Dict,
+                              context: Optional[ContextPrefix] = None) -> AsyncIterator[ProviderResponse]:
+        # ストリームは最後まで読まれた場合のみ、generate と同じキーで全文を記録する
+        started = time.monotonic()
+        parts, usage = [], None
+        async for chunk in self.inner.stream_generate(model_name, prompt, generation_config, context):
+            parts.append(chunk.text)
+            usage = chunk.usage or usage
+            yield chunk
+        await self._record({
+            "key": generate_key(model_name, prompt, generation_config, context),
+            "kind": "generate",
+            "model": model_name,
+            "generation_config": generation_config,
+            "prompt": prompt,
+            "text": "".join(parts),
+            "usage": _usage_to_dict(usage),
+            "latency": time.monotonic() - started,
+            "recorded_at": time.time(),
+        })
+
+    def start_chat(self, model_name: str, history: List[Dict], context: Optional[ContextPrefix] = None):
+        return self.inner.start_chat(model_name, history, context)
+
+    async def send_message(self, chat, message: str,
+                           generation_config: Optional[Dict] = None) -> ProviderResponse:
+        # 送信が成功すると履歴が変わるため、キーは送信前の履歴で作る
+        model_name = getattr(chat, "model_name", "") or getattr(getattr(chat, "model", None), "model_name", "")
+        history = history_to_dicts(chat.history)
+        started = time.monotonic()
+        response = await self.inner.send_message(chat, message, generation_config)
+        await self._record({
+            "key": chat_key(model_name, history, message, getattr(chat, "context", None)),
+            "kind": "chat",
+            "model": model_name,
+            "history_turns": len(history),
+            "message": message,
+            "text": response.text,
+            "usage": _usage_to_dict(response.usage),
+            "latency": time.monotonic() - started,
+            "recorded_at": time.time(),
+        })
+        return response
+
+    async def sample_message(self, chat, message: str,
+                             generation_config: Optional[Dict] = None) -> ProviderResponse:
+        model_name = getattr(chat, "model_name", "") or getattr(getattr(chat, "model", None), "model_name", "")
+        history = history_to_dicts(chat.history)
+        started = time.monotonic()
+        response = await self.inner.sample_message(chat, message, generation_config)
+        await self._record({
+            "key": sample_key(model_name, generation_config, history, message, getattr(chat, "context", None)),
+            "kind": "sample",
+            "model": model_name,
+            "history_turns": len(history),
+            "message": message,
+            "text": response.text,
+            "candidates": response.candidates,
+            "usage": _usage_to_dict(response.usage),
+            "latency": time.monotonic() - started,
+            "recorded_at": time.time(),
+        })
+        return response
+
+    def append_turn(self, chat, message: str, answer: str) -> None:
+        self.inner.append_turn(chat, message, answer)
+
+
+class ReplayProvider(LLMProvider):
+    """カセットから応答を返すプロバイダー（API は呼ばない）"""
+
+    name = "replay"
+
+    def __init__(self, cassette: Cassette, latency_scale: float = 0.0):
+        self.cassette = cassette
+        self.latency_scale = latency_scale  # 記録時レイテンシの倍率（0 で待機しない）
+        self._records = cassette.load()
+        self.stats = {"loaded": sum(len(queue) for queue in self._records.values()),
+                      "replayed": 0, "misses": 0}
+        logger.info(f"カセットを読み込みました: {self.cassette.path}（{self.stats['loaded']}件）")
+
+    async def _replay(self, key: str, description: str) -> ProviderResponse:
+        queue = self._records.get(key)
+        if not queue:
+            self.stats["misses"] += 1
+            raise CassetteMissError(f"カセットに一致する記録がありません: {description}（key={key[:12]}）")
+
+        record = queue.popleft() if len(queue) > 1 else queue[0]
+        if self.latency_scale > 0:
+            await asyncio.sleep(record.get("latency", 0.0) * self.latency_scale)
+        self.stats["replayed"] += 1
+        usage = Usage(**record["usage"]) if record.get("usage") else None
+        return ProviderResponse(text=record["text"], usage=usage, candidates=record.get("candidates") or [])
+
+    async def generate(self, model_name: str, prompt: str, generation_config: Dict,
+                       context: Optional[ContextPrefix] = None) -> ProviderResponse:
+        return await self._replay(generate_key(model_name, prompt, generation_config, context),
+                                  f"generate {model_name}")
+
+    async def stream_generate(self, model_name: str, prompt: str, generation_config: Dict,
+                              context: Optional[ContextPrefix] = None) -> AsyncIterator[ProviderResponse]:
+        response = await self.generate(model_name, prompt, generation_config, context)
+        # 記録した全文を行単位で返す（見出しの検出を本番と同じように行えるようにする）
+        for line in response.text.splitlines(keepends=True):
+            yield ProviderResponse(text=line)
+        yield ProviderResponse(text="", usage=response.usage)
+
+    async def send_message(self, chat: LocalChat, message: str,
+                           generation_config: Optional[Dict] = None) -> ProviderResponse:
+        response = await self._replay(chat_key(chat.model_name, chat.history, message, chat.context),
+                                      f"chat {chat.model_name}（履歴 {len(chat.history)}件）")
+        chat.append_turn(message, response.text)
+        return response
+
+    async def sample_message(self, chat: LocalChat, message: str,
+                             generation_config: Optional[Dict] = None) -> ProviderResponse:
+        return await self._replay(sample_key(chat.model_name, generation_config, chat.history, message,
+                                             chat.context),
+                                  f"sample {chat.model_name}（履歴 {len(chat.history)}件）")
+
+
+def create_cassette_provider_from_env(inner: Optional[LLMProvider]) -> LLMProvider:
+    """環境変数 LLM_CASSETTE_* から記録・再生用プロバイダーを作成する（inner が None なら再生）"""
+    cassette = Cassette(os.getenv("LLM_CASSETTE_PATH", DEFAULT_CASSETTE_PATH))
+    if inner is None:
+        return ReplayProvider(
+            cassette,
+            latency_scale=float(os.getenv("LLM_CASSETTE_LATENCY_SCALE", "0"))
+        )
+    logger.info(f"LLM呼び出しをカセットに記録します: {cassette.path}")
+    return RecordingProvider(inner, cassette)
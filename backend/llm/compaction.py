@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+チャット履歴の圧縮 - 長いペルソナとのチャットの古いやり取りを要約に置き換える
+
+チャットは送信のたびに履歴全体を送るため、質問が進むほど入力トークンとレイテンシが増える。
+HistoryCompactor は履歴のやり取りが一定数を超えたら、直近のやり取りだけをそのまま残し、
+それより前（前回の要約を含む）を要約した 1 往復に置き換える。
+
+- 要約はバックグラウンドで生成し、次の送信までの間（更問の生成など）に進める（リクエストの期限にも縛られない）
+- 置き換えは次の送信の開始時にチャットのロックを取った状態で行う。要約がまだなら完成を待つため、
+  どの送信にどの履歴を送るかはタイミングに左右されない（カセットの記録・再生でも同じ履歴になる）
+- 要約の生成中に履歴の先頭が変わっていれば、その要約は破棄する
+- 置き換えで減った履歴のトークン数を、以降の送信ごとにセッション単位で「節約したトークン数」として数える
+"""
+
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from .context import get_session_id, without_deadline
+from .providers import history_to_dicts
+from .tokens import estimate_contents_tokens
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_ACK = "承知しました。要約内容を基に、引き続きインタビューにお答えします。"
+
+
+def summary_messages(summary: str) -> List[Dict]:
+    """要約を履歴の先頭に置く 1 往復にする"""
+    return [
+        {"role": "user", "parts": [f"これまでのインタビュー要約:\n{summary}"]},
+        {"role": "model", "parts": [SUMMARY_ACK]},
+    ]
+
+
+def summary_prompt(persona: str, previous_summary: str, history: List[Dict]) -> str:
+    """履歴の要約を依頼するプロンプト"""
+    speakers = {"user": "インタビュアー", "model": "回答者"}
+    conversation = "\n".join(
+        f"{speakers.get(content['role'], content['role'])}: {''.join(content['parts'])}"
+        for content in history_to_dicts(history)
+    )
+    previous = f"これまでの要約:\n{previous_summary}\n\n" if previous_summary else ""
+    return f"""以下はインタビュー対象者「{persona or '回答者'}」へのインタビューの記録です。
+この後もインタビューを続けるため、回答者がこれまでに話した内容（事実・経験・数値・意見・感情・立場）を
+矛盾なく引き継げるよう、具体的な発言をできるだけ残して箇条書きで要約してください。
+これまでの要約がある場合は、その内容も漏らさず含めてください。
+
+{previous}会話:
+{conversation}
+"""
+
+
+class HistoryCompactor:
+    """チャット履歴が長くなったら、古いやり取りをバックグラウンドで要約に置き換える"""
+
+    def __init__(self, enabled: bool = True, trigger_turns: int = 12, keep_turns: int = 4,
+                 max_history_tokens: int = 0):
+        self.enabled = enabled
+        self.trigger_turns = trigger_turns  # そのまま残っているやり取り（往復）がこれを超えたら圧縮する
+        self.keep_turns = keep_turns  # 圧縮後もそのまま残す直近のやり取りの数
+        self.max_history_tokens = max_history_tokens  # 履歴のトークン数がこれを超えても圧縮する（0 以下は無効）
+        self._saved: Dict[str, int] = {}
+        self.stats = {"scheduled": 0, "compactions": 0, "stale": 0, "failed": 0, "compacted_turns": 0}
+
+    def verbatim_turns(self, session) -> int:
+        """要約に置き換えられていないやり取りの数"""
+        return (len(session.chat.history) - session.summary_message_count) // 2
+
+    def needs_compaction(self, session) -> bool:
+        turns = self.verbatim_turns(session)
+        if turns <= self.keep_turns:
+            return False
+        if turns > self.trigger_turns:
+            return True
+        return 0 < self.max_history_tokens < estimate_contents_tokens(session.chat.history)
+
+    def schedule(self, session, summarize: Callable[[str], Awaitable[str]]) -> None:
+        """圧縮が必要なら要約をバックグラウンドで始める（置き換えは次の送信の開始時に apply_pending で行う）"""
+        if not self.enabled or session.compaction_task is not None or not self.needs_compaction(session):
+            return
+        history = session.chat.history
+        cut = len(history) - self.keep_turns * 2
+        if cut <= session.summary_message_count:
+            return
+        self.stats["scheduled"] += 1
+        # 要約はきっかけになったリクエストより長く続くことがあるため、その期限は使わない
+        with without_deadline():
+            session.compaction_task = asyncio.ensure_future(self._summarize(session, list(history[:cut]), summarize))
+
+    async def _summarize(self, session, old: List,
+                         summarize: Callable[[str], Awaitable[str]]) -> Optional[Tuple[List, str]]:
+        """old（置き換える履歴）の要約を生成する（失敗したら None）"""
+        try:
+            summary = (await summarize(summary_prompt(session.persona, session.history_summary,
+                                                      old[session.summary_message_count:]))).strip()
+            if not summary:
+                raise ValueError("要約が空でした")
+            return old, summary
+        except Exception as e:
+            self.stats["failed"] += 1
+            logger.warning(f"チャット履歴を要約できなかったため圧縮を見送ります（{session.persona}）: {e}")
+            return None
+
+    async def apply_pending(self, session) -> bool:
+        """生成中・生成済みの要約で履歴を置き換える（置き換えたかどうかを返す）
+
+        送信の開始時に、チャットのロックを取った状態で呼ぶ。要約がまだなら完成を待つ
+        （送信が取り消されても要約は続け、次の送信で使う）。
+        """
+        task = session.compaction_task
+        if task is None:
+            return False
+        pending = await asyncio.shield(task)
+        session.compaction_task = None
+        if pending is None:
+            return False
+        old, summary = pending
+        cut = len(old)
+        current = session.chat.history
+        # 要約の生成中に別の圧縮などで先頭が変わっていれば、この要約は使わない
+        if len(current) < cut or any(a is not b for a, b in zip(current, old)):
+            self.stats["stale"] += 1
+            return False
+        replacement = summary_messages(summary)
+        session.chat.history = replacement + current[cut:]
+        session.compacted_tokens += estimate_contents_tokens(old) - estimate_contents_tokens(replacement)
+        session.summary_message_count = len(replacement)
+        session.history_summary = summary
+        self.stats["compactions"] += 1
+        self.stats["compacted_turns"] += (cut - len(replacement)) // 2
+        logger.info(f"チャット履歴を圧縮しました（{session.persona}）: {cut // 2}往復を要約に置き換え、"
+                    f"直近{self.keep_turns}往復を残しました")
+        return True
+
+    def record_send(self, session) -> None:
+        """送信 1 回分の節約したトークン数を現在のセッションに加える"""
+        if session.compacted_tokens > 0:
+            session_id = get_session_id()
+            self._saved[session_id] = self._saved.get(session_id, 0) + session.compacted_tokens
+
+    def tokens_saved(self, session_id: str) -> int:
+        """セッションで圧縮により送らずに済んだ入力トークン数（概算）"""
+        return self._saved.get(session_id, 0)
+
+    def get_stats(self) -> Dict:
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "trigger_turns": self.trigger_turns,
+            "keep_turns": self.keep_turns,
+            "max_history_tokens": self.max_history_tokens,
+            "tokens_saved": sum(self._saved.values()),
+            "tokens_saved_by_session": dict(self._saved),
+        }
+
+
+def create_compactor_from_env() -> HistoryCompactor:
+    """環境変数 LLM_COMPACTION_* から履歴の圧縮を作成する"""
+    return HistoryCompactor(
+        enabled=os.getenv("LLM_COMPACTION_ENABLED", "true").lower() not in ("0", "false", "no"),
+        trigger_turns=int(os.getenv("LLM_COMPACTION_TRIGGER_TURNS", "12")),
+        keep_turns=int(os.getenv("LLM_COMPACTION_KEEP_TURNS", "4")),
+        max_history_tokens=int(os.getenv("LLM_COMPACTION_MAX_HISTORY_TOKENS", "0"))
+    )
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+適応的な同時実行数制御（AIMD） - プロバイダーの過負荷の兆候から同時に送る呼び出し数を自動で調整する
+
+- 呼び出しが成功し、レイテンシが目標内なら同時実行の上限（ウィンドウ）を加算的に増やす
+  （ウィンドウの半分以上を使っているときだけ増やし、負荷のない間に上限だけが膨らまないようにする）
+- 過負荷・クォータ超過・タイムアウトのエラーを受けたらウィンドウを乗算的に減らす
+  同時に送っていた呼び出しがまとめて失敗しても 1 回分だけ減らすよう、前回の削減より後に始まった呼び出しのみ数える
+- ウィンドウはモデルごと（LLMGateway）とキーごと（KeyPool）に持つ
+
+固定の同時実行数を手で調整しなくても、持続可能なスループットの付近に収束する。
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Optional
+
+from .retry import is_overload_error
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveLimiter:
+    """AIMD で上限を調整するセマフォ"""
+
+    def __init__(self, name: str, initial_limit: float = 8, min_limit: float = 1, max_limit: float = 64,
+                 increase: float = 1.0, decrease_factor: float = 0.5):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase  # ウィンドウ分の呼び出しが成功するごとに増やす量
+        self.decrease_factor = decrease_factor
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.in_flight = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._last_decrease = 0.0
+        self.stats = {"acquired": 0, "queued": 0, "successes": 0, "slow": 0, "overloads": 0,
+                      "increases": 0, "decreases": 0, "total_wait": 0.0}
+
+    @property
+    def window(self) -> int:
+        """同時に実行できる呼び出し数"""
+        return max(1, int(self.limit))
+
+    async def acquire(self) -> float:
+        """枠が空くまで待ち、呼び出しを始めた時刻を返す"""
+        enqueued_at = time.monotonic()
+        if self.in_flight >= self.window or self._waiters:
+            self.stats["queued"] += 1
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.append(future)
+            try:
+                await future
+            except asyncio.CancelledError:
+                # 枠を割り当てられた直後に取り消された場合は次の待機者に譲る
+                if future.done() and not future.cancelled():
+                    self.in_flight -= 1
+                    self._wake()
+                raise
+        else:
+            self.in_flight += 1
+        started = time.monotonic()
+        self.stats["acquired"] += 1
+        self.stats["total_wait"] += started - enqueued_at
+        return started
+
+    def release(self, started: float, error: Optional[BaseException] = None,
+                latency_target: Optional[float] = None) -> None:
+        """呼び出しの結果をウィンドウに反映して枠を返す
+
+        error が過負荷を示す例外なら減らし、成功してレイテンシが latency_target 以内なら増やす。
+        それ以外のエラーや取り消し（ヘッジで負けた呼び出しなど）は上限を変えない。
+        """
+        now = time.monotonic()
+        if error is None:
+            if latency_target and now - started > latency_target:
+                self.stats["slow"] += 1
+            else:
+                self.stats["successes"] += 1
+                self._on_success()
+        elif isinstance(error, Exception) and is_overload_error(error):
+            self.stats["overloads"] += 1
+            self._on_overload(started, now)
+        self.in_flight -= 1
+        self._wake()
+
+    def _on_success(self) -> None:
+        if self.in_flight * 2 < self.window or self.limit >= self.max_limit:
+            return
+        self.limit = min(self.max_limit, self.limit + self.increase / self.limit)
+        self.stats["increases"] += 1
+
+    def _on_overload(self, started: float, now: float) -> None:
+        if started < self._last_decrease:
+            return
+        previous = self.window
+        self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+        self._last_decrease = now
+        self.stats["decreases"] += 1
+        logger.warning(f"過負荷の応答を受けたため同時実行数を減らしました: {self.name} {previous} -> {self.window}")
+
+    def _wake(self) -> None:
+        while self._waiters and self.in_flight < self.window:
+            future = self._waiters.popleft()
+            if not future.done():
+                self.in_flight += 1
+                future.set_result(None)
+
+    def get_stats(self) -> Dict:
+        acquired = self.stats["acquired"]
+        return {
+            **{k: v for k, v in self.stats.items() if k != "total_wait"},
+            "limit": round(self.limit, 2),
+            "window": self.window,
+            "in_flight": self.in_flight,
+            "queue_depth": sum(1 for future in self._waiters if not future.done()),
+            "avg_wait_seconds": self.stats["total_wait"] / acquired if acquired else 0.0,
+        }
+
+
+class AdaptiveConcurrency:
+    """名前（モデル名・キー）ごとの AdaptiveLimiter を作成・保持する"""
+
+    def __init__(self, enabled: bool = True, initial_limit: float = 8, min_limit: float = 1,
+                 max_limit: float = 64, increase: float = 1.0, decrease_factor: float = 0.5,
+                 latency_target_ratio: float = 0.5):
+        self.enabled = enabled
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        # タスクプロファイルのタイムアウトに対するレイテンシ目標の割合（超えた成功ではウィンドウを増やさない）
+        self.latency_target_ratio = latency_target_ratio
+        self._limiters: Dict[str, AdaptiveLimiter] = {}
+
+    def limiter(self, name: str) -> AdaptiveLimiter:
+        if name not in self._limiters:
+            self._limiters[name] = AdaptiveLimiter(
+                name, initial_limit=self.initial_limit, min_limit=self.min_limit, max_limit=self.max_limit,
+                increase=self.increase, decrease_factor=self.decrease_factor
+            )
+        return self._limiters[name]
+
+    def latency_target(self, timeout: Optional[float]) -> Optional[float]:
+        """タイムアウトからレイテンシ目標を求める（タイムアウトがなければ目標なし）"""
+        return timeout * self.latency_target_ratio if timeout else None
+
+    async def acquire(self, name: str) -> Optional[float]:
+        """name のウィンドウの枠を確保し、開始時刻を返す（無効なら待たずに None）"""
+        if not self.enabled:
+            return None
+        return await self.limiter(name).acquire()
+
+    def release(self, name: str, started: Optional[float], error: Optional[BaseException] = None,
+                timeout: Optional[float] = None) -> None:
+        """acquire で確保した枠を結果とともに返す"""
+        if started is not None:
+            self.limiter(name).release(started, error, self.latency_target(timeout))
+
+    @asynccontextmanager
+    async def slot(self, name: str, timeout: Optional[float] = None):
+        """name のウィンドウ内で呼び出しを行う"""
+        started = await self.acquire(name)
+        try:
+            yield
+        except BaseException as e:
+            self.release(name, started, e)
+            raise
+        else:
+            self.release(name, started, timeout=timeout)
+
+    def get_stats(self) -> Dict:
+        return {name: limiter.get_stats() for name, limiter in self._limiters.items()}
+
+
+def create_concurrency_from_env() -> AdaptiveConcurrency:
+    """環境変数 LLM_CONCURRENCY_* から同時実行数の制御を作成する"""
+    return AdaptiveConcurrency(
+        enabled=os.getenv("LLM_CONCURRENCY_ENABLED", "true").lower() not in ("0", "false", "no"),
+        initial_limit=float(os.getenv("LLM_CONCURRENCY_INITIAL", "8")),
+        min_limit=float(os.getenv("LLM_CONCURRENCY_MIN", "1")),
+        max_limit=float(os.getenv("LLM_CONCURRENCY_MAX", "64")),
+        increase=float(os.getenv("LLM_CONCURRENCY_INCREASE", "1")),
+        decrease_factor=float(os.getenv("LLM_CONCURRENCY_DECREASE_FACTOR", "0.5")),
+        latency_target_ratio=float(os.getenv("LLM_CONCURRENCY_LATENCY_TARGET_RATIO", "0.5"))
+    )
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+LLM 呼び出しのコンテキスト
+
+HTTP リクエスト単位でセッション ID やエンドポイント名を contextvars に保持し、
+スケジューラなど LLM レイヤーの各処理から参照できるようにする。
+リクエストの期限（deadline）も同様に保持し、ゲートウェイが各 LLM 呼び出しのタイムアウトに使う。
+"""
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+DEFAULT_SESSION_ID = "default"
+
+_call_context: ContextVar[Dict[str, str]] = ContextVar("llm_call_context", default={})
+
+# 期限の時刻（time.monotonic 基準）。None なら期限なし
+_deadline: ContextVar[Optional[float]] = ContextVar("llm_request_deadline", default=None)
+
+
+def get_call_context() -> Dict[str, str]:
+    """現在のコンテキスト情報を返す"""
+    return _call_context.get()
+
+
+def get_session_id() -> str:
+    """現在のセッション ID を返す（未設定なら既定値）"""
+    return _call_context.get().get("session_id") or DEFAULT_SESSION_ID
+
+
+@contextmanager
+def call_context(**fields):
+    """with ブロック内の LLM 呼び出しにコンテキスト情報を付与する（入れ子の場合は上書き・追加）"""
+    token = _call_context.set({**_call_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _call_context.reset(token)
+
+
+def get_remaining_time() -> Optional[float]:
+    """リクエストの期限までの残り秒数を返す（期限なしなら None、過ぎていれば 0 以下）"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+@contextmanager
+def request_deadline(seconds: Optional[float]):
+    """with ブロック内の LLM 呼び出しに期限を設定する（入れ子の場合は早い方の期限を使う）"""
+    if seconds is None:
+        yield
+        return
+    deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(deadline if current is None else min(current, deadline))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+@contextmanager
+def without_deadline():
+    """with ブロック内では期限を設定しない（リクエストより長く続くバックグラウンド処理用）"""
+    token = _deadline.set(None)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
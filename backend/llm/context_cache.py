@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+コンテキストキャッシュ - 繰り返し送る共通の前置き（ペルソナ設定・商品情報）を 1 度だけ登録して参照する
+
+- ContextPrefix: プロジェクトごとに登録する前置き（チャット履歴と同じ {'role', 'parts'} 形式）
+- ContextCacheStore: プロバイダー側のキャッシュ（Gemini の CachedContent など）を前置き・モデルごとに保持する
+  前置きが短すぎる場合やキャッシュを作れなかった場合は、前置きをそのまま送る（インライン）
+- ContextCacheMeter: 前置きを参照した呼び出しで、キャッシュから読まれたトークン数（節約分）を集計する
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from .ledger import Usage
+from .tokens import estimate_contents_tokens
+
+logger = logging.getLogger(__name__)
+
+# 期限切れ直前のキャッシュを使わないための余裕（秒）
+EXPIRY_MARGIN_SECONDS = 60.0
+
+
+@dataclass(frozen=True)
+class ContextPrefix:
+    """キャッシュ対象の前置き"""
+    name: str  # 集計・表示用の名前（例: "persona:鈴木 翔太"）
+    contents: Tuple[Dict, ...]
+    key: str  # 内容のハッシュ（同じ内容なら同じキャッシュを使う）
+    tokens: int
+
+    def as_history(self) -> List[Dict]:
+        """インラインで送る場合の履歴"""
+        return [dict(content) for content in self.contents]
+
+    @property
+    def text(self) -> str:
+        """単発の生成でインラインで送る場合のテキスト"""
+        return "\n".join(part for content in self.contents for part in content["parts"])
+
+
+def make_context_prefix(name: str, contents: List[Dict]) -> ContextPrefix:
+    """前置きを作成する（contents は [{'role': 'user' | 'model', 'parts': [str]}]）"""
+    normalized = tuple({"role": content["role"], "parts": list(content["parts"])} for content in contents)
+    key = hashlib.sha256(json.dumps(normalized, ensure_ascii=False).encode("utf-8")).hexdigest()
+    return ContextPrefix(name=name, contents=normalized, key=key,
+                         tokens=estimate_contents_tokens(list(normalized)))
+
+
+class ContextCacheStore:
+    """前置き・モデルごとにプロバイダー側のキャッシュを作成・再利用する
+
+    同じ前置きを並行して参照しても、キャッシュの作成は 1 回だけ行う。
+    作成に失敗した前置きは以後インラインで送る。
+    """
+
+    def __init__(self, enabled: bool = True, min_tokens: int = 1024, ttl_seconds: float = 3600.0):
+        self.enabled = enabled
+        self.min_tokens = min_tokens  # これより短い前置きはキャッシュしない（プロバイダーの下限に合わせる）
+        self.ttl_seconds = ttl_seconds
+        self._entries: Dict[Tuple[str, str], Tuple[Any, float]] = {}
+        self._locks: Dict[Tuple[str, str], asyncio.Lock] = {}
+        self._failed = set()
+        self.stats = {"created": 0, "reused": 0, "inline": 0, "errors": 0}
+
+    async def get(self, prefix: ContextPrefix, model_name: str,
+                  create: Callable[[float], Awaitable[Any]]) -> Optional[Any]:
+        """キャッシュのハンドルを返す（インラインで送るべき場合は None）
+
+        create は TTL 秒を受け取り、プロバイダー側のキャッシュを作成する非同期関数。
+        """
+        entry_key = (prefix.key, model_name)
+        if not self.enabled or prefix.tokens < self.min_tokens or entry_key in self._failed:
+            self.stats["inline"] += 1
+            return None
+
+        lock = self._locks.setdefault(entry_key, asyncio.Lock())
+        async with lock:
+            entry = self._entries.get(entry_key)
+            if entry is not None and entry[1] - time.monotonic() > EXPIRY_MARGIN_SECONDS:
+                self.stats["reused"] += 1
+                return entry[0]
+            try:
+                handle = await create(self.ttl_seconds)
+            except Exception as e:
+                self.stats["errors"] += 1
+                self.stats["inline"] += 1
+                self._failed.add(entry_key)
+                logger.warning(f"コンテキストキャッシュを作成できないため前置きをそのまま送ります: {prefix.name}: {e}")
+                return None
+            self._entries[entry_key] = (handle, time.monotonic() + self.ttl_seconds)
+            self.stats["created"] += 1
+            logger.info(f"コンテキストキャッシュを作成しました: {prefix.name}（{prefix.tokens}トークン, {model_name}）")
+            return handle
+
+    def get_stats(self) -> Dict:
+        return {
+            **self.stats,
+            "entries": len(self._entries),
+            "min_tokens": self.min_tokens,
+            "ttl_seconds": self.ttl_seconds,
+        }
+
+
+class ContextCacheMeter:
+    """前置きごとに参照回数と、キャッシュから読まれたトークン数（再送せずに済んだ分）を集計する"""
+
+    def __init__(self):
+        self._prefixes: Dict[str, Dict] = {}
+
+    def record(self, prefix: ContextPrefix, usage: Optional[Usage]) -> None:
+        stats = self._prefixes.setdefault(prefix.name, {
+            "prefix_tokens": prefix.tokens, "calls": 0, "cached_calls": 0, "tokens_saved": 0
+        })
+        stats["prefix_tokens"] = prefix.tokens
+        stats["calls"] += 1
+        if usage is not None and usage.cached_tokens:
+            stats["cached_calls"] += 1
+            stats["tokens_saved"] += usage.cached_tokens
+
+    def get_stats(self) -> Dict:
+        return {
+            "tokens_saved": sum(stats["tokens_saved"] for stats in self._prefixes.values()),
+            "prefixes": {name: dict(stats) for name, stats in self._prefixes.items()},
+        }
+
+
+def create_context_cache_store_from_env() -> ContextCacheStore:
+    """環境変数 LLM_CONTEXT_CACHE_* からコンテキストキャッシュを作成する"""
+    return ContextCacheStore(
+        enabled=os.getenv("LLM_CONTEXT_CACHE_ENABLED", "true").lower() not in ("0", "false", "no"),
+        min_tokens=int(os.getenv("LLM_CONTEXT_CACHE_MIN_TOKENS", "1024")),
+        ttl_seconds=float(os.getenv("LLM_CONTEXT_CACHE_TTL_SECONDS", "3600"))
+    )
@@ -0,0 +1,751 @@
+# -*- coding: utf-8 -*-
+"""
+LLM ゲートウェイ - LLM 呼び出しを非同期で行う共通インターフェース
+
+エンドポイントから同期 API を直接呼ぶとイベントループ全体が停止するため、
+テキスト生成とチャット送信はすべてこのモジュールを経由して await する。
+実際の呼び出し先はプロバイダー（Gemini / シミュレーター）で差し替えられる。
+"""
+
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field, replace
+from typing import Any, AsyncIterator, Dict, List, Optional, Type
+
+from pydantic import BaseModel
+
+from .cache import ResponseCache, make_cache_key
+from .compaction import HistoryCompactor
+from .concurrency import AdaptiveConcurrency
+from .context import get_call_context, get_remaining_time, get_session_id
+from .context_cache import ContextCacheMeter, ContextPrefix
+from .hedging import HedgePolicy
+from .ledger import CostLedger, Usage, estimate_usage, split_usage
+from .packing import PromptPacker, pack_prompts, packed_schema, unpack_results
+from .profiles import ProfileRegistry, TaskProfile
+from .providers import GeminiProvider, LLMProvider, inline_prompt
+from .retry import (
+    CircuitBreaker,
+    CircuitOpenError,
+    RetryExhaustedError,
+    RetryPolicy,
+    create_breaker_from_env,
+    create_retry_policy_from_env,
+)
+from .scheduler import Priority, RateLimitScheduler
+from .singleflight import SingleFlight
+from .tracing import Span, Tracer, current_span
+from .structured import describe_error, json_generation_config, parse_structured, repair_prompt
+from .tokens import estimate_contents_tokens, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = "models/gemini-2.5-flash-lite"
+
+# レート制限で出力分として予約しておくトークン数（呼び出し後に実績で精算する）
+OUTPUT_TOKEN_RESERVE = 1024
+
+
+class LLMError(Exception):
+    """LLM 呼び出しに失敗した場合の例外"""
+
+
+class LLMOverloadedError(LLMError):
+    """一時的なエラーが続き、リトライ上限に達した場合の例外"""
+
+
+class LLMUnavailableError(LLMOverloadedError):
+    """プロバイダーの過負荷によりサーキットが開いており、呼び出しを行わなかった場合の例外"""
+
+
+class DeadlineExceededError(LLMError):
+    """リクエストの期限を過ぎたため、LLM 呼び出しを打ち切った（または行わなかった）場合の例外"""
+
+
+class StructuredOutputError(LLMError):
+    """構造化出力が修正を依頼した後もスキーマに適合しなかった場合の例外"""
+
+
+@dataclass
+class GenerationResult:
+    """テキスト生成の結果"""
+    text: str
+    model_name: str
+    cached: bool = False
+    coalesced: bool = False  # 同時実行中の同一プロンプトの結果を共有した
+    usage: Optional[Usage] = None  # API を呼んだ場合の実トークン数
+    candidates: List[str] = field(default_factory=list)  # candidate_count > 1 で得た全候補（先頭は text）
+    parsed: Optional[Any] = None  # generate_structured で検証済みのスキーマのインスタンス
+    repaired: bool = False  # 検証に失敗し、修正を依頼した結果
+    packed: bool = False  # 他のプロンプトとまとめた 1 回のリクエストで生成した（usage はまとめた全体の分）
+
+    @property
+    def billable(self) -> bool:
+        """API 呼び出しが実際に発生した結果かどうか"""
+        return not (self.cached or self.coalesced)
+
+
+class ChatSession:
+    """ペルソナとのチャットセッション
+
+    同じチャットへの送信が並行すると履歴が壊れるため、送信はロックで直列化する。
+    履歴の圧縮（HistoryCompactor）による置き換えも同じロックを取って行う。
+    """
+
+    def __init__(self, chat, model_name: str, persona: Optional[str] = None):
+        self.chat = chat
+        self.model_name = model_name
+        self.persona = persona
+        self.lock = asyncio.Lock()
+        # 履歴の圧縮の状態（先頭の要約の件数・要約・圧縮で履歴から減ったトークン数）
+        self.summary_message_count = 0
+        self.history_summary = ""
+        self.compacted_tokens = 0
+        self.compaction_task: Optional[asyncio.Future] = None
+
+    @property
+    def history(self):
+        return self.chat.history
+
+
+class LLMGateway:
+    """LLM へのテキスト生成・チャット送信を非同期で行うゲートウェイ"""
+
+    def __init__(self, provider: Optional[LLMProvider] = None, default_model: str = DEFAULT_MODEL,
+                 cache: Optional[ResponseCache] = None,
+                 scheduler: Optional[RateLimitScheduler] = None,
+                 retry_policy: Optional[RetryPolicy] = None,
+                 ledger: Optional[CostLedger] = None,
+                 hedging: Optional[HedgePolicy] = None,
+                 profiles: Optional[ProfileRegistry] = None,
+                 packer: Optional[PromptPacker] = None,
+                 concurrency: Optional[AdaptiveConcurrency] = None,
+                 tracer: Optional[Tracer] = None,
+                 compactor: Optional[HistoryCompactor] = None):
+        self.provider = provider or GeminiProvider()
+        self.default_model = default_model
+        self.cache = cache
+        self.scheduler = scheduler
+        self.ledger = ledger
+        self.retry_policy = retry_policy or create_retry_policy_from_env()
+        self.hedging = hedging
+        self.profiles = profiles or ProfileRegistry()
+        self.singleflight = SingleFlight()
+        self.packer = packer
+        # モデルごとの同時実行数（過負荷の応答で減らし、成功が続けば増やす）
+        self.concurrency = concurrency or AdaptiveConcurrency(enabled=False)
+        self.tracer = tracer or Tracer(enabled=False)
+        # 長くなったチャット履歴の古いやり取りを要約に置き換える
+        self.compactor = compactor or HistoryCompactor(enabled=False)
+        self.context_meter = ContextCacheMeter()
+        self.structured_stats = {"calls": 0, "repaired": 0, "failed": 0}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    async def generate_text(self, prompt: str, model_name: Optional[str] = None,
+                            temperature: Optional[float] = None, max_retries: Optional[int] = None,
+                            use_cache: bool = True,
+                            priority: Priority = Priority.BACKGROUND,
+                            template: Optional[str] = None,
+                            persona: Optional[str] = None,
+                            candidate_count: int = 1,
+                            context: Optional[ContextPrefix] = None,
+                            response_schema: Optional[Type[BaseModel]] = None) -> GenerationResult:
+        """プロンプトからテキストを生成する
+
+        キャッシュを参照し、ミスした場合も同時実行中の同一プロンプトがあれば
+        その結果を待つ。一時的なエラーはリトライポリシーに従って再試行する。
+        template はタスクプロファイルの選択とコスト台帳の集計ラベルに、persona は集計ラベルに使う。
+        model_name / temperature を指定した場合はプロファイルより優先する。
+        candidate_count > 1 の場合は 1 回の呼び出しで複数の候補を生成し、candidates に返す
+        （キャッシュには 1 候補分しか残せないため参照しない）。
+        context を指定した場合は、プロンプトの前に共通の前置きを付けて生成する
+        （プロバイダーがコンテキストキャッシュに対応していれば前置きは再送しない）。
+        response_schema を指定した場合は JSON モードで生成する（検証は generate_structured で行う）。
+        """
+        profile, model_name, generation_config = self._resolve(template, model_name, temperature, response_schema)
+        if candidate_count > 1:
+            generation_config["candidate_count"] = candidate_count
+            use_cache = False
+        key = make_cache_key(model_name, generation_config, inline_prompt(prompt, context))
+        use_cache = use_cache and self.cache is not None
+        labels = {"template": template, "persona": persona}
+
+        with self._trace_call("llm.generate", model_name, labels, prompt, context) as span:
+            if use_cache:
+                cached_text = await asyncio.to_thread(self.cache.get, key)
+                if cached_text is not None:
+                    span.set(cache="hit")
+                    return GenerationResult(text=cached_text, model_name=model_name, cached=True)
+
+            async def generate():
+                text, usage, candidates = await self._generate_with_retry(prompt, model_name, generation_config,
+                                                                          profile, max_retries, priority, labels,
+                                                                          context)
+                if use_cache and text:
+                    await asyncio.to_thread(self.cache.set, key, model_name, text)
+                return text, usage, candidates
+
+            # 共有する実行は期限なしで進め、待機は呼び出し元ごとの期限で打ち切る
+            (text, usage, candidates), shared = await self.singleflight.do(key, generate, wait=_within_deadline)
+            if shared:
+                # 実行中の同じ呼び出しの結果を待っただけのため、試行のスパンは実行した側に記録される
+                span.set(cache="coalesced")
+                return GenerationResult(text=text, model_name=model_name, coalesced=True, candidates=candidates)
+            span.set(cache="miss" if use_cache else None)
+            return GenerationResult(text=text, model_name=model_name, usage=usage, candidates=candidates)
+
+    async def stream_text(self, prompt: str, model_name: Optional[str] = None,
+                          temperature: Optional[float] = None, use_cache: bool = True,
+                          priority: Priority = Priority.BACKGROUND,
+                          template: Optional[str] = None,
+                          persona: Optional[str] = None,
+                          context: Optional[ContextPrefix] = None) -> AsyncIterator[GenerationResult]:
+        """プロンプトからテキストをストリーミングで生成し、差分を GenerationResult で順に返す
+
+        キャッシュにあれば全文を cached=True の結果 1 回で返す。リトライは最初のチャンクが届くまでに限り、
+        途中で失敗した場合は LLMError になる。ストリームを最後まで読まずに閉じた場合も
+        それまでの使用量をコスト台帳に記録する。重複リクエスト（ヘッジ）は行わない。
+        context は generate_text と同じ。
+        """
+        profile, model_name, generation_config = self._resolve(template, model_name, temperature)
+        key = make_cache_key(model_name, generation_config, inline_prompt(prompt, context))
+        use_cache = use_cache and self.cache is not None
+        labels = {"template": template, "persona": persona}
+        # 非同期ジェネレーターのため、スパンは現在のスパンにせず明示的に開始・終了する
+        span = self.tracer.start_span("llm.stream", self._call_attributes(model_name, labels, prompt, context))
+        stream_error: Optional[BaseException] = None
+        try:
+            if use_cache:
+                cached_text = await asyncio.to_thread(self.cache.get, key)
+                if cached_text is not None:
+                    span.set(cache="hit")
+                    yield GenerationResult(text=cached_text, model_name=model_name, cached=True)
+                    return
+
+            span.set(cache="miss" if use_cache else None)
+            input_tokens = estimate_tokens(prompt) + (context.tokens if context is not None else 0)
+
+            async def open_stream():
+                # 試行のスパンは最初のチャンクが届くまで（以降の所要時間はストリーム全体のスパンに含まれる）
+                with self.tracer.span("llm.attempt", parent=span):
+                    reserved = await self._acquire(input_tokens, priority)
+                    # 同時実行の枠はストリームを読み終えるまで使用中とする
+                    queued_at = time.monotonic()
+                    started = await self.concurrency.acquire(model_name)
+                    _trace_wait(time.monotonic() - queued_at)
+                    stream = self.provider.stream_generate(model_name, prompt, generation_config, context).__aiter__()
+                    try:
+                        first = await _with_timeout(stream.__anext__(), profile.timeout)
+                    except StopAsyncIteration:
+                        first = None
+                    except BaseException as e:
+                        self.concurrency.release(model_name, started, e)
+                        await stream.aclose()
+                        raise
+                    return reserved, started, stream, first
+
+            reserved, started, stream, chunk = await self._call_with_retry(open_stream, model_name)
+            parts: List[str] = []
+            usage: Optional[Usage] = None
+            error: Optional[BaseException] = None
+            try:
+                while chunk is not None:
+                    usage = chunk.usage or usage
+                    if chunk.text:
+                        parts.append(chunk.text)
+                        yield GenerationResult(text=chunk.text, model_name=model_name)
+                    try:
+                        chunk = await _within_deadline(_with_timeout(stream.__anext__(), profile.timeout))
+                    except StopAsyncIteration:
+                        chunk = None
+            except (Exception, asyncio.CancelledError, GeneratorExit) as e:
+                error = e
+                usage = estimate_usage(input_tokens, "".join(parts))
+                self._settle(reserved, usage, model_name, "stream", labels)
+                _trace_usage(span, usage)
+                if isinstance(e, DeadlineExceededError):
+                    raise
+                if isinstance(e, Exception):
+                    logger.error(f"ストリーミング生成中にエラーが発生しました: {type(e).__name__}: {e}")
+                    raise LLMError(str(e)) from e
+                raise
+            finally:
+                self.concurrency.release(model_name, started, error)
+                await stream.aclose()
+
+            text = "".join(parts)
+            usage = usage or estimate_usage(input_tokens, text)
+            self._settle(reserved, usage, model_name, "stream", labels)
+            _trace_usage(span, usage)
+            self._record_context(context, usage)
+            if use_cache and text:
+                await asyncio.to_thread(self.cache.set, key, model_name, text)
+        except (Exception, asyncio.CancelledError) as e:
+            stream_error = e
+            raise
+        finally:
+            _summarize_attempts(span)
+            self.tracer.end_span(span, stream_error)
+
+    async def generate_structured(self, prompt: str, schema: Type[BaseModel], model_name: Optional[str] = None,
+                                  temperature: Optional[float] = None, use_cache: bool = True,
+                                  priority: Priority = Priority.BACKGROUND,
+                                  template: Optional[str] = None,
+                                  persona: Optional[str] = None,
+                                  context: Optional[ContextPrefix] = None) -> GenerationResult:
+        """schema の JSON を生成し、検証済みのインスタンスを parsed に入れて返す
+
+        検証に失敗した場合は、元のプロンプトを再送せずにエラー箇所と出力だけを渡して 1 回だけ修正を依頼する。
+        修正後も適合しなければ StructuredOutputError になる。修正できた出力はキャッシュの元の結果を置き換える。
+        """
+        options = dict(model_name=model_name, temperature=temperature, priority=priority,
+                       template=template, persona=persona, response_schema=schema)
+        self.structured_stats["calls"] += 1
+        result = await self.generate_text(prompt, use_cache=use_cache, context=context, **options)
+        try:
+            result.parsed = parse_structured(result.text, schema)
+            return result
+        except ValueError as e:
+            error = e
+        logger.warning(f"構造化出力がスキーマに適合しないため修正を依頼します（{template}）:\n{describe_error(error)}")
+
+        repair = await self.generate_text(repair_prompt(result.text, error, schema), use_cache=False, **options)
+        try:
+            parsed = parse_structured(repair.text, schema)
+        except ValueError as e:
+            self.structured_stats["failed"] += 1
+            raise StructuredOutputError(f"構造化出力がスキーマに適合しませんでした: {describe_error(e)}") from e
+        self.structured_stats["repaired"] += 1
+
+        if use_cache and self.cache is not None:
+            _, resolved_model, generation_config = self._resolve(template, model_name, temperature, schema)
+            key = make_cache_key(resolved_model, generation_config, inline_prompt(prompt, context))
+            await asyncio.to_thread(self.cache.set, key, resolved_model, repair.text)
+        return GenerationResult(text=repair.text, model_name=repair.model_name, usage=repair.usage,
+                                parsed=parsed, repaired=True)
+
+    async def generate_packable(self, prompt: str, template: Optional[str] = None,
+                                persona: Optional[str] = None, use_cache: bool = True,
+                                priority: Priority = Priority.BACKGROUND,
+                                schema: Optional[Type[BaseModel]] = None) -> GenerationResult:
+        """他の小さなプロンプトとまとめて 1 回のリクエストで生成できるテキスト生成
+
+        同じテンプレート・優先度のプロンプトがパッカーの時間窓内に届けば、ID 付きの区切りで 1 つに詰めて
+        構造化出力で生成し、ID ごとに分けて返す。結果を得られなかった項目とまとめる相手がいなかった項目は
+        generate_text（schema があれば generate_structured）で個別に生成する。
+        """
+        options = dict(template=template, persona=persona, use_cache=use_cache, priority=priority)
+
+        async def individual():
+            if schema is not None:
+                return await self.generate_structured(prompt, schema, **options)
+            return await self.generate_text(prompt, **options)
+
+        if self.packer is None or not self.packer.enabled:
+            return await individual()
+
+        profile, model_name, generation_config = self._resolve(template, None, None, schema)
+        key = make_cache_key(model_name, generation_config, prompt)
+        use_cache = use_cache and self.cache is not None
+        if use_cache:
+            cached_text = await asyncio.to_thread(self.cache.get, key)
+            if cached_text is not None:
+                # キャッシュの結果は個別に生成した場合と同じ検証を通す
+                return await individual()
+
+        async def send(prompts: List[str], item_labels: List[Dict]) -> List[Optional[Any]]:
+            return await self._generate_packed(prompts, item_labels, template, model_name, profile, priority, schema)
+
+        group = (self.profiles.task_for(template), template, model_name, priority, schema)
+        # 結果はこの呼び出しの期限まで待つ（まとめた送信自体は期限なしで続く）
+        # 使用量はまとめた項目ごとに、その呼び出し元のセッション・エンドポイント・ペルソナへ按分する
+        labels = {**get_call_context(), "persona": persona}
+        result, packed = await _within_deadline(self.packer.submit(group, prompt, send, individual, labels))
+        if not packed:
+            return result
+        if schema is not None:
+            text = result.model_dump_json()
+            if use_cache:
+                await asyncio.to_thread(self.cache.set, key, model_name, text)
+            return GenerationResult(text=text, model_name=model_name, parsed=result, packed=True)
+        if use_cache:
+            await asyncio.to_thread(self.cache.set, key, model_name, result)
+        return GenerationResult(text=result, model_name=model_name, packed=True)
+
+    async def _generate_packed(self, prompts: List[str], item_labels: List[Dict], template: Optional[str],
+                               model_name: str, profile: TaskProfile, priority: Priority,
+                               schema: Optional[Type[BaseModel]]) -> List[Optional[Any]]:
+        """複数のプロンプトを 1 回のリクエストで生成し、プロンプトの順に結果を返す（得られなかった項目は None）
+
+        送信は最初の呼び出し元のコンテキストで行われるため、コスト台帳には項目ごとの呼び出し元の
+        セッション・エンドポイント・ペルソナで、プロンプトのトークン数の比で按分して記録する。
+        スパンには項目の呼び出し元の一覧を属性として付ける。
+        """
+        ids = [f"t{i + 1}" for i in range(len(prompts))]
+        generation_config = profile.generation_config()
+        generation_config.update(json_generation_config(packed_schema(schema)))
+        # 出力上限と時間は 1 件分の設定をまとめた件数分に広げる
+        if profile.max_output_tokens:
+            generation_config["max_output_tokens"] = profile.max_output_tokens * len(prompts)
+        if profile.timeout:
+            profile = replace(profile, timeout=profile.timeout * len(prompts))
+        shares = [(labels, estimate_tokens(item)) for labels, item in zip(item_labels, prompts)]
+        trace_labels = {"template": template}
+        for key in ("session_id", "endpoint", "persona"):
+            values = list(dict.fromkeys(labels.get(key) for labels in item_labels if labels.get(key)))
+            # 呼び出し元で共通ならその値、異なれば一覧（複数形の属性）にする
+            trace_labels[key] = values[0] if len(values) == 1 else None
+            if len(values) > 1:
+                trace_labels[f"{key}s"] = ", ".join(values)
+        prompt = pack_prompts(ids, prompts)
+        with self._trace_call("llm.generate_packed", model_name, trace_labels, prompt) as span:
+            span.set(packed_items=len(prompts))
+            try:
+                text, _, _ = await self._generate_with_retry(prompt, model_name, generation_config,
+                                                             profile, None, priority,
+                                                             {"template": template, "shares": shares})
+            except LLMError as e:
+                logger.warning(f"パックしたリクエストに失敗したため個別に生成します: {e}")
+                return [None] * len(prompts)
+            return unpack_results(text, ids, schema)
+
+    def _resolve(self, template: Optional[str], model_name: Optional[str], temperature: Optional[float],
+                 response_schema: Optional[Type[BaseModel]] = None):
+        """テンプレートに対応するプロファイル・モデル名・生成設定を返す"""
+        profile = self.profiles.get(template)
+        model_name = model_name or profile.model or self.default_model
+        generation_config = profile.generation_config(temperature)
+        if response_schema is not None:
+            generation_config.update(json_generation_config(response_schema))
+        return profile, model_name, generation_config
+
+    async def _acquire(self, input_tokens: int, priority: Priority) -> int:
+        """レート制限の許可を待ち、予約したトークン数を返す"""
+        reserved = input_tokens + OUTPUT_TOKEN_RESERVE
+        if self.scheduler is not None:
+            _trace_wait(await self.scheduler.acquire(reserved, priority, get_session_id()))
+        return reserved
+
+    def _settle(self, reserved: int, usage: Usage, model_name: str, kind: str, labels: Dict) -> None:
+        """予約したトークンを実績で精算し、コスト台帳に記録する"""
+        if self.scheduler is not None:
+            self.scheduler.settle(reserved, usage.input_tokens + usage.output_tokens)
+        if self.ledger is not None:
+            context_labels = get_call_context()
+            base = {**context_labels, **{k: v for k, v in labels.items() if v is not None and k != "shares"}}
+            shares = labels.get("shares")
+            if not shares:
+                self.ledger.record(usage, model_name, kind, base)
+                return
+            # まとめたリクエストは、項目ごとの呼び出し元に重みの比で按分する（呼び出し回数は 1 回として数える）
+            for i, ((share_labels, _), share) in enumerate(zip(shares, split_usage(usage, [w for _, w in shares]))):
+                self.ledger.record(share, model_name, kind, {
+                    **base, **{k: v for k, v in share_labels.items() if v is not None}
+                }, calls=1 if i == 0 else 0)
+
+    def _record_context(self, context: Optional[ContextPrefix], usage: Optional[Usage]) -> None:
+        """前置きを参照した呼び出しの、キャッシュから読まれたトークン数を集計する"""
+        if context is not None:
+            self.context_meter.record(context, usage)
+
+    def _call_attributes(self, model_name: str, labels: Dict, prompt: str,
+                         context: Optional[ContextPrefix] = None) -> Dict:
+        """LLM 呼び出しのスパンの属性（エンドポイント・セッション・ペルソナ・テンプレート・モデル・プロンプトの大きさ）"""
+        return {
+            **get_call_context(), **labels, "model": model_name,
+            "prompt_chars": len(prompt),
+            "estimated_input_tokens": estimate_tokens(prompt) + (context.tokens if context is not None else 0),
+            "context": context.name if context is not None else None,
+        }
+
+    @contextmanager
+    def _trace_call(self, name: str, model_name: str, labels: Dict, prompt: str,
+                    context: Optional[ContextPrefix] = None):
+        """LLM 呼び出し 1 回分のスパン（終了時に試行のスパンからリトライ回数・待機時間・トークン数を集計する）"""
+        with self.tracer.span(name, self._call_attributes(model_name, labels, prompt, context)) as span:
+            try:
+                yield span
+            finally:
+                _summarize_attempts(span)
+
+    def _breaker_for(self, model_name: str) -> CircuitBreaker:
+        """モデルごとのサーキットブレーカーを返す"""
+        if model_name not in self._breakers:
+            self._breakers[model_name] = create_breaker_from_env(model_name)
+        return self._breakers[model_name]
+
+    async def _call_with_retry(self, call, model_name: str, max_attempts: Optional[int] = None):
+        """リトライポリシーとサーキットブレーカーを適用して API を呼び出す
+
+        リクエストに期限があれば、レート制限の待機・リトライを含めた全体を期限までに打ち切る。
+        """
+        try:
+            return await _within_deadline(self.retry_policy.run(
+                call, breaker=self._breaker_for(model_name), max_attempts=max_attempts
+            ))
+        except DeadlineExceededError:
+            raise
+        except CircuitOpenError as e:
+            logger.warning(f"プロバイダー過負荷のため呼び出しを中止しました: {e}")
+            raise LLMUnavailableError(str(e)) from e
+        except RetryExhaustedError as e:
+            logger.error(f"LLM呼び出しが最大試行回数（{e.attempts}）に達しました: {e.last_error}")
+            raise LLMOverloadedError(str(e.last_error)) from e
+        except Exception as e:
+            logger.error(f"LLM呼び出し中にエラーが発生しました: {type(e).__name__}: {e}")
+            raise LLMError(str(e)) from e
+
+    async def _generate_with_retry(self, prompt: str, model_name: str, generation_config: Dict,
+                                   profile: TaskProfile, max_retries: Optional[int],
+                                   priority: Priority, labels: Dict,
+                                   context: Optional[ContextPrefix] = None):
+        """API を呼び出してテキストと使用量を返す（一時的なエラーはバックオフしてリトライ）"""
+        input_tokens = estimate_tokens(prompt) + (context.tokens if context is not None else 0)
+
+        async def attempt(is_hedge: bool = False, started: Optional[asyncio.Event] = None):
+            kind = "generate_hedge" if is_hedge else "generate"
+            with self.tracer.span("llm.attempt", {"hedge": is_hedge or None}) as span:
+                reserved = await self._acquire(input_tokens, priority)
+                try:
+                    queued_at = time.monotonic()
+                    async with self.concurrency.slot(model_name, profile.timeout):
+                        _trace_wait(time.monotonic() - queued_at)
+                        if started is not None:
+                            started.set()
+                        response = await _with_timeout(
+                            self.provider.generate(model_name, prompt, generation_config, context), profile.timeout
+                        )
+                except asyncio.CancelledError:
+                    # ヘッジで負けた・打ち切られた呼び出しも入力分は課金され得るため概算で記録する
+                    self._settle(reserved, Usage(input_tokens=input_tokens, output_tokens=0, estimated=True),
+                                 model_name, kind, labels)
+                    raise
+                usage = response.usage or estimate_usage(input_tokens, "".join(response.candidates or [response.text]))
+                self._settle(reserved, usage, model_name, kind, labels)
+                _trace_usage(span, usage)
+                self._record_context(context, usage)
+                return response.text, usage, response.candidates
+
+        async def call():
+            if self.hedging is None:
+                return await attempt()
+            return await self.hedging.run(attempt, model_name)
+
+        return await self._call_with_retry(call, model_name, max_attempts=max_retries)
+
+    def get_metrics(self) -> Dict:
+        """キャッシュ・シングルフライトなどのメトリクスをまとめて返す"""
+        return {
+            "cache": self.cache.get_stats() if self.cache is not None else None,
+            "singleflight": self.singleflight.get_stats(),
+            "scheduler": self.scheduler.get_stats() if self.scheduler is not None else None,
+            "concurrency": self.concurrency.get_stats() if self.concurrency.enabled else None,
+            "retry": self.retry_policy.get_stats(),
+            "hedging": self.hedging.get_stats() if self.hedging is not None else None,
+            "circuit_breakers": {name: breaker.get_stats() for name, breaker in self._breakers.items()},
+            "profiles": self.profiles.describe(),
+            "context_cache": self.context_meter.get_stats(),
+            "structured": dict(self.structured_stats),
+            "packing": self.packer.get_stats() if self.packer is not None else None,
+            "tracing": self.tracer.get_stats(),
+            "compaction": self.compactor.get_stats(),
+            "provider": {"name": self.provider.name, **getattr(self.provider, "stats", {})},
+        }
+
+    def start_chat(self, history: List[Dict], model_name: Optional[str] = None,
+                   persona: Optional[str] = None, context: Optional[ContextPrefix] = None) -> ChatSession:
+        """履歴付きのチャットセッションを作成する（通信は発生しない）
+
+        context はすべての送信で履歴の前に置く共通の前置き（ペルソナ設定など）。
+        """
+        model_name = model_name or self.profiles.get("persona_answer").model or self.default_model
+        return ChatSession(self.provider.start_chat(model_name, history, context), model_name, persona=persona)
+
+    def _chat_input_tokens(self, session: ChatSession, message: str) -> int:
+        context = getattr(session.chat, "context", None)
+        return (estimate_contents_tokens(session.history) + estimate_tokens(message)
+                + (context.tokens if context is not None else 0))
+
+    async def send_message(self, session: ChatSession, message: str,
+                           template: str = "persona_answer") -> str:
+        """チャットにメッセージを送信し、回答テキストを返す（対話レーンで優先処理）"""
+        async with session.lock:
+            # 履歴の要約は送信の開始時に反映する（生成中なら、この呼び出しの期限まで完成を待つ）
+            await _within_deadline(self.compactor.apply_pending(session))
+            self.compactor.record_send(session)
+            input_tokens = self._chat_input_tokens(session, message)
+            labels = {"persona": session.persona, "template": template}
+            profile = self.profiles.get(template)
+
+            async def call():
+                # 失敗した送信は履歴に残らないため、そのまま再送できる
+                with self.tracer.span("llm.attempt") as span:
+                    reserved = await self._acquire(input_tokens, Priority.INTERACTIVE)
+                    queued_at = time.monotonic()
+                    async with self.concurrency.slot(session.model_name, profile.timeout):
+                        _trace_wait(time.monotonic() - queued_at)
+                        response = await _with_timeout(
+                            self.provider.send_message(session.chat, message, profile.generation_config()),
+                            profile.timeout
+                        )
+                    usage = response.usage or estimate_usage(input_tokens, response.text)
+                    self._settle(reserved, usage, session.model_name, "chat", labels)
+                    _trace_usage(span, usage)
+                    self._record_context(getattr(session.chat, "context", None), usage)
+                    return response.text
+
+            with self._trace_call("llm.chat", session.model_name, labels, message,
+                                  getattr(session.chat, "context", None)) as span:
+                span.set(history_turns=len(session.history) // 2)
+                text = await self._call_with_retry(call, session.model_name)
+            self._schedule_compaction(session)
+            return text
+
+    async def sample_message(self, session: ChatSession, message: str, candidate_count: int,
+                             template: str = "persona_answer") -> GenerationResult:
+        """チャットの履歴に続く回答を 1 回の呼び出しで candidate_count 件生成する
+
+        履歴は変更しないため、採用する回答は append_turn で追加する。
+        """
+        return await self._sample(session, message, template, {"candidate_count": candidate_count},
+                                  candidate_count=candidate_count)
+
+    async def send_structured_message(self, session: ChatSession, message: str, schema: Type[BaseModel],
+                                      template: str = "persona_answer") -> GenerationResult:
+        """チャットの履歴に続けて schema の JSON を生成し、検証済みのインスタンスを parsed に入れて返す
+
+        履歴は変更しないため、JSON の一部（回答など）を append_turn で追加する。
+        検証に失敗した場合は generate_structured と同様に 1 回だけ修正を依頼する。
+        """
+        self.structured_stats["calls"] += 1
+        result = await self._sample(session, message, template, json_generation_config(schema), structured=True)
+        try:
+            result.parsed = parse_structured(result.text, schema)
+            return result
+        except ValueError as e:
+            error = e
+        logger.warning(f"構造化出力がスキーマに適合しないため修正を依頼します（{template}）:\n{describe_error(error)}")
+
+        repair = await self.generate_text(repair_prompt(result.text, error, schema), model_name=session.model_name,
+                                          use_cache=False, priority=Priority.INTERACTIVE, template=template,
+                                          persona=session.persona, response_schema=schema)
+        try:
+            parsed = parse_structured(repair.text, schema)
+        except ValueError as e:
+            self.structured_stats["failed"] += 1
+            raise StructuredOutputError(f"構造化出力がスキーマに適合しませんでした: {describe_error(e)}") from e
+        self.structured_stats["repaired"] += 1
+        return GenerationResult(text=repair.text, model_name=repair.model_name, usage=repair.usage,
+                                parsed=parsed, repaired=True)
+
+    async def _sample(self, session: ChatSession, message: str, template: str, extra_config: Dict,
+                      **trace_attributes) -> GenerationResult:
+        """チャットの履歴とメッセージを 1 回の generate として送る（対話レーンで優先処理、履歴は変更しない）"""
+        async with session.lock:
+            # 履歴の要約は送信の開始時に反映する（生成中なら、この呼び出しの期限まで完成を待つ）
+            await _within_deadline(self.compactor.apply_pending(session))
+            self.compactor.record_send(session)
+            input_tokens = self._chat_input_tokens(session, message)
+            labels = {"persona": session.persona, "template": template}
+            profile = self.profiles.get(template)
+            generation_config = {**profile.generation_config(), **extra_config}
+
+            async def call():
+                with self.tracer.span("llm.attempt") as span:
+                    reserved = await self._acquire(input_tokens, Priority.INTERACTIVE)
+                    queued_at = time.monotonic()
+                    async with self.concurrency.slot(session.model_name, profile.timeout):
+                        _trace_wait(time.monotonic() - queued_at)
+                        response = await _with_timeout(
+                            self.provider.sample_message(session.chat, message, generation_config),
+                            profile.timeout
+                        )
+                    usage = response.usage or estimate_usage(input_tokens, "".join(response.candidates or [response.text]))
+                    self._settle(reserved, usage, session.model_name, "sample", labels)
+                    _trace_usage(span, usage)
+                    self._record_context(getattr(session.chat, "context", None), usage)
+                    return response, usage
+
+            with self._trace_call("llm.sample", session.model_name, labels, message,
+                                  getattr(session.chat, "context", None)) as span:
+                span.set(**trace_attributes)
+                response, usage = await self._call_with_retry(call, session.model_name)
+            return GenerationResult(text=response.text, model_name=session.model_name, usage=usage,
+                                    candidates=response.candidates or [response.text])
+
+    def append_turn(self, session: ChatSession, message: str, answer: str) -> None:
+        """sample_message で選んだ回答をチャットの履歴に追加する"""
+        self.provider.append_turn(session.chat, message, answer)
+        self._schedule_compaction(session)
+
+    def _schedule_compaction(self, session: ChatSession) -> None:
+        """履歴が長くなっていれば、古いやり取りの要約をバックグラウンドで始める"""
+        async def summarize(prompt: str) -> str:
+            result = await self.generate_text(prompt, model_name=session.model_name, use_cache=False,
+                                              template="history_summary", persona=session.persona)
+            return result.text
+
+        self.compactor.schedule(session, summarize)
+
+
+def _trace_wait(seconds: float) -> None:
+    """レート制限・同時実行数の待機時間を現在の試行のスパンに加える"""
+    span = current_span()
+    if span is not None:
+        span.add("queue_wait_seconds", round(seconds, 4))
+
+
+def _trace_usage(span: Span, usage: Usage) -> None:
+    span.set(input_tokens=usage.input_tokens, output_tokens=usage.output_tokens,
+             cached_tokens=usage.cached_tokens, estimated_usage=usage.estimated or None)
+
+
+def _summarize_attempts(span: Span) -> None:
+    """呼び出しのスパンに、試行のスパンの回数・待機時間・トークン数の合計を設定する"""
+    attempts = [child for child in span.children if child.name == "llm.attempt"]
+    hedges = sum(1 for child in attempts if child.attributes.get("hedge"))
+    span.set(attempts=len(attempts), retries=max(0, len(attempts) - hedges - 1), hedges=hedges or None,
+             queue_wait_seconds=round(span.sum_children("queue_wait_seconds", "llm.attempt"), 4))
+    for key in ("input_tokens", "output_tokens", "cached_tokens"):
+        if key not in span.attributes and attempts:
+            span.set(**{key: int(span.sum_children(key, "llm.attempt"))})
+
+
+async def _within_deadline(awaitable):
+    """リクエストの期限までに終わらない処理を取り消し、DeadlineExceededError にする"""
+    remaining = get_remaining_time()
+    if remaining is None:
+        return await awaitable
+    if remaining <= 0:
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        raise DeadlineExceededError("リクエストの期限を過ぎたため LLM 呼び出しを行いませんでした")
+
+    # 処理内部のタイムアウトと区別するため、期限による取り消しかどうかを記録する
+    task = asyncio.ensure_future(awaitable)
+    expired = False
+
+    def expire():
+        nonlocal expired
+        expired = True
+        task.cancel()
+
+    handle = asyncio.get_running_loop().call_later(remaining, expire)
+    try:
+        return await task
+    except asyncio.CancelledError as e:
+        if not expired:
+            raise
+        logger.warning("リクエストの期限に達したため LLM 呼び出しを打ち切りました")
+        raise DeadlineExceededError("リクエストの期限に達したため LLM 呼び出しを打ち切りました") from e
+    finally:
+        handle.cancel()
+
+
+async def _with_timeout(awaitable, timeout: Optional[float]):
+    """プロファイルのタイムアウトを適用する（超過は asyncio.TimeoutError としてリトライ対象になる）"""
+    if not timeout:
+        return await awaitable
+    return await asyncio.wait_for(awaitable, timeout)
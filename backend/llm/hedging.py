@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+ヘッジリクエスト - 応答が遅い単発生成に重複リクエストを送り、先に返った方を使う
+
+- 待機の閾値はモデルごとの直近レイテンシの p95（サンプルが少ない間は初期値）
+- 重複送信は予算制: 通常の呼び出し 1 件ごとに budget 分だけ枠が貯まり、ヘッジ 1 件で 1 枠を使う
+- 負けた側はキャンセルする（コスト台帳への記録は呼び出し側が行う）
+
+チャット送信は履歴を変更するため対象外。
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# attempt(is_hedge, started) を受け取る呼び出し。started はレート制限を通過して API を呼び始めた時点でセットする
+Attempt = Callable[[bool, asyncio.Event], Awaitable[T]]
+
+
+class LatencyTracker:
+    """直近のレイテンシからパーセンタイルを求める"""
+
+    def __init__(self, window: int = 200):
+        self._samples: Deque[float] = deque(maxlen=window)
+
+    def observe(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(q * len(ordered)))
+        return ordered[index]
+
+
+class _StartEvent(asyncio.Event):
+    """セットされた時刻を保持するイベント"""
+
+    def set(self) -> None:
+        self.at = time.monotonic()
+        super().set()
+
+
+class HedgePolicy:
+    """p95 を超えても応答がない呼び出しに、予算の範囲で重複リクエストを送る"""
+
+    def __init__(self, percentile: float = 0.95, budget: float = 0.05, max_burst: float = 10.0,
+                 min_delay: float = 0.5, initial_delay: float = 5.0, min_samples: int = 20):
+        self.percentile = percentile
+        self.budget = budget
+        self.max_burst = max_burst
+        self.min_delay = min_delay
+        self.initial_delay = initial_delay
+        self.min_samples = min_samples
+        self._trackers: Dict[str, LatencyTracker] = {}
+        self._tokens = max_burst
+        self.stats = {"calls": 0, "hedged": 0, "hedge_wins": 0, "budget_denied": 0}
+
+    def _tracker(self, model_name: str) -> LatencyTracker:
+        if model_name not in self._trackers:
+            self._trackers[model_name] = LatencyTracker()
+        return self._trackers[model_name]
+
+    def threshold(self, model_name: str) -> float:
+        """重複リクエストを送るまでの待機秒数"""
+        tracker = self._tracker(model_name)
+        if len(tracker) < self.min_samples:
+            return self.initial_delay
+        return max(self.min_delay, tracker.percentile(self.percentile))
+
+    def _take_budget(self) -> bool:
+        if self._tokens >= 1.0:
+            self._tokens -= 1.0
+            return True
+        self.stats["budget_denied"] += 1
+        return False
+
+    async def _timed(self, attempt: Attempt, is_hedge: bool, started: _StartEvent, model_name: str):
+        result = await attempt(is_hedge, started)
+        # レート制限の待機は含めず、API 呼び出しの所要時間だけを記録する
+        self._tracker(model_name).observe(time.monotonic() - started.at)
+        return result
+
+    async def run(self, attempt: Attempt, model_name: str) -> T:
+        """attempt を実行し、閾値を超えたら重複リクエストを送って先に成功した結果を返す"""
+        self.stats["calls"] += 1
+        self._tokens = min(self.max_burst, self._tokens + self.budget)
+
+        primary_started = _StartEvent()
+        primary = asyncio.ensure_future(self._timed(attempt, False, primary_started, model_name))
+        try:
+            # 閾値はレート制限を通過して API を呼び始めた時点から数える
+            started_waiter = asyncio.ensure_future(primary_started.wait())
+            await asyncio.wait({primary, started_waiter}, return_when=asyncio.FIRST_COMPLETED)
+            started_waiter.cancel()
+            if not primary.done():
+                delay = self.threshold(model_name)
+                await asyncio.wait({primary}, timeout=delay)
+            if primary.done() or not self._take_budget():
+                return await primary
+
+            self.stats["hedged"] += 1
+            logger.info(f"応答が {self.threshold(model_name):.1f}秒を超えたため重複リクエストを送信します: {model_name}")
+            hedge = asyncio.ensure_future(self._timed(attempt, True, _StartEvent(), model_name))
+            return await self._first_success(primary, hedge)
+        finally:
+            if not primary.done():
+                primary.cancel()
+
+    async def _first_success(self, primary: asyncio.Future, hedge: asyncio.Future):
+        """先に成功した方の結果を返し、もう一方をキャンセルする（両方失敗なら元の呼び出しの例外）"""
+        pending = {primary, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        if future is hedge:
+                            self.stats["hedge_wins"] += 1
+                        return future.result()
+            return primary.result()
+        finally:
+            for future in (primary, hedge):
+                if not future.done():
+                    future.cancel()
+
+    def get_stats(self) -> Dict:
+        return {
+            **self.stats,
+            "budget_available": round(self._tokens, 2),
+            "thresholds": {model: round(self.threshold(model), 3) for model in self._trackers},
+        }
+
+
+def create_hedge_policy_from_env() -> Optional[HedgePolicy]:
+    """環境変数 LLM_HEDGE_* からヘッジポリシーを作成する（LLM_HEDGE_ENABLED=true で有効）"""
+    if os.getenv("LLM_HEDGE_ENABLED", "false").lower() not in ("1", "true", "yes"):
+        return None
+    return HedgePolicy(
+        percentile=float(os.getenv("LLM_HEDGE_PERCENTILE", "0.95")),
+        budget=float(os.getenv("LLM_HEDGE_BUDGET", "0.05")),
+        min_delay=float(os.getenv("LLM_HEDGE_MIN_DELAY", "0.5")),
+        initial_delay=float(os.getenv("LLM_HEDGE_INITIAL_DELAY", "5.0"))
+    )
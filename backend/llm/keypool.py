@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+API キープール - 複数の API キーに呼び出しを振り分け、1 キー分のクォータを上限にしない
+
+- キーごとに直近1分のリクエスト数・トークン数と実行中の呼び出し数を記録する
+- 同時実行のウィンドウ（AIMD で調整、concurrency.py）に対する実行中の呼び出しの割合が最も低い
+  （同じなら直近1分のリクエストが少ない）キーを選び、ウィンドウが埋まっていれば空くまで待つ
+- クォータ超過エラーを受けたキーはクールダウンさせ、連続した場合は待ち時間を倍にする
+  （全キーが休止中のときは最も早く休止が明けるキーで試行し、判断をリトライポリシーに委ねる）
+- キーごとに別のプロバイダーインスタンスを持つため、シミュレーターでもオフラインで検証できる
+"""
+
+import logging
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Dict, List, Optional, Tuple
+
+from google.api_core import exceptions as google_exceptions
+
+from .concurrency import AdaptiveConcurrency, create_concurrency_from_env
+from .context_cache import ContextPrefix
+from .providers import LLMProvider, ProviderResponse
+
+logger = logging.getLogger(__name__)
+
+# キーのクールダウン対象となる例外
+QUOTA_ERRORS = (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)
+
+WINDOW_SECONDS = 60.0
+
+
+def mask_key(key: str) -> str:
+    """メトリクスやログに出すためのキーの表示名（末尾 4 文字のみ）"""
+    return f"...{key[-4:]}" if len(key) > 4 else "..."
+
+
+def parse_api_keys(raw: Optional[str]) -> List[str]:
+    """カンマ区切りのキー一覧を重複なしのリストにする"""
+    keys = []
+    for key in (raw or "").split(","):
+        key = key.strip()
+        if key and key not in keys:
+            keys.append(key)
+    return keys
+
+
+class ApiKeyState:
+    """1 つの API キーの負荷と健全性"""
+
+    def __init__(self, key_id: str, requests_per_minute: float = 0):
+        self.key_id = key_id
+        self.requests_per_minute = requests_per_minute  # 0 以下は上限なし（選択時の判定のみに使う）
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.consecutive_quota_errors = 0
+        self._requests: Deque[float] = deque()
+        self._tokens: Deque[Tuple[float, int]] = deque()
+        self.stats = {"calls": 0, "errors": 0, "quota_errors": 0}
+
+    def _trim(self, now: float) -> None:
+        while self._requests and now - self._requests[0] > WINDOW_SECONDS:
+            self._requests.popleft()
+        while self._tokens and now - self._tokens[0][0] > WINDOW_SECONDS:
+            self._tokens.popleft()
+
+    def requests_last_minute(self, now: float) -> int:
+        self._trim(now)
+        return len(self._requests)
+
+    def tokens_last_minute(self, now: float) -> int:
+        self._trim(now)
+        return sum(tokens for _, tokens in self._tokens)
+
+    def available(self, now: float) -> bool:
+        if now < self.cooldown_until:
+            return False
+        if self.requests_per_minute > 0 and self.requests_last_minute(now) >= self.requests_per_minute:
+            return False
+        return True
+
+    def get_stats(self, now: float) -> Dict:
+        return {
+            **self.stats,
+            "in_flight": self.in_flight,
+            "requests_last_minute": self.requests_last_minute(now),
+            "tokens_last_minute": self.tokens_last_minute(now),
+            "cooling_down": now < self.cooldown_until,
+            "cooldown_remaining": max(0.0, self.cooldown_until - now),
+        }
+
+
+class KeyPool:
+    """最も負荷の低い健全なキーを選び、クォータ超過したキーを一時的に外す"""
+
+    def __init__(self, key_ids: List[str], cooldown_seconds: float = 60.0,
+                 max_cooldown_seconds: float = 600.0, requests_per_minute: float = 0,
+                 concurrency: Optional[AdaptiveConcurrency] = None):
+        if not key_ids:
+            raise ValueError("API キーが 1 つも指定されていません")
+        self.cooldown_seconds = cooldown_seconds
+        self.max_cooldown_seconds = max_cooldown_seconds
+        # キーごとの同時実行数（過負荷・クォータ超過の応答で減らし、成功が続けば増やす）
+        self.concurrency = concurrency or AdaptiveConcurrency(enabled=False)
+        self.keys: Dict[str, ApiKeyState] = {
+            key_id: ApiKeyState(key_id, requests_per_minute) for key_id in key_ids
+        }
+        self.stats = {"all_unavailable": 0}
+
+    def select(self) -> ApiKeyState:
+        """利用可能なキーのうち最も負荷の低いものを返す
+
+        全てのキーが休止中の場合は、単一キーと同様にリトライポリシーへ判断を委ねるため、
+        休止が最も早く明けるキーを返す。
+        """
+        now = time.monotonic()
+        candidates = [state for state in self.keys.values() if state.available(now)]
+        if not candidates:
+            self.stats["all_unavailable"] += 1
+            return min(self.keys.values(), key=lambda state: (state.cooldown_until, self._load(state)))
+        return min(candidates, key=lambda state: (self._load(state), state.requests_last_minute(now)))
+
+    def _load(self, state: ApiKeyState) -> float:
+        """キーの同時実行のウィンドウに対する実行中（枠待ちを含む）の呼び出しの割合"""
+        if not self.concurrency.enabled:
+            return state.in_flight
+        return state.in_flight / self.concurrency.limiter(state.key_id).window
+
+    @asynccontextmanager
+    async def lease(self):
+        """キーを 1 つ選んで呼び出し中として数え、結果に応じて状態を更新する
+
+        選択から in_flight の加算までの間に await を挟まないため、並行する呼び出しでも
+        同じキーに偏らない。選んだキーのウィンドウが埋まっていれば空くまで待つ。
+        """
+        state = self.select()
+        state.in_flight += 1
+        try:
+            started = await self.concurrency.acquire(state.key_id)
+        except BaseException:
+            state.in_flight -= 1
+            raise
+        state.stats["calls"] += 1
+        state._requests.append(time.monotonic())
+        try:
+            yield state
+        except BaseException as e:
+            self.concurrency.release(state.key_id, started, e)
+            if isinstance(e, Exception):
+                state.stats["errors"] += 1
+                if isinstance(e, QUOTA_ERRORS):
+                    self._cool_down(state)
+            raise
+        else:
+            self.concurrency.release(state.key_id, started)
+            state.consecutive_quota_errors = 0
+        finally:
+            state.in_flight -= 1
+
+    def record_tokens(self, state: ApiKeyState, tokens: int) -> None:
+        state._tokens.append((time.monotonic(), tokens))
+
+    def _cool_down(self, state: ApiKeyState) -> None:
+        state.stats["quota_errors"] += 1
+        state.consecutive_quota_errors += 1
+        duration = min(self.max_cooldown_seconds,
+                       self.cooldown_seconds * (2 ** (state.consecutive_quota_errors - 1)))
+        state.cooldown_until = time.monotonic() + duration
+        logger.warning(f"APIキー {state.key_id} がクォータ上限に達したため {duration:.0f}秒休止します")
+
+    def get_stats(self) -> Dict:
+        now = time.monotonic()
+        return {
+            **self.stats,
+            "keys": {
+                key_id: {
+                    **state.get_stats(now),
+                    "concurrency": self.concurrency.limiter(key_id).get_stats() if self.concurrency.enabled else None,
+                }
+                for key_id, state in self.keys.items()
+            },
+        }
+
+
+class PooledProvider(LLMProvider):
+    """キーごとのプロバイダーにキープールで呼び出しを振り分けるプロバイダー"""
+
+    def __init__(self, pool: KeyPool, providers: Dict[str, LLMProvider]):
+        self.pool = pool
+        self.providers = providers
+        self.name = f"{next(iter(providers.values())).name}+pool"
+
+    @property
+    def stats(self) -> Dict:
+        return {"pool": self.pool.get_stats()}
+
+    def _record_usage(self, state: ApiKeyState, response: ProviderResponse) -> None:
+        if response.usage is not None:
+            self.pool.record_tokens(state, response.usage.input_tokens + response.usage.output_tokens)
+
+    async def generate(self, model_name: str, prompt: str, generation_config: Dict,
+                       context: Optional[ContextPrefix] = None) -> ProviderResponse:
+        async with self.pool.lease() as state:
+            response = await self.providers[state.key_id].generate(model_name, prompt, generation_config, context)
+        self._record_usage(state, response)
+        return response
+
+    async def stream_generate(self, model_name: str, prompt: str, generation_config: Dict,
+                              context: Optional[ContextPrefix] = None) -> AsyncIterator[ProviderResponse]:
+        # ストリームを読み終えるまで同じキーを使用中として数える
+        async with self.pool.lease() as state:
+            last_usage = None
+            provider = self.providers[state.key_id]
+            async for chunk in provider.stream_generate(model_name, prompt, generation_config, context):
+                if chunk.usage is not None:
+                    last_usage = chunk  # usage は累計で届くため最後のものだけを記録する
+                yield chunk
+        if last_usage is not None:
+            self._record_usage(state, last_usage)
+
+    def start_chat(self, model_name: str, history: List[Dict], context: Optional[ContextPrefix] = None):
+        # チャットは送信のたびにキーを選び直す（各プロバイダーは他のキーで作られたチャットも送信でき、
+        # 前置きのキャッシュも送信に使うキーのものを参照する）
+        return next(iter(self.providers.values())).start_chat(model_name, history, context)
+
+    async def send_message(self, chat, message: str,
+                           generation_config: Optional[Dict] = None) -> ProviderResponse:
+        async with self.pool.lease() as state:
+            response = await self.providers[state.key_id].send_message(chat, message, generation_config)
+        self._record_usage(state, response)
+        return response
+
+    async def sample_message(self, chat, message: str,
+                             generation_config: Optional[Dict] = None) -> ProviderResponse:
+        async with self.pool.lease() as state:
+            response = await self.providers[state.key_id].sample_message(chat, message, generation_config)
+        self._record_usage(state, response)
+        return response
+
+    def append_turn(self, chat, message: str, answer: str) -> None:
+        next(iter(self.providers.values())).append_turn(chat, message, answer)
+
+
+def create_key_pool_from_env(key_ids: List[str]) -> KeyPool:
+    """環境変数 LLM_KEY_* からキープールを作成する"""
+    return KeyPool(
+        key_ids,
+        cooldown_seconds=float(os.getenv("LLM_KEY_COOLDOWN_SECONDS", "60")),
+        max_cooldown_seconds=float(os.getenv("LLM_KEY_MAX_COOLDOWN_SECONDS", "600")),
+        requests_per_minute=float(os.getenv("LLM_KEY_RPM_LIMIT", "0")),
+        concurrency=create_concurrency_from_env()
+    )
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+コスト台帳 - LLM 呼び出しごとの実トークン数と料金を記録・集計する
+
+トークン数はレスポンスの usage_metadata から取得し、取得できない場合のみ概算値を使う。
+セッション・エンドポイント・ペルソナ・プロンプトテンプレート単位で集計できる。
+"""
+
+import threading
+import time
+from collections import deque
+from dataclasses import asdict, dataclass
+from typing import Deque, Dict, List, Optional
+
+from .tokens import estimate_tokens
+
+# 集計に使える項目
+GROUP_BY_FIELDS = ("session_id", "endpoint", "persona", "template", "model", "kind")
+
+
+@dataclass
+class Usage:
+    """1 回の呼び出しのトークン使用量"""
+    input_tokens: int
+    output_tokens: int
+    cached_tokens: int = 0
+    estimated: bool = False  # usage_metadata がなく概算した値
+
+
+def usage_from_metadata(metadata) -> Optional[Usage]:
+    """レスポンスの usage_metadata から使用量を取り出す（取得できなければ None）"""
+    if metadata is None or not getattr(metadata, "prompt_token_count", 0):
+        return None
+    return Usage(
+        input_tokens=metadata.prompt_token_count,
+        output_tokens=getattr(metadata, "candidates_token_count", 0) or 0,
+        cached_tokens=getattr(metadata, "cached_content_token_count", 0) or 0,
+    )
+
+
+def estimate_usage(input_tokens: int, output_text: str) -> Usage:
+    """使用量が取得できない場合の概算"""
+    return Usage(input_tokens=input_tokens, output_tokens=estimate_tokens(output_text), estimated=True)
+
+
+def split_usage(usage: Usage, weights: List[int]) -> List[Usage]:
+    """1 回の呼び出しの使用量を重みの比で分ける（合計は元の使用量と一致させる）"""
+    if sum(weights) <= 0:
+        weights = [1] * len(weights)
+    shares = [weight / sum(weights) for weight in weights]
+
+    def divide(amount: int) -> List[int]:
+        parts = [int(amount * share) for share in shares]
+        parts[-1] += amount - sum(parts)
+        return parts
+
+    return [
+        Usage(input_tokens=i, output_tokens=o, cached_tokens=c, estimated=usage.estimated)
+        for i, o, c in zip(divide(usage.input_tokens), divide(usage.output_tokens), divide(usage.cached_tokens))
+    ]
+
+
+@dataclass
+class LedgerEntry:
+    timestamp: float
+    session_id: str
+    endpoint: str
+    persona: str
+    template: str
+    model: str
+    kind: str  # "generate" / "generate_hedge"（ヘッジの重複リクエスト） / "stream" / "chat" / "sample"（複数候補）
+    input_tokens: int
+    output_tokens: int
+    cached_tokens: int
+    cost: float
+    estimated: bool
+    calls: int = 1  # API 呼び出しの回数（まとめたリクエストを按分した明細は先頭の 1 件だけが 1）
+
+
+class CostLedger:
+    """呼び出しごとの使用量を記録し、任意の項目で集計する台帳"""
+
+    def __init__(self, input_token_price: float, output_token_price: float, max_entries: int = 10000,
+                 cached_token_price: Optional[float] = None):
+        self.input_token_price = input_token_price
+        self.output_token_price = output_token_price
+        # コンテキストキャッシュから読まれた入力トークンの単価（None なら通常の入力と同じ）
+        self.cached_token_price = input_token_price if cached_token_price is None else cached_token_price
+        self._entries: Deque[LedgerEntry] = deque(maxlen=max_entries)
+        # 明細が古い順に捨てられても集計は失われないよう、全項目の組み合わせ単位で合計を保持する
+        self._totals: Dict[tuple, Dict] = {}
+        self._lock = threading.Lock()
+
+    def cost_of(self, usage: Usage) -> float:
+        uncached_input = usage.input_tokens - usage.cached_tokens
+        return (uncached_input * self.input_token_price + usage.cached_tokens * self.cached_token_price
+                + usage.output_tokens * self.output_token_price)
+
+    def record(self, usage: Usage, model: str, kind: str, labels: Dict[str, str], calls: int = 1) -> LedgerEntry:
+        """使用量を記録する（labels は session_id / endpoint / persona / template）"""
+        entry = LedgerEntry(
+            timestamp=time.time(),
+            session_id=labels.get("session_id") or "",
+            endpoint=labels.get("endpoint") or "",
+            persona=labels.get("persona") or "",
+            template=labels.get("template") or "",
+            model=model,
+            kind=kind,
+            input_tokens=usage.input_tokens,
+            output_tokens=usage.output_tokens,
+            cached_tokens=usage.cached_tokens,
+            cost=self.cost_of(usage),
+            estimated=usage.estimated,
+            calls=calls,
+        )
+        key = tuple(getattr(entry, field) for field in GROUP_BY_FIELDS)
+        with self._lock:
+            self._entries.append(entry)
+            totals = self._totals.setdefault(key, _empty_totals())
+            _add_to_totals(totals, entry)
+        return entry
+
+    def summarize(self, group_by: Optional[List[str]] = None, **filters) -> Dict:
+        """filters に一致する呼び出しを group_by の項目ごとに集計する"""
+        group_by = [field for field in (group_by or []) if field in GROUP_BY_FIELDS]
+        filters = {k: v for k, v in filters.items() if k in GROUP_BY_FIELDS and v is not None}
+
+        overall = _empty_totals()
+        groups: Dict[tuple, Dict] = {}
+        with self._lock:
+            items = list(self._totals.items())
+        for key, totals in items:
+            labels = dict(zip(GROUP_BY_FIELDS, key))
+            if any(labels[field] != value for field, value in filters.items()):
+                continue
+            _merge_totals(overall, totals)
+            group_key = tuple(labels[field] for field in group_by)
+            _merge_totals(groups.setdefault(group_key, _empty_totals()), totals)
+
+        return {
+            "group_by": group_by,
+            "filters": filters,
+            "total": overall,
+            "groups": [
+                {**dict(zip(group_by, group_key)), **totals}
+                for group_key, totals in sorted(groups.items(), key=lambda item: -item[1]["cost"])
+            ] if group_by else [],
+        }
+
+    def entries(self, limit: int = 100, **filters) -> List[Dict]:
+        """新しい順に明細を返す"""
+        filters = {k: v for k, v in filters.items() if k in GROUP_BY_FIELDS and v is not None}
+        with self._lock:
+            entries = list(self._entries)
+        matched = [
+            asdict(entry) for entry in reversed(entries)
+            if all(getattr(entry, field) == value for field, value in filters.items())
+        ]
+        return matched[:limit]
+
+
+def _empty_totals() -> Dict:
+    return {"calls": 0, "input_tokens": 0, "output_tokens": 0, "cached_tokens": 0,
+            "cost": 0.0, "estimated_calls": 0}
+
+
+def _add_to_totals(totals: Dict, entry: LedgerEntry) -> None:
+    totals["calls"] += entry.calls
+    totals["input_tokens"] += entry.input_tokens
+    totals["output_tokens"] += entry.output_tokens
+    totals["cached_tokens"] += entry.cached_tokens
+    totals["cost"] += entry.cost
+    totals["estimated_calls"] += entry.calls if entry.estimated else 0
+
+
+def _merge_totals(target: Dict, source: Dict) -> None:
+    for field, value in source.items():
+        target[field] += value
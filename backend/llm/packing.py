@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+プロンプトのパッキング - 独立した小さな生成タスクを 1 回のリクエストにまとめる
+
+ペルソナごとの要約や更問の生成のように、短いプロンプトを別々に送ると往復の回数だけ待ち時間がかかる。
+PromptPacker は同じグループ（タスク・モデル・優先度が同じ）のプロンプトを短い時間窓で集め、
+ID を付けた区切りで 1 つのプロンプトに詰めて送り、構造化出力の結果を ID ごとに各呼び出し元へ返す。
+
+- 時間窓が過ぎるか、件数・トークン数が上限に達した時点で送信する（1 件だけなら通常どおり個別に送る）
+- 結果に含まれない・検証できない項目は、その項目の呼び出し元が個別の呼び出しで生成し直す
+- まとめた送信は最初の呼び出し元の期限に縛られない（各呼び出し元は自分の期限で結果を待つ）。
+  送信に失敗した場合も、各呼び出し元が自分のコンテキストで個別に生成し直す
+- 待っている呼び出し元がすべて取り消された（クライアントの切断など）場合は、まとめた送信も取り消す
+"""
+
+import asyncio
+import json
+import logging
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Set, Tuple, Type
+
+from pydantic import BaseModel, Field, ValidationError, create_model
+
+from .context import without_deadline
+from .structured import strip_code_fence
+from .tokens import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+_TASK_MARKER = "=== TASK {id} ==="
+_TASK_PATTERN = re.compile(r"^=== TASK (\S+) ===$", re.MULTILINE)
+
+# 個別に生成し直すべき項目を表す値
+_INDIVIDUAL = object()
+
+
+class PackedResult(BaseModel):
+    id: str = Field(description="タスクのID")
+    text: str = Field(description="そのタスクへの回答")
+
+
+class PackedOutput(BaseModel):
+    results: List[PackedResult]
+
+
+def packed_schema(item_schema: Optional[Type[BaseModel]] = None) -> Type[BaseModel]:
+    """パックしたリクエストの出力スキーマ（item_schema があれば各タスクの回答をそのスキーマにする）"""
+    if item_schema is None:
+        return PackedOutput
+    result = create_model(
+        f"Packed{item_schema.__name__}Result",
+        id=(str, Field(description="タスクのID")),
+        result=(item_schema, Field(description="そのタスクへの回答")),
+    )
+    return create_model(f"Packed{item_schema.__name__}Output", results=(List[result], ...))
+
+
+def pack_prompts(ids: List[str], prompts: List[str]) -> str:
+    """複数のプロンプトを ID 付きの区切りで 1 つのプロンプトにする"""
+    sections = "\n\n".join(f"{_TASK_MARKER.format(id=task_id)}\n{prompt.strip()}"
+                           for task_id, prompt in zip(ids, prompts))
+    return f"""以下の{len(prompts)}件のタスクに、それぞれ独立して回答してください。
+各タスクは「=== TASK <ID> ===」の行から次の区切りまでです。他のタスクの内容を回答に混ぜないでください。
+すべてのタスクについて、ID と回答を指定されたJSON形式で出力してください。
+
+{sections}
+"""
+
+
+def unpack_prompt(prompt: str) -> List[Tuple[str, str]]:
+    """pack_prompts で作ったプロンプトから (ID, 元のプロンプト) の一覧を取り出す（パックされていなければ空）"""
+    markers = list(_TASK_PATTERN.finditer(prompt))
+    tasks = []
+    for i, marker in enumerate(markers):
+        end = markers[i + 1].start() if i + 1 < len(markers) else len(prompt)
+        tasks.append((marker.group(1), prompt[marker.end():end].strip()))
+    return tasks
+
+
+def unpack_results(text: str, ids: List[str], item_schema: Optional[Type[BaseModel]] = None) -> List[Optional[Any]]:
+    """パックした出力を ids の順の結果にする（得られなかった・検証できなかった項目は None）
+
+    1 件の不備で全体を捨てないよう、出力全体ではなく項目ごとに検証する。
+    item_schema があれば各項目をそのインスタンスに、なければ回答テキストにする。
+    """
+    try:
+        data = json.loads(strip_code_fence(text))
+    except ValueError:
+        return [None] * len(ids)
+    entries = data.get("results") if isinstance(data, dict) else None
+    values: Dict[str, Any] = {}
+    for entry in entries if isinstance(entries, list) else []:
+        if isinstance(entry, dict) and entry.get("id") in ids and entry["id"] not in values:
+            values[entry["id"]] = _validate_item(entry.get("result" if item_schema else "text"), item_schema)
+    return [values.get(task_id) for task_id in ids]
+
+
+def _validate_item(value: Any, item_schema: Optional[Type[BaseModel]]) -> Optional[Any]:
+    if item_schema is None:
+        return value if isinstance(value, str) and value.strip() else None
+    try:
+        return item_schema.model_validate(value)
+    except ValidationError:
+        return None
+
+
+@dataclass
+class _Pending:
+    prompt: str
+    future: asyncio.Future
+    labels: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class _Batch:
+    send: Callable[[List[str], List[Dict[str, Any]]], Awaitable[List[Optional[Any]]]]
+    items: List[_Pending] = field(default_factory=list)
+    tokens: int = 0
+    timer: Optional[asyncio.TimerHandle] = None
+    task: Optional[asyncio.Task] = None
+
+
+class PromptPacker:
+    """同じグループのプロンプトを時間窓で集めて 1 回のリクエストにまとめる"""
+
+    def __init__(self, enabled: bool = True, window_seconds: float = 0.05, max_items: int = 8,
+                 max_input_tokens: int = 16000):
+        self.enabled = enabled
+        self.window_seconds = window_seconds
+        self.max_items = max_items
+        self.max_input_tokens = max_input_tokens  # 1 回のリクエストに詰めるプロンプトの合計トークン数の上限
+        self._batches: Dict[Hashable, _Batch] = {}
+        self._sending: Set[asyncio.Task] = set()  # 送信中のまとめたリクエスト
+        self.stats = {"submitted": 0, "requests": 0, "failed_requests": 0, "cancelled_requests": 0,
+                      "packed_items": 0, "individual": 0}
+
+    async def submit(self, group: Hashable, prompt: str,
+                     send: Callable[[List[str], List[Dict[str, Any]]], Awaitable[List[Optional[Any]]]],
+                     individual: Callable[[], Awaitable[Any]],
+                     labels: Optional[Dict[str, Any]] = None) -> Tuple[Any, bool]:
+        """プロンプトを送信待ちに加え、(結果, パックして生成できたか) を返す
+
+        send はグループのプロンプトと各項目の labels（呼び出し元のセッション・ペルソナなど、使用量の按分に使う）の
+        一覧を受け取ってまとめて生成し、各項目の結果（得られなかった項目は None）を返す。
+        グループで最初に届いた呼び出しの send を使う。individual はこの項目だけを個別に生成する
+        （1 件だけで送信する場合や結果を得られなかった場合に、呼び出し元のタスクで実行する）。
+        """
+        self.stats["submitted"] += 1
+        tokens = estimate_tokens(prompt)
+        loop = asyncio.get_running_loop()
+        pending = _Pending(prompt, loop.create_future(), dict(labels or {}))
+
+        batch = self._batches.get(group)
+        if batch is not None and batch.tokens + tokens > self.max_input_tokens:
+            self._flush(group)
+            batch = None
+        if batch is None:
+            batch = self._batches[group] = _Batch(send=send)
+            batch.timer = loop.call_later(self.window_seconds, self._flush, group)
+        batch.items.append(pending)
+        batch.tokens += tokens
+        pending.future.add_done_callback(lambda _: _cancel_if_abandoned(batch))
+        if len(batch.items) >= self.max_items:
+            self._flush(group)
+
+        result = await pending.future
+        if result is _INDIVIDUAL:
+            self.stats["individual"] += 1
+            return await individual(), False
+        return result, True
+
+    def _flush(self, group: Hashable) -> None:
+        batch = self._batches.pop(group, None)
+        if batch is None:
+            return
+        if batch.timer is not None:
+            batch.timer.cancel()
+        batch.task = asyncio.ensure_future(self._run(batch))
+        self._sending.add(batch.task)
+        batch.task.add_done_callback(self._sending.discard)
+
+    async def _run(self, batch: _Batch) -> None:
+        # 待っている間に取り消された呼び出しは除く
+        items = [item for item in batch.items if not item.future.done()]
+        if len(items) <= 1:
+            _resolve(items, [None] * len(items))
+            return
+
+        self.stats["requests"] += 1
+        try:
+            # 送信はグループで最初に届いた呼び出し元のコンテキストで始まるため、その期限は外す
+            with without_deadline():
+                results = await batch.send([item.prompt for item in items], [item.labels for item in items])
+        except asyncio.CancelledError:
+            self.stats["cancelled_requests"] += 1
+            logger.info(f"待っている呼び出し元がすべて取り消されたため、パックしたリクエスト（{len(items)} 件）を取り消しました")
+            raise
+        except Exception as e:
+            self.stats["failed_requests"] += 1
+            logger.warning(f"パックしたリクエストに失敗したため {len(items)} 件を個別に生成します: {e}")
+            _resolve(items, [None] * len(items))
+            return
+
+        missing = sum(1 for result in results if result is None)
+        if missing:
+            logger.warning(f"パックしたリクエストで {missing}/{len(items)} 件の結果を得られなかったため個別に生成します")
+        self.stats["packed_items"] += len(items) - missing
+        _resolve(items, results)
+
+    def get_stats(self) -> Dict:
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "window_seconds": self.window_seconds,
+            "max_items": self.max_items,
+        }
+
+
+def _cancel_if_abandoned(batch: _Batch) -> None:
+    """送信中のバッチの呼び出し元がすべて結果を受け取るか取り消されたら、送信を取り消す"""
+    if batch.task is not None and not batch.task.done() and all(item.future.done() for item in batch.items):
+        batch.task.cancel()
+
+
+def _resolve(items: List[_Pending], results: List[Optional[Any]]) -> None:
+    for item, result in zip(items, results):
+        if not item.future.done():
+            item.future.set_result(_INDIVIDUAL if result is None else result)
+
+
+def create_packer_from_env() -> PromptPacker:
+    """環境変数 LLM_PACKING_* からパッカーを作成する"""
+    return PromptPacker(
+        enabled=os.getenv("LLM_PACKING_ENABLED", "true").lower() not in ("0", "false", "no"),
+        window_seconds=float(os.getenv("LLM_PACKING_WINDOW_SECONDS", "0.05")),
+        max_items=int(os.getenv("LLM_PACKING_MAX_ITEMS", "8")),
+        max_input_tokens=int(os.getenv("LLM_PACKING_MAX_INPUT_TOKENS", "16000"))
+    )
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+タスクプロファイル - タスクごとのモデル・生成設定・タイムアウト
+
+1 行の更問生成と重い最終分析を同じ設定で呼ばないよう、呼び出しのテンプレート名を
+タスクに対応付け、タスクごとに model / temperature / max_output_tokens / timeout / stop_sequences を決める。
+
+設定の優先順位（後のものが優先）:
+1. DEFAULT_PROFILES
+2. LLM_PROFILES_FILE で指定した JSON ファイル（{"analysis": {"max_output_tokens": 4096}, ...}）
+3. 環境変数 LLM_PROFILE_<タスク名>_<項目名>（例: LLM_PROFILE_ANALYSIS_MAX_OUTPUT_TOKENS=4096）
+"""
+
+import json
+import logging
+import os
+from dataclasses import asdict, dataclass, field, fields, replace
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TASK = "default"
+
+
+@dataclass
+class TaskProfile:
+    """1 タスク分のモデルと生成設定"""
+    model: Optional[str] = None  # None ならゲートウェイの既定モデル
+    temperature: Optional[float] = None
+    max_output_tokens: Optional[int] = None
+    timeout: Optional[float] = None  # 1 回の API 呼び出しの上限秒数
+    stop_sequences: List[str] = field(default_factory=list)
+
+    def generation_config(self, temperature: Optional[float] = None) -> Dict:
+        """API に渡す生成設定（temperature は呼び出し側の指定を優先）"""
+        config = {}
+        temperature = temperature if temperature is not None else self.temperature
+        if temperature is not None:
+            config["temperature"] = temperature
+        if self.max_output_tokens:
+            config["max_output_tokens"] = self.max_output_tokens
+        if self.stop_sequences:
+            config["stop_sequences"] = list(self.stop_sequences)
+        return config
+
+
+DEFAULT_PROFILES: Dict[str, TaskProfile] = {
+    DEFAULT_TASK: TaskProfile(temperature=0.8, timeout=120),
+    "persona_generation": TaskProfile(temperature=0.8, max_output_tokens=4096, timeout=90),
+    "question_generation": TaskProfile(temperature=0.7, max_output_tokens=2048, timeout=60),
+    "follow_up_question": TaskProfile(temperature=0.7, max_output_tokens=256, timeout=20),
+    "persona_answer": TaskProfile(temperature=0.8, max_output_tokens=512, timeout=30),
+    # 質問票形式（全質問への回答・更問を1回で生成するため出力が長い）
+    "questionnaire": TaskProfile(temperature=0.8, max_output_tokens=8192, timeout=120),
+    "summary": TaskProfile(temperature=0.5, max_output_tokens=1024, timeout=60),
+    "analysis": TaskProfile(temperature=0.8, max_output_tokens=8192, timeout=180),
+    "hypothesis": TaskProfile(temperature=0.8, max_output_tokens=2048, timeout=90),
+}
+
+# 呼び出しテンプレート名 -> タスク名（コスト台帳の template ラベルと共通）
+TEMPLATE_TASKS: Dict[str, str] = {
+    "persona_generation": "persona_generation",
+    "default_questions": "question_generation",
+    "follow_up_question": "follow_up_question",
+    "persona_answer": "persona_answer",
+    "follow_up_answer": "persona_answer",
+    "fused_answer": "persona_answer",
+    "questionnaire_answer": "questionnaire",
+    "questionnaire_follow_up_question": "questionnaire",
+    "questionnaire_follow_up_answer": "questionnaire",
+    "persona_summary": "summary",
+    "interview_summary": "summary",
+    "chunk_summary": "summary",
+    "history_summary": "summary",
+    "analysis": "analysis",
+    "initial_analysis": "analysis",
+    "market_structure": "analysis",
+    "customer_needs": "analysis",
+    "product_improvement": "analysis",
+    "target_analysis": "analysis",
+    "improvement_analysis": "analysis",
+    "final_analysis": "analysis",
+    "hypothesis": "hypothesis",
+}
+
+_FIELD_TYPES = {
+    "model": str,
+    "temperature": float,
+    "max_output_tokens": int,
+    "timeout": float,
+}
+
+
+class ProfileRegistry:
+    """タスク名・テンプレート名からプロファイルを引く"""
+
+    def __init__(self, profiles: Optional[Dict[str, TaskProfile]] = None,
+                 template_tasks: Optional[Dict[str, str]] = None):
+        self.profiles = dict(profiles or DEFAULT_PROFILES)
+        self.template_tasks = dict(template_tasks or TEMPLATE_TASKS)
+
+    def task_for(self, template: Optional[str]) -> str:
+        if template in self.profiles:
+            return template
+        return self.template_tasks.get(template or "", DEFAULT_TASK)
+
+    def get(self, template: Optional[str]) -> TaskProfile:
+        """テンプレート名（またはタスク名）に対応するプロファイルを返す"""
+        return self.profiles.get(self.task_for(template)) or self.profiles[DEFAULT_TASK]
+
+    def update(self, task: str, **overrides) -> None:
+        """プロファイルの一部の項目を上書きする（未登録のタスクは既定値から作る）"""
+        known = {f.name for f in fields(TaskProfile)}
+        unknown = set(overrides) - known
+        if unknown:
+            logger.warning(f"タスクプロファイル '{task}' の不明な項目を無視します: {', '.join(sorted(unknown))}")
+        base = self.profiles.get(task) or self.profiles[DEFAULT_TASK]
+        self.profiles[task] = replace(base, **{k: v for k, v in overrides.items() if k in known})
+
+    def describe(self) -> Dict:
+        return {
+            "profiles": {task: asdict(profile) for task, profile in self.profiles.items()},
+            "templates": dict(self.template_tasks),
+        }
+
+
+def _parse_env_value(name: str, raw: str):
+    if name == "stop_sequences":
+        return [s for s in raw.split("|") if s] if raw else []
+    return _FIELD_TYPES[name](raw)
+
+
+def create_profile_registry_from_env() -> ProfileRegistry:
+    """既定値に LLM_PROFILES_FILE と LLM_PROFILE_* の設定を重ねたレジストリを作成する"""
+    registry = ProfileRegistry()
+
+    path = os.getenv("LLM_PROFILES_FILE")
+    if path:
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            for task, overrides in data.items():
+                registry.update(task, **overrides)
+            logger.info(f"タスクプロファイルを読み込みました: {path}")
+        except (OSError, ValueError, TypeError) as e:
+            logger.error(f"タスクプロファイルファイルの読み込みに失敗しました: {path}: {e}")
+
+    for task in list(registry.profiles):
+        overrides = {}
+        for name in list(_FIELD_TYPES) + ["stop_sequences"]:
+            raw = os.getenv(f"LLM_PROFILE_{task.upper()}_{name.upper()}")
+            if raw is None:
+                continue
+            try:
+                overrides[name] = _parse_env_value(name, raw)
+            except ValueError:
+                logger.warning(f"LLM_PROFILE_{task.upper()}_{name.upper()} の値が不正です: {raw}")
+        if overrides:
+            registry.update(task, **overrides)
+
+    return registry
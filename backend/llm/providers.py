@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+LLM プロバイダー - ゲートウェイから呼び出すモデル実装の共通インターフェース
+
+- GeminiProvider: google.generativeai を使う本番用プロバイダー
+- SimulatedProvider（simulator.py）: 負荷試験・オフライン用のローカルシミュレーター
+- RecordingProvider / ReplayProvider（cassette.py）: 呼び出しの記録と決定的な再生
+- PooledProvider（keypool.py）: 複数の API キーへの振り分け
+"""
+
+import asyncio
+import datetime
+import logging
+import os
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import google.generativeai as genai
+from google.generativeai import caching
+from google.generativeai import client as genai_client
+
+from .context_cache import ContextCacheStore, ContextPrefix, create_context_cache_store_from_env
+from .ledger import Usage, usage_from_metadata
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ProviderResponse:
+    """プロバイダーからの応答"""
+    text: str
+    usage: Optional[Usage] = None  # プロバイダーが使用量を返さない場合は None
+    raw: Any = None
+    candidates: List[str] = field(default_factory=list)  # candidate_count > 1 の全候補（先頭は text）
+
+
+def history_to_dicts(history) -> List[Dict]:
+    """チャット履歴（dict または protos.Content）を {'role', 'parts': [str]} のリストに揃える"""
+    result = []
+    for content in history or []:
+        if isinstance(content, dict):
+            role, parts = content["role"], content["parts"]
+        else:
+            role, parts = content.role, content.parts
+        texts = [part if isinstance(part, str) else getattr(part, "text", "") for part in parts]
+        result.append({"role": role, "parts": texts})
+    return result
+
+
+class LocalChat:
+    """履歴を dict のリストで保持するチャット（送信のたびに履歴全体をプロバイダーに渡す）
+
+    context（共通の前置き）は履歴に含めず、送信時にプロバイダーがキャッシュを参照するかインラインで付ける。
+    """
+
+    def __init__(self, model_name: str, history: List[Dict], context: Optional[ContextPrefix] = None):
+        self.model_name = model_name
+        self.context = context
+        self.history = history_to_dicts(history)
+
+    def append_turn(self, message: str, answer: str) -> None:
+        self.history.append({"role": "user", "parts": [message]})
+        self.history.append({"role": "model", "parts": [answer]})
+
+
+def inline_prompt(prompt: str, context: Optional[ContextPrefix]) -> str:
+    """前置きをキャッシュせずに送る場合の単発プロンプト"""
+    return f"{context.text}\n\n{prompt}" if context is not None else prompt
+
+
+class LLMProvider:
+    """LLM プロバイダーの共通インターフェース
+
+    context を受け取るメソッドは、対応していればプロバイダー側のキャッシュを参照し、
+    対応していなければ前置きをインラインで送る。
+    """
+
+    name = "base"
+
+    async def generate(self, model_name: str, prompt: str, generation_config: Dict,
+                       context: Optional[ContextPrefix] = None) -> ProviderResponse:
+        """単発のテキスト生成"""
+        raise NotImplementedError
+
+    async def stream_generate(self, model_name: str, prompt: str, generation_config: Dict,
+                              context: Optional[ContextPrefix] = None) -> AsyncIterator[ProviderResponse]:
+        """単発のテキスト生成をストリーミングで行う（text は差分、usage は分かった時点で設定）
+
+        ストリーミングに対応しないプロバイダーは生成結果全体を 1 回で返す。
+        """
+        yield await self.generate(model_name, prompt, generation_config, context)
+
+    def start_chat(self, model_name: str, history: List[Dict], context: Optional[ContextPrefix] = None):
+        """履歴付きのチャットを作成する（通信は発生しない）"""
+        return LocalChat(model_name, history, context)
+
+    async def send_message(self, chat, message: str,
+                           generation_config: Optional[Dict] = None) -> ProviderResponse:
+        """チャットにメッセージを送信する（成功した場合のみ履歴に追加される）"""
+        raise NotImplementedError
+
+    async def sample_message(self, chat, message: str,
+                             generation_config: Optional[Dict] = None) -> ProviderResponse:
+        """チャットの履歴に続く回答を生成する（履歴は変更しない）
+
+        チャット API は candidate_count > 1 に対応しないため、履歴とメッセージを 1 回の
+        generate として送り、複数の候補を得る。
+        """
+        raise NotImplementedError
+
+    def append_turn(self, chat, message: str, answer: str) -> None:
+        """sample_message で選んだ回答をチャットの履歴に追加する"""
+        chat.append_turn(message, answer)
+
+
+class GeminiProvider(LLMProvider):
+    """google.generativeai を使うプロバイダー
+
+    チャットの履歴は LocalChat で保持し、送信のたびに generate_content に渡す
+    （ChatSession と同じ送り方だが、前置きをコンテキストキャッシュから参照できる）。
+    """
+
+    name = "gemini"
+
+    def __init__(self, api_key: Optional[str] = None, isolated: bool = False,
+                 context_cache: Optional[ContextCacheStore] = None):
+        """isolated=True の場合は genai.configure() の全体設定を使わず、このキー専用のクライアントで呼び出す"""
+        self._client_manager = None
+        if isolated and api_key:
+            self._client_manager = genai_client._ClientManager()
+            self._client_manager.configure(api_key=api_key)
+        elif api_key:
+            genai.configure(api_key=api_key)
+        # CachedContent は作成した API キーからしか参照できないため、キーごとに保持する
+        self.context_cache = context_cache
+
+    @property
+    def stats(self) -> Dict:
+        return {"context_cache": self.context_cache.get_stats()} if self.context_cache is not None else {}
+
+    def _bind_client(self, model) -> None:
+        if self._client_manager is not None:
+            model._async_client = self._client_manager.get_default_client("generative_async")
+
+    async def _model(self, model_name: str, context: Optional[ContextPrefix]):
+        """呼び出しに使うモデルと、インラインで送る必要のある前置きの履歴を返す"""
+        cached = None
+        if context is not None and self.context_cache is not None:
+            cached = await self.context_cache.get(
+                context, model_name, lambda ttl: self._create_cached_content(model_name, context, ttl)
+            )
+        if cached is not None:
+            # ハンドルの CachedContent を渡すため、キャッシュの再取得の通信は発生しない
+            model = genai.GenerativeModel.from_cached_content(cached)
+        else:
+            model = genai.GenerativeModel(model_name=model_name)
+        self._bind_client(model)
+        if context is None or cached is not None:
+            return model, []
+        return model, context.as_history()
+
+    async def _create_cached_content(self, model_name: str, context: ContextPrefix, ttl: float):
+        """前置きの CachedContent を作成する（失敗した場合は ContextCacheStore が前置きをインラインで送る）"""
+        display_name, contents = context.name[:128], context.as_history()
+        ttl = datetime.timedelta(seconds=ttl)
+        if self._client_manager is None:
+            return await asyncio.to_thread(
+                caching.CachedContent.create, model_name, display_name=display_name, contents=contents, ttl=ttl
+            )
+        # CachedContent.create は genai.configure() のキーのクライアントでしか作成できないため、
+        # キー専用のクライアントでは google-generativeai 0.8.3（requirements.txt で固定）の内部 API で作成する。
+        # バージョンを上げて内部 API が変わった場合はここで例外になり、前置きをインラインで送る
+        request = caching.CachedContent._prepare_create_request(
+            model_name, display_name=display_name, contents=contents, ttl=ttl
+        )
+        client = self._client_manager.get_default_client("cache")
+        response = await asyncio.to_thread(client.create_cached_content, request)
+        return caching.CachedContent._from_obj(response)
+
+    async def _single_contents(self, model_name: str, prompt: str, context: Optional[ContextPrefix]):
+        model, inline = await self._model(model_name, context)
+        return model, (inline_prompt(prompt, context) if inline else prompt)
+
+    async def generate(self, model_name: str, prompt: str, generation_config: Dict,
+                       context: Optional[ContextPrefix] = None) -> ProviderResponse:
+        model, contents = await self._single_contents(model_name, prompt, context)
+        response = await model.generate_content_async(contents, generation_config=generation_config)
+        return _to_provider_response(response)
+
+    async def stream_generate(self, model_name: str, prompt: str, generation_config: Dict,
+                              context: Optional[ContextPrefix] = None) -> AsyncIterator[ProviderResponse]:
+        model, contents = await self._single_contents(model_name, prompt, context)
+        response = await model.generate_content_async(contents, generation_config=generation_config, stream=True)
+        async for chunk in response:
+            yield ProviderResponse(
+                text=_chunk_text(chunk),
+                usage=usage_from_metadata(getattr(chunk, "usage_metadata", None)),
+                raw=chunk
+            )
+
+    async def _chat_request(self, chat: LocalChat, message: str, generation_config: Optional[Dict]):
+        # キープール使用時は送信ごとにキーが変わるため、モデルは送信のたびにこのキーのクライアントで作る
+        model, inline = await self._model(chat.model_name, chat.context)
+        contents = [*inline, *chat.history, {"role": "user", "parts": [message]}]
+        return await model.generate_content_async(contents, generation_config=generation_config)
+
+    async def send_message(self, chat: LocalChat, message: str,
+                           generation_config: Optional[Dict] = None) -> ProviderResponse:
+        response = await self._chat_request(chat, message, generation_config)
+        text = response.text
+        chat.append_turn(message, text)
+        return ProviderResponse(
+            text=text,
+            usage=usage_from_metadata(getattr(response, "usage_metadata", None)),
+            raw=response
+        )
+
+    async def sample_message(self, chat: LocalChat, message: str,
+                             generation_config: Optional[Dict] = None) -> ProviderResponse:
+        return _to_provider_response(await self._chat_request(chat, message, generation_config))
+
+
+def _to_provider_response(response) -> ProviderResponse:
+    """generate_content の応答を ProviderResponse にする（候補が複数あれば response.text は使えない）"""
+    candidates = [
+        "".join(part.text for part in candidate.content.parts)
+        for candidate in getattr(response, "candidates", None) or []
+    ]
+    return ProviderResponse(
+        text=response.text if len(candidates) <= 1 else candidates[0],
+        usage=usage_from_metadata(getattr(response, "usage_metadata", None)),
+        raw=response,
+        candidates=candidates if len(candidates) > 1 else []
+    )
+
+
+def _chunk_text(chunk) -> str:
+    """ストリームのチャンクのテキスト（終了理由のみのチャンクなどテキストがない場合は空文字）"""
+    try:
+        return chunk.text
+    except ValueError:
+        return ""
+
+
+def _create_single_provider(provider_name: str, api_key: Optional[str], isolated: bool = False) -> LLMProvider:
+    if provider_name == "simulator":
+        from .simulator import create_simulator_from_env
+        return create_simulator_from_env()
+    return GeminiProvider(api_key=api_key, isolated=isolated, context_cache=create_context_cache_store_from_env())
+
+
+def create_provider_from_env() -> LLMProvider:
+    """環境変数 LLM_PROVIDER（gemini / simulator）からプロバイダーを作成する
+
+    GOOGLE_API_KEYS にカンマ区切りで複数のキーを指定した場合はキープールで振り分ける
+    （simulator でもキーごとにインスタンスを作るため、オフラインでキープールを検証できる）。
+    """
+    provider_name = os.getenv("LLM_PROVIDER", "gemini").lower()
+
+    cassette_mode = os.getenv("LLM_CASSETTE_MODE", "").lower()
+    if cassette_mode == "replay":
+        # 再生時は実プロバイダーを一切使わない
+        from .cassette import create_cassette_provider_from_env
+        return create_cassette_provider_from_env(None)
+
+    if provider_name not in ("gemini", "simulator"):
+        logger.warning(f"不明なLLMプロバイダー '{provider_name}' が指定されました。Geminiを使用します。")
+        provider_name = "gemini"
+    if provider_name == "simulator":
+        logger.info("LLMプロバイダー: ローカルシミュレーター")
+
+    from .keypool import PooledProvider, create_key_pool_from_env, mask_key, parse_api_keys
+    api_keys = parse_api_keys(os.getenv("GOOGLE_API_KEYS"))
+    if len(api_keys) > 1:
+        key_ids = [f"#{i + 1} {mask_key(key)}" for i, key in enumerate(api_keys)]
+        providers = {
+            key_id: _create_single_provider(provider_name, key, isolated=True)
+            for key_id, key in zip(key_ids, api_keys)
+        }
+        logger.info(f"APIキープールを使用します（{len(api_keys)}キー）")
+        provider = PooledProvider(create_key_pool_from_env(key_ids), providers)
+    else:
+        api_key = api_keys[0] if api_keys else os.getenv('GOOGLE_API_KEY')
+        if provider_name == "gemini" and not api_key:
+            logger.error("エラー: 環境変数 'GOOGLE_API_KEY' が設定されていません。")
+        provider = _create_single_provider(provider_name, api_key)
+
+    if cassette_mode == "record":
+        from .cassette import create_cassette_provider_from_env
+        return create_cassette_provider_from_env(provider)
+    return provider
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+リトライポリシーとサーキットブレーカー
+
+- 例外の型で一時的なエラーかどうかを判定し、指数バックオフ＋ジッターで非同期に待機して再試行する
+- プロバイダーの過負荷が続く場合はサーキットを開き、一定時間は呼び出さずに即座に失敗させる
+"""
+
+import asyncio
+import logging
+import os
+import random
+import time
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+from google.api_core import exceptions as google_exceptions
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# 過負荷・クォータ超過・タイムアウトを示す例外（サーキットブレーカーの失敗として数える）
+OVERLOAD_ERRORS = (
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.TooManyRequests,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.GatewayTimeout,
+    asyncio.TimeoutError,
+)
+
+# リトライで回復し得る例外
+RETRYABLE_ERRORS = OVERLOAD_ERRORS + (
+    google_exceptions.InternalServerError,
+    google_exceptions.BadGateway,
+    google_exceptions.Aborted,
+    ConnectionError,
+)
+
+
+def is_retryable_error(error: BaseException) -> bool:
+    return isinstance(error, RETRYABLE_ERRORS)
+
+
+def is_overload_error(error: BaseException) -> bool:
+    return isinstance(error, OVERLOAD_ERRORS)
+
+
+class RetryExhaustedError(Exception):
+    """一時的なエラーが続き、最大試行回数に達した"""
+
+    def __init__(self, last_error: BaseException, attempts: int):
+        super().__init__(str(last_error))
+        self.last_error = last_error
+        self.attempts = attempts
+
+
+class CircuitOpenError(Exception):
+    """サーキットが開いているため呼び出しを行わなかった"""
+
+
+class CircuitBreaker:
+    """連続した過負荷エラーでサーキットを開き、回復待ちの後に試行を 1 件だけ通す"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_seconds: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_seconds = recovery_seconds
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+        self._probe_in_flight = False
+
+    def before_call(self) -> None:
+        """呼び出し可否を判定する（不可なら CircuitOpenError）"""
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.recovery_seconds:
+                self.rejected += 1
+                raise CircuitOpenError(f"{self.name} のサーキットが開いています")
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+
+        if self.state == self.HALF_OPEN:
+            if self._probe_in_flight:
+                self.rejected += 1
+                raise CircuitOpenError(f"{self.name} は回復確認中です")
+            self._probe_in_flight = True
+
+    def record_success(self) -> None:
+        if self.state != self.CLOSED:
+            logger.info(f"サーキットを閉じました: {self.name}")
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self, error: BaseException) -> None:
+        if not is_overload_error(error):
+            # 過負荷以外の失敗はプロバイダーの状態を示さない
+            if self.state == self.HALF_OPEN:
+                self._probe_in_flight = False
+            return
+
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"過負荷が続いているためサーキットを開きます: {self.name}（{self.recovery_seconds}秒）")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+    def get_stats(self) -> Dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "rejected": self.rejected,
+        }
+
+
+class RetryPolicy:
+    """指数バックオフ（フルジッター）で一時的なエラーを再試行するポリシー"""
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 1.0,
+                 max_delay: float = 30.0, multiplier: float = 2.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.stats = {"calls": 0, "retries": 0, "exhausted": 0}
+
+    def backoff(self, attempt: int) -> float:
+        """attempt 回目（1 始まり）の失敗後の待機秒数"""
+        ceiling = min(self.max_delay, self.base_delay * (self.multiplier ** (attempt - 1)))
+        return random.uniform(0, ceiling)
+
+    async def run(self, call: Callable[[], Awaitable[T]], breaker: Optional[CircuitBreaker] = None,
+                  max_attempts: Optional[int] = None) -> T:
+        """call を実行し、一時的なエラーならバックオフして再試行する"""
+        max_attempts = max_attempts or self.max_attempts
+        self.stats["calls"] += 1
+        attempt = 0
+
+        while True:
+            attempt += 1
+            if breaker is not None:
+                breaker.before_call()
+            try:
+                result = await call()
+            except (Exception, asyncio.CancelledError) as e:
+                # キャンセルも記録し、回復確認中の枠を解放する
+                if breaker is not None:
+                    breaker.record_failure(e)
+                if not is_retryable_error(e):
+                    raise
+                if attempt >= max_attempts:
+                    self.stats["exhausted"] += 1
+                    raise RetryExhaustedError(e, attempt) from e
+
+                wait_time = self.backoff(attempt)
+                self.stats["retries"] += 1
+                logger.warning(f"API一時エラー（リトライ {attempt}/{max_attempts - 1}）: {type(e).__name__}: {e}。{wait_time:.1f}秒待機中...")
+                await asyncio.sleep(wait_time)
+                continue
+
+            if breaker is not None:
+                breaker.record_success()
+            return result
+
+    def get_stats(self) -> Dict:
+        return dict(self.stats)
+
+
+def create_retry_policy_from_env() -> RetryPolicy:
+    """環境変数 LLM_RETRY_* からリトライポリシーを作成する"""
+    return RetryPolicy(
+        max_attempts=int(os.getenv("LLM_RETRY_MAX_ATTEMPTS", "3")),
+        base_delay=float(os.getenv("LLM_RETRY_BASE_DELAY", "1.0")),
+        max_delay=float(os.getenv("LLM_RETRY_MAX_DELAY", "30.0"))
+    )
+
+
+def create_breaker_from_env(name: str) -> CircuitBreaker:
+    """環境変数 LLM_BREAKER_* からサーキットブレーカーを作成する"""
+    return CircuitBreaker(
+        name,
+        failure_threshold=int(os.getenv("LLM_BREAKER_FAILURE_THRESHOLD", "5")),
+        recovery_seconds=float(os.getenv("LLM_BREAKER_RECOVERY_SECONDS", "30"))
+    )
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+レートリミットスケジューラ - プロセス全体で Gemini 呼び出しの流量を制御する
+
+- 1分あたりのリクエスト数（RPM）とトークン数（TPM）をトークンバケットで制限
+- 優先度レーン: ペルソナの回答など対話的な呼び出しを要約・分析より先に通す
+- セッション間の公平性: 同じレーン内ではセッションごとにラウンドロビンで割り当てる
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from enum import IntEnum
+from typing import Deque, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    """呼び出しの優先度（値が小さいほど先に処理）"""
+    INTERACTIVE = 0  # ペルソナの回答・更問など、ユーザーが待っている呼び出し
+    BACKGROUND = 1  # 要約・分析など
+
+
+class TokenBucket:
+    """1分あたりの上限で補充されるトークンバケット（上限 0 以下は無制限）"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.capacity <= 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """amount を消費できるまでの待ち秒数を返す"""
+        if self.unlimited:
+            return 0.0
+        self._refill()
+        amount = min(amount, self.capacity)  # 上限を超える要求も満タンになれば通す
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float) -> None:
+        if not self.unlimited:
+            self.tokens -= min(amount, self.capacity)
+
+    def adjust(self, delta: float) -> None:
+        """見積もりと実績の差分を反映する（正なら追加消費、負なら返却）"""
+        if not self.unlimited:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - delta)
+
+
+class _Waiter:
+    def __init__(self, future: asyncio.Future, tokens: int, session_id: str):
+        self.future = future
+        self.tokens = tokens
+        self.session_id = session_id
+        self.enqueued_at = time.monotonic()
+
+
+class RateLimitScheduler:
+    """RPM/TPM の予算内で、優先度とセッション間の公平性に従って呼び出しを許可する"""
+
+    # 1回の待機の上限（新たに届いた高優先度の呼び出しを再評価するため）
+    MAX_SLEEP_SECONDS = 1.0
+
+    def __init__(self, requests_per_minute: float = 0, tokens_per_minute: float = 0):
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        # レーンごとに セッションID -> 待機キュー
+        self._lanes: Dict[Priority, "OrderedDict[str, Deque[_Waiter]]"] = {
+            priority: OrderedDict() for priority in Priority
+        }
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._lane_stats = {
+            priority: {"granted": 0, "total_wait": 0.0, "max_wait": 0.0} for priority in Priority
+        }
+
+    async def acquire(self, tokens: int, priority: Priority = Priority.BACKGROUND,
+                      session_id: str = "default") -> float:
+        """呼び出しの許可を待ち、待機秒数を返す"""
+        if self._is_idle() and self._ready_in(tokens) <= 0:
+            self._consume(tokens)
+            self._record_wait(priority, 0.0)
+            return 0.0
+
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter(loop.create_future(), tokens, session_id)
+        self._lanes[priority].setdefault(session_id, deque()).append(waiter)
+        if self._dispatcher is None or self._dispatcher.done() or self._dispatcher.get_loop() is not loop:
+            self._dispatcher = loop.create_task(self._dispatch())
+
+        await waiter.future
+        wait = time.monotonic() - waiter.enqueued_at
+        if wait > 1.0:
+            logger.info(f"レート制限により {wait:.1f}秒待機しました（{priority.name}, session={session_id}）")
+        return wait
+
+    def settle(self, reserved_tokens: int, actual_tokens: int) -> None:
+        """呼び出し完了後、予約したトークン数と実際の使用量の差を精算する"""
+        self.token_bucket.adjust(actual_tokens - reserved_tokens)
+
+    def _is_idle(self) -> bool:
+        return not any(lane for lane in self._lanes.values())
+
+    def _ready_in(self, tokens: int) -> float:
+        return max(self.request_bucket.wait_time(1), self.token_bucket.wait_time(tokens))
+
+    def _consume(self, tokens: int) -> None:
+        self.request_bucket.consume(1)
+        self.token_bucket.consume(tokens)
+
+    def _record_wait(self, priority: Priority, wait: float) -> None:
+        stats = self._lane_stats[priority]
+        stats["granted"] += 1
+        stats["total_wait"] += wait
+        stats["max_wait"] = max(stats["max_wait"], wait)
+
+    def _next_waiter(self):
+        """優先度の高いレーンから、先頭セッションの先頭の待機者を返す（キャンセル済みは除去）"""
+        for priority in Priority:
+            lane = self._lanes[priority]
+            while lane:
+                session_id, queue = next(iter(lane.items()))
+                while queue and queue[0].future.done():
+                    queue.popleft()
+                if queue:
+                    return priority, session_id, queue[0]
+                del lane[session_id]
+        return None
+
+    async def _dispatch(self) -> None:
+        while True:
+            entry = self._next_waiter()
+            if entry is None:
+                return
+            priority, session_id, waiter = entry
+
+            delay = self._ready_in(waiter.tokens)
+            if delay > 0:
+                await asyncio.sleep(min(delay, self.MAX_SLEEP_SECONDS))
+                continue
+
+            lane = self._lanes[priority]
+            queue = lane[session_id]
+            queue.popleft()
+            # ラウンドロビン: 割り当てたセッションはレーンの末尾へ回す
+            if queue:
+                lane.move_to_end(session_id)
+            else:
+                del lane[session_id]
+
+            self._consume(waiter.tokens)
+            self._record_wait(priority, time.monotonic() - waiter.enqueued_at)
+            waiter.future.set_result(None)
+
+    def get_stats(self) -> Dict:
+        """キューの深さ・待機時間・バケット残量を返す"""
+        lanes = {}
+        for priority in Priority:
+            lane = self._lanes[priority]
+            stats = self._lane_stats[priority]
+            lanes[priority.name.lower()] = {
+                "queue_depth": sum(1 for queue in lane.values() for w in queue if not w.future.done()),
+                "waiting_sessions": len(lane),
+                "granted": stats["granted"],
+                "avg_wait_seconds": stats["total_wait"] / stats["granted"] if stats["granted"] else 0.0,
+                "max_wait_seconds": stats["max_wait"],
+            }
+        return {
+            "requests_per_minute": self.request_bucket.capacity,
+            "tokens_per_minute": self.token_bucket.capacity,
+            "available_requests": None if self.request_bucket.unlimited else self.request_bucket.tokens,
+            "available_tokens": None if self.token_bucket.unlimited else self.token_bucket.tokens,
+            "queue_depth": sum(lane["queue_depth"] for lane in lanes.values()),
+            "lanes": lanes,
+        }
+
+
+def create_scheduler_from_env() -> RateLimitScheduler:
+    """環境変数 LLM_RPM_LIMIT / LLM_TPM_LIMIT からスケジューラを作成する（0 で無制限）"""
+    return RateLimitScheduler(
+        requests_per_minute=float(os.getenv("LLM_RPM_LIMIT", "1000")),
+        tokens_per_minute=float(os.getenv("LLM_TPM_LIMIT", "1000000"))
+    )
@@ -0,0 +1,415 @@
+# -*- coding: utf-8 -*-
+"""
+ローカルシミュレータープロバイダー - API を呼ばずに負荷試験・オフライン検証を行う
+
+- レイテンシ分布（対数正規・一様・固定）と出力トークンあたりの生成時間を設定できる
+- 指定した割合で過負荷・クォータ超過エラーを発生させる
+- 共通の前置き（ContextPrefix）はローカルのコンテキストキャッシュで代替し、キャッシュから読んだ
+  トークン数を usage の cached_tokens として返す
+- 1分あたりのクォータを超えた呼び出しはクォータ超過エラーにする（キープールの検証用）
+- 同時実行数の容量を超えた呼び出しは過負荷エラーにする（同時実行数の適応制御の検証用）
+- 応答はプロンプトのハッシュから決定的に生成し、parse_personas() や
+  追加質問の抽出正規表現が期待する形式の日本語テキストを返す
+- JSON モード（response_schema 指定）ではスキーマに沿った JSON を返す。指定した割合で
+  途中で切れた JSON を返し、構造化出力の修正依頼を検証できる
+- パックしたプロンプト（packing.pack_prompts）には、タスクごとに個別の場合と同じ応答を返す
+- 質問票（「Q1: ...」の行を含むプロンプト）の JSON には質問の数だけ、質問番号を付けた要素を返す
+"""
+
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import AsyncIterator, Dict, List, Optional
+
+from google.api_core import exceptions as google_exceptions
+
+from .context_cache import ContextCacheStore, ContextPrefix, create_context_cache_store_from_env
+from .ledger import Usage
+from .packing import unpack_prompt
+from .providers import LLMProvider, LocalChat, ProviderResponse, inline_prompt
+from .structured import is_structured_config
+from .tokens import estimate_contents_tokens, estimate_tokens
+
+_LAST_NAMES = ["佐藤", "鈴木", "高橋", "田中", "伊藤", "渡辺", "山本", "中村", "小林", "加藤"]
+_FIRST_NAMES = ["美咲", "健太", "陽子", "翔太", "由美", "大輔", "恵", "拓也", "彩", "直樹"]
+_OCCUPATIONS = ["会社員（営業）", "公務員", "看護師", "ITエンジニア", "パート勤務", "自営業", "大学生", "主婦", "教員", "デザイナー"]
+_REGIONS = ["東京都世田谷区", "大阪府大阪市", "神奈川県横浜市", "愛知県名古屋市", "福岡県福岡市", "北海道札幌市"]
+_FAMILIES = ["独身・一人暮らし", "夫婦二人暮らし", "夫婦と子ども1人", "夫婦と子ども2人", "両親と同居"]
+_HOBBIES = ["週末のカフェ巡り", "ランニング", "料理と家庭菜園", "動画配信サービスで映画鑑賞", "キャンプ", "読書"]
+_CONCERNS = ["仕事と家庭の両立", "老後の資金", "健康維持", "時間の使い方", "子どもの教育費", "キャリアアップ"]
+
+_QUESTIONS = [
+    "ご自身の簡単な自己紹介をお願いします。",
+    "普段の1日の過ごし方について教えてください。",
+    "休日はどのように過ごすことが多いですか？",
+    "最近購入して満足したものは何ですか？",
+    "買い物をするときに重視することは何ですか？",
+    "新しい商品を知るきっかけは何が多いですか？",
+    "この商品・サービスに対してどのような印象を持ちますか？",
+    "この商品・サービスを使うとしたら、どのような場面ですか？",
+    "似た商品・サービスを使った経験はありますか？",
+    "競合の商品と比べて、魅力に感じる点はどこですか？",
+    "この商品・サービスのベネフィットにどの程度共感しますか？",
+    "価格についてどのように感じますか？",
+    "いくらであれば購入を検討しますか？",
+    "購入をためらう理由があるとすれば何ですか？",
+    "この商品・サービスに不安に感じることはありますか？",
+    "友人に勧めるとしたら、どのように説明しますか？",
+    "口コミやレビューは購入判断にどの程度影響しますか？",
+    "理想的な商品・サービスとはどのようなものですか？",
+    "今後この分野に期待することは何ですか？",
+    "最後に、何か付け加えたいことはありますか？",
+]
+
+_ANSWER_SENTENCES = [
+    "正直なところ、価格次第では試してみたいと思います。",
+    "毎日忙しいので、手間が減るのであればとても魅力的です。",
+    "以前似たサービスを使ったことがありますが、続きませんでした。",
+    "家族の意見も聞いてから決めることが多いですね。",
+    "SNSで評判を見てから判断すると思います。",
+    "品質がしっかりしていれば、多少高くても納得できます。",
+    "具体的な効果がイメージできると、もっと興味が湧きます。",
+    "競合の商品と比べて、違いがまだよく分かっていません。",
+    "週末にまとめて使うような使い方になりそうです。",
+    "不安があるとすれば、サポート体制がどうなっているかです。",
+]
+
+_ANALYSIS_SENTENCES = [
+    "「価格次第では試してみたい」という発言があることから、価格設定が購買の分岐点になっていると読み取れる。",
+    "「手間が減るのであれば魅力的」という発言があることから、時短ベネフィットへの共感度は高いと読み取れる。",
+    "「競合との違いが分からない」という発言があることから、差別化ポイントの訴求が不足していると読み取れる。",
+    "「サポート体制が不安」という発言があることから、導入後の安心感を伝える施策が有効と考えられる。",
+    "「SNSで評判を見る」という発言があることから、口コミを起点としたコミュニケーションが重要である。",
+]
+
+# ストリーミング時に 1 回で返す文字数
+STREAM_CHUNK_CHARS = 8
+
+_HEADING_PATTERN = re.compile(r'^\s*(#{2,3})\s*(\d+)\.\s*(.+?)\s*$', re.MULTILINE)
+
+
+def _rng_for(*parts: str) -> random.Random:
+    """入力から決定的な乱数生成器を作る"""
+    digest = hashlib.sha256("\x00".join(parts).encode("utf-8")).digest()
+    return random.Random(int.from_bytes(digest[:8], "big"))
+
+
+def _sentences(rng: random.Random, pool: List[str], count: int) -> str:
+    return "".join(rng.sample(pool, min(count, len(pool))))
+
+
+def canned_response(prompt: str, variant: int = 0) -> str:
+    """プロンプトの種類を判別し、本番と同じ形式の定型応答を返す（variant ごとに内容が変わる）"""
+    rng = _rng_for(prompt, str(variant)) if variant else _rng_for(prompt)
+
+    if "インタビュー対象者を作成" in prompt:
+        count_match = re.search(r'(\d+)人のインタビュー対象者', prompt)
+        count = int(count_match.group(1)) if count_match else 5
+        blocks = []
+        for i in range(count):
+            blocks.append("\n".join([
+                f"インタビュー対象者{i + 1}: {rng.choice(_LAST_NAMES)} {rng.choice(_FIRST_NAMES)}",
+                f"年齢: {rng.randint(22, 65)}歳",
+                f"性別: {rng.choice(['女性', '男性'])}",
+                f"職業: {rng.choice(_OCCUPATIONS)}",
+                f"年収帯: {rng.choice(['300-400万円', '400-600万円', '600-800万円', '800万円以上'])}",
+                f"居住地: {rng.choice(_REGIONS)}",
+                f"家族構成: {rng.choice(_FAMILIES)}",
+                f"趣味・余暇: {rng.choice(_HOBBIES)}",
+                f"関心事・悩み: {rng.choice(_CONCERNS)}",
+            ]))
+        return "\n\n".join(blocks)
+
+    if "質問リストを20個作成" in prompt:
+        questions = rng.sample(_QUESTIONS, len(_QUESTIONS))
+        return "\n".join(f"{i + 1}. {q}" for i, q in enumerate(questions))
+
+    if "追加インタビュー質問" in prompt:
+        questions = rng.sample(_QUESTIONS[6:], 5)
+        return "インタビュー結果を踏まえ、以下を追加で確認します。\n\n追加インタビュー質問:\n" + \
+            "\n".join(f"- {q}" for q in questions)
+
+    if "【主な発見】" in prompt:
+        return "【主な発見】\n" + _sentences(rng, _ANALYSIS_SENTENCES, 3) + \
+            "\n\n【主な示唆】\n" + _sentences(rng, _ANALYSIS_SENTENCES, 3)
+
+    if "1つの" in prompt and "質問を作成" in prompt:
+        return rng.choice([
+            "その点について、もう少し詳しく教えていただけますか？",
+            "そう感じたきっかけについて、具体的に教えていただけますか？",
+            "その場面で、どのようなお気持ちになりましたか？",
+        ])
+
+    headings = _HEADING_PATTERN.findall(prompt)
+    if headings:
+        sections = []
+        for hashes, number, title in headings:
+            sections.append(f"{hashes} {number}. {title}\n{_sentences(rng, _ANALYSIS_SENTENCES, 2)}")
+        return "\n\n".join(sections)
+
+    return _sentences(rng, _ANALYSIS_SENTENCES, 3)
+
+
+# JSON モードで項目名から値を作る（ペルソナ生成のスキーマの項目名に対応）
+_STRUCTURED_FIELDS = {
+    "name": lambda rng: f"{rng.choice(_LAST_NAMES)} {rng.choice(_FIRST_NAMES)}",
+    "age": lambda rng: f"{rng.randint(22, 65)}歳",
+    "gender": lambda rng: rng.choice(["女性", "男性"]),
+    "occupation": lambda rng: rng.choice(_OCCUPATIONS),
+    "income": lambda rng: rng.choice(["300-400万円", "400-600万円", "600-800万円", "800万円以上"]),
+    "residence": lambda rng: rng.choice(_REGIONS),
+    "family": lambda rng: rng.choice(_FAMILIES),
+    "hobbies": lambda rng: rng.choice(_HOBBIES),
+    "concerns": lambda rng: rng.choice(_CONCERNS),
+    "answer": lambda rng: _sentences(rng, _ANSWER_SENTENCES, rng.randint(2, 3)),
+}
+
+
+def structured_response(prompt: str, schema: Dict, variant: int = 0) -> str:
+    """JSON モードの応答（スキーマの型と項目名に合わせた値を入れる）"""
+    tasks = unpack_prompt(prompt)
+    if tasks:
+        return json.dumps({"results": [_packed_result(task_id, task_prompt, schema, variant)
+                                       for task_id, task_prompt in tasks]}, ensure_ascii=False)
+    rng = _rng_for(prompt, "json", str(variant))
+    count_match = re.search(r'(\d+)人のインタビュー対象者', prompt)
+    # 質問票（「Q1: ...」の行）には質問ごとに、質問番号を付けて答える
+    numbers = [int(number) for number in re.findall(r'^Q(\d+):', prompt, re.MULTILINE)]
+    default_count = int(count_match.group(1)) if count_match else len(numbers) or 5
+    value = _structured_value(schema, "", rng, default_count)
+    if numbers:
+        _number_items(value, numbers)
+    return json.dumps(value, ensure_ascii=False)
+
+
+def _number_items(value, numbers: List[int]) -> None:
+    """配列の要素の number 項目に質問番号を順に入れる"""
+    if isinstance(value, dict):
+        for item in value.values():
+            _number_items(item, numbers)
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            if isinstance(item, dict) and "number" in item:
+                item["number"] = numbers[index] if index < len(numbers) else index + 1
+
+
+def _packed_result(task_id: str, prompt: str, schema: Dict, variant: int) -> Dict:
+    item_properties = schema.get("properties", {}).get("results", {}).get("items", {}).get("properties", {})
+    if "result" in item_properties:
+        return {"id": task_id, "result": json.loads(structured_response(prompt, item_properties["result"], variant))}
+    return {"id": task_id, "text": canned_response(prompt, variant)}
+
+
+def _structured_value(schema: Dict, name: str, rng: random.Random, default_count: int):
+    schema_type = str(schema.get("type", "string")).lower()
+    if schema_type == "object":
+        return {key: _structured_value(value, key, rng, default_count)
+                for key, value in schema.get("properties", {}).items()}
+    if schema_type == "array":
+        count = max(schema.get("min_items", 0), min(schema.get("max_items", default_count), default_count))
+        return [_structured_value(schema.get("items", {}), name, rng, default_count) for _ in range(count)]
+    if schema_type == "integer":
+        return rng.randint(1, 5)
+    if schema_type == "number":
+        return round(rng.random(), 2)
+    if schema_type == "boolean":
+        return rng.random() < 0.5
+    if schema.get("enum"):
+        return rng.choice(schema["enum"])
+    if name in _STRUCTURED_FIELDS:
+        return _STRUCTURED_FIELDS[name](rng)
+    if "question" in name:
+        return rng.choice(_QUESTIONS)
+    return _sentences(rng, _ANALYSIS_SENTENCES, 2)
+
+
+class SimulatedProvider(LLMProvider):
+    """API を呼ばずに、設定したレイテンシとエラー率で定型応答を返すプロバイダー"""
+
+    name = "simulator"
+
+    def __init__(self, latency_median: float = 0.8, latency_sigma: float = 0.5,
+                 latency_distribution: str = "lognormal", seconds_per_token: float = 0.002,
+                 error_rate: float = 0.0, seed: Optional[int] = None, quota_rpm: float = 0,
+                 context_cache: Optional[ContextCacheStore] = None, malformed_rate: float = 0.0,
+                 capacity: int = 0):
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.latency_distribution = latency_distribution
+        self.seconds_per_token = seconds_per_token
+        self.error_rate = error_rate
+        self.quota_rpm = quota_rpm  # 0 以下はクォータなし
+        self.malformed_rate = malformed_rate  # JSON モードで不完全な JSON を返す割合
+        self.capacity = capacity  # 同時に処理できる呼び出し数（0 以下は無制限）
+        self._in_flight = 0
+        self._recent_calls = deque()
+        # レイテンシとエラーの発生は応答内容とは別の乱数で決める
+        self._rng = random.Random(seed)
+        self.stats = {"calls": 0, "errors": 0, "quota_errors": 0, "malformed": 0, "over_capacity": 0}
+        self.context_cache = context_cache
+
+    async def _context_usage(self, model_name: str, context: Optional[ContextPrefix]) -> Usage:
+        """前置きの分の入力トークン（キャッシュを使えた場合はその分を cached_tokens にする）"""
+        if context is None:
+            return Usage(input_tokens=0, output_tokens=0)
+        cached = None
+        if self.context_cache is not None:
+            cached = await self.context_cache.get(context, model_name, self._create_cached_content(context))
+        return Usage(input_tokens=context.tokens, output_tokens=0,
+                     cached_tokens=context.tokens if cached is not None else 0)
+
+    def _create_cached_content(self, context: ContextPrefix):
+        async def create(ttl: float) -> str:
+            # キャッシュの作成にも通常の呼び出しと同程度の時間がかかるものとする
+            await asyncio.sleep(self.sample_latency())
+            return f"cachedContents/sim-{context.key[:12]}"
+        return create
+
+    def sample_latency(self) -> float:
+        """設定された分布から基本レイテンシ（秒）を 1 つ取り出す"""
+        if self.latency_distribution == "fixed":
+            return self.latency_median
+        if self.latency_distribution == "uniform":
+            spread = self.latency_median * self.latency_sigma
+            return max(0.0, self._rng.uniform(self.latency_median - spread, self.latency_median + spread))
+        return self.latency_median * math.exp(self.latency_sigma * self._rng.gauss(0, 1))
+
+    async def _simulate(self, output_tokens: int) -> None:
+        """レイテンシ分の待機と、エラー率に応じた例外の発生"""
+        with self._occupied():
+            await self._simulate_first_token()
+            await asyncio.sleep(output_tokens * self.seconds_per_token)
+
+    @contextmanager
+    def _occupied(self):
+        """処理中の呼び出しとして数える（容量の判定に使う）"""
+        self._in_flight += 1
+        try:
+            yield
+        finally:
+            self._in_flight -= 1
+
+    async def _simulate_first_token(self) -> None:
+        """最初のトークンが返るまでの待機（クォータ・エラー率の判定を含む）"""
+        self.stats["calls"] += 1
+        if self.quota_rpm > 0:
+            now = time.monotonic()
+            while self._recent_calls and now - self._recent_calls[0] > 60.0:
+                self._recent_calls.popleft()
+            if len(self._recent_calls) >= self.quota_rpm:
+                self.stats["quota_errors"] += 1
+                raise google_exceptions.ResourceExhausted("Quota exceeded for requests per minute. (simulated)")
+            self._recent_calls.append(now)
+        latency = self.sample_latency()
+        if self.capacity > 0 and self._in_flight > self.capacity:
+            self.stats["over_capacity"] += 1
+            await asyncio.sleep(latency / 2)
+            raise google_exceptions.ServiceUnavailable("The model is overloaded. (simulated)")
+        if self._rng.random() < self.error_rate:
+            self.stats["errors"] += 1
+            await asyncio.sleep(latency / 2)
+            if self._rng.random() < 0.8:
+                raise google_exceptions.ServiceUnavailable("The model is overloaded. (simulated)")
+            raise google_exceptions.ResourceExhausted("Resource has been exhausted. (simulated)")
+        await asyncio.sleep(latency)
+
+    async def generate(self, model_name: str, prompt: str, generation_config: Dict,
+                       context: Optional[ContextPrefix] = None) -> ProviderResponse:
+        # 応答の内容は前置きを含めたプロンプトで決める（キャッシュの有無で応答が変わらないようにする）
+        full_prompt = inline_prompt(prompt, context)
+        candidates = [self._response_text(full_prompt, generation_config, i)
+                      for i in range(_candidate_count(generation_config))]
+        context_usage = await self._context_usage(model_name, context)
+        return await self._respond(estimate_tokens(prompt), candidates, context_usage)
+
+    def _response_text(self, prompt: str, generation_config: Dict, variant: int = 0) -> str:
+        if not is_structured_config(generation_config):
+            return canned_response(prompt, variant)
+        text = structured_response(prompt, generation_config.get("response_schema") or {}, variant)
+        if self._rng.random() < self.malformed_rate:
+            self.stats["malformed"] += 1
+            return text[:len(text) // 2]
+        return text
+
+    async def _respond(self, input_tokens: int, candidates: List[str],
+                       context_usage: Optional[Usage] = None) -> ProviderResponse:
+        # 候補は並列に生成されるため、待機は最も長い候補の分だけ行い、出力トークンは全候補分を数える
+        usage = Usage(input_tokens=input_tokens, output_tokens=sum(estimate_tokens(c) for c in candidates))
+        if context_usage is not None:
+            usage.input_tokens += context_usage.input_tokens
+            usage.cached_tokens = context_usage.cached_tokens
+        await self._simulate(max(estimate_tokens(c) for c in candidates))
+        return ProviderResponse(text=candidates[0], usage=usage,
+                                candidates=candidates if len(candidates) > 1 else [])
+
+    async def stream_generate(self, model_name: str, prompt: str, generation_config: Dict,
+                              context: Optional[ContextPrefix] = None) -> AsyncIterator[ProviderResponse]:
+        text = self._response_text(inline_prompt(prompt, context), generation_config)
+        context_usage = await self._context_usage(model_name, context)
+        with self._occupied():
+            await self._simulate_first_token()
+            for i in range(0, len(text), STREAM_CHUNK_CHARS):
+                piece = text[i:i + STREAM_CHUNK_CHARS]
+                await asyncio.sleep(estimate_tokens(piece) * self.seconds_per_token)
+                yield ProviderResponse(text=piece)
+        yield ProviderResponse(text="", usage=Usage(
+            input_tokens=estimate_tokens(prompt) + context_usage.input_tokens,
+            output_tokens=estimate_tokens(text),
+            cached_tokens=context_usage.cached_tokens
+        ))
+
+    async def send_message(self, chat: LocalChat, message: str,
+                           generation_config: Optional[Dict] = None) -> ProviderResponse:
+        rng = _rng_for(str(len(chat.history)), message)
+        text = _sentences(rng, _ANSWER_SENTENCES, rng.randint(2, 3))
+        context_usage = await self._context_usage(chat.model_name, chat.context)
+        usage = Usage(
+            input_tokens=estimate_contents_tokens(chat.history) + estimate_tokens(message) + context_usage.input_tokens,
+            output_tokens=estimate_tokens(text),
+            cached_tokens=context_usage.cached_tokens
+        )
+        await self._simulate(usage.output_tokens)
+        chat.append_turn(message, text)
+        return ProviderResponse(text=text, usage=usage)
+
+    async def sample_message(self, chat: LocalChat, message: str,
+                             generation_config: Optional[Dict] = None) -> ProviderResponse:
+        candidates = []
+        for i in range(_candidate_count(generation_config)):
+            if is_structured_config(generation_config):
+                candidates.append(self._response_text(f"{len(chat.history)}\x00{message}", generation_config, i))
+                continue
+            # 先頭の候補は send_message と同じ回答になる
+            rng = _rng_for(str(len(chat.history)), message, *([str(i)] if i else []))
+            candidates.append(_sentences(rng, _ANSWER_SENTENCES, rng.randint(2, 3)))
+        context_usage = await self._context_usage(chat.model_name, chat.context)
+        return await self._respond(estimate_contents_tokens(chat.history) + estimate_tokens(message), candidates,
+                                   context_usage)
+
+
+def _candidate_count(generation_config: Optional[Dict]) -> int:
+    return max(1, int((generation_config or {}).get("candidate_count", 1)))
+
+
+def create_simulator_from_env() -> SimulatedProvider:
+    """環境変数 LLM_SIM_* からシミュレーターを作成する"""
+    seed = os.getenv("LLM_SIM_SEED")
+    return SimulatedProvider(
+        latency_median=float(os.getenv("LLM_SIM_LATENCY_MEDIAN", "0.8")),
+        latency_sigma=float(os.getenv("LLM_SIM_LATENCY_SIGMA", "0.5")),
+        latency_distribution=os.getenv("LLM_SIM_LATENCY_DISTRIBUTION", "lognormal"),
+        seconds_per_token=float(os.getenv("LLM_SIM_SECONDS_PER_TOKEN", "0.002")),
+        error_rate=float(os.getenv("LLM_SIM_ERROR_RATE", "0")),
+        seed=int(seed) if seed else None,
+        quota_rpm=float(os.getenv("LLM_SIM_QUOTA_RPM", "0")),
+        context_cache=create_context_cache_store_from_env(),
+        malformed_rate=float(os.getenv("LLM_SIM_MALFORMED_RATE", "0")),
+        capacity=int(os.getenv("LLM_SIM_CAPACITY", "0"))
+    )
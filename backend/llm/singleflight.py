@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+シングルフライト - 同一キーで同時に走る非同期処理を 1 回の実行にまとめる
+"""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from .context import without_deadline
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """実行中の処理と同じキーの呼び出しは、新たに実行せず結果を共有する"""
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._waiters: Dict[asyncio.Task, int] = {}
+        self.stats = {"executions": 0, "coalesced": 0, "abandoned": 0}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]],
+                 wait: Optional[Callable[[Awaitable[Any]], Awaitable[Any]]] = None) -> Tuple[Any, bool]:
+        """fn を実行して (結果, 他の呼び出しの結果を共有したか) を返す
+
+        実行はタスクとして切り離すため、待機側がキャンセルされても
+        他の待機者の分の処理は継続する。待機者が全員キャンセルされた場合は処理も取り消す。
+        実行は最初の呼び出し元の期限に縛られない。wait を渡すと各待機者はそれで待つ
+        （呼び出し元ごとの期限を適用するため）。
+        """
+        task = self._inflight.get(key)
+        shared = task is not None
+        if shared:
+            self.stats["coalesced"] += 1
+            logger.info(f"実行中の同一リクエストに合流しました: {key[:12]}")
+        else:
+            self.stats["executions"] += 1
+            # 合流した他の呼び出し元を最初の呼び出し元の期限で打ち切らないよう、期限を外して始める
+            with without_deadline():
+                task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            shielded = asyncio.shield(task)
+            return await (wait(shielded) if wait is not None else shielded), shared
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+                if not task.done():
+                    self.stats["abandoned"] += 1
+                    logger.info(f"待機者がいなくなったため実行中の処理を取り消します: {key[:12]}")
+                    task.cancel()
+
+    def get_stats(self) -> Dict:
+        """実行数・合流数と実行中のキー数を返す"""
+        return {**self.stats, "inflight": len(self._inflight)}
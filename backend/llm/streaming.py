@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+ストリーミング - 生成中のテキストと「### N.」の見出しを Server-Sent Events で送る
+
+ストリーミング用エンドポイントはリクエストごとに StreamSink を作り、bind_stream_sink() で
+現在のコンテキストに紐付けてから通常のエンドポイント処理を実行する。
+その間の LLM 呼び出しはトークン単位で sink にイベントを送る。
+"""
+
+import asyncio
+import json
+import re
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+_HEADING_PATTERN = re.compile(r'^\s*#{2,3}\s*(\d+)\.\s*(.+?)\s*$')
+
+_stream_sink: ContextVar[Optional["StreamSink"]] = ContextVar("llm_stream_sink", default=None)
+
+
+def sse_event(event: str, data: Dict) -> str:
+    """Server-Sent Events の 1 イベント分の文字列"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class SectionTracker:
+    """ストリームのテキストを行単位で見て、「### N. 見出し」の行を検出する"""
+
+    def __init__(self):
+        self._line = ""
+
+    def feed(self, text: str) -> List[Dict]:
+        """受け取ったテキストで完成した行のうち、見出しの行を返す"""
+        self._line += text
+        sections = []
+        while "\n" in self._line:
+            line, self._line = self._line.split("\n", 1)
+            sections.extend(self._match(line))
+        return sections
+
+    def flush(self) -> List[Dict]:
+        """最後の改行のない行を判定する"""
+        line, self._line = self._line, ""
+        return self._match(line)
+
+    @staticmethod
+    def _match(line: str) -> List[Dict]:
+        match = _HEADING_PATTERN.match(line)
+        if not match:
+            return []
+        return [{"number": int(match.group(1)), "title": match.group(2)}]
+
+
+class StreamSink:
+    """エンドポイント処理から SSE のレスポンスへイベントを渡すキュー"""
+
+    def __init__(self):
+        self._queue: asyncio.Queue = asyncio.Queue()
+
+    def emit(self, event: str, data: Dict) -> None:
+        self._queue.put_nowait((event, data))
+
+    async def next_event(self):
+        return await self._queue.get()
+
+    def empty(self) -> bool:
+        return self._queue.empty()
+
+
+def get_stream_sink() -> Optional[StreamSink]:
+    return _stream_sink.get()
+
+
+@contextmanager
+def bind_stream_sink(sink: StreamSink):
+    """このコンテキストで行う LLM 呼び出しのイベント送信先を設定する"""
+    token = _stream_sink.set(sink)
+    try:
+        yield sink
+    finally:
+        _stream_sink.reset(token)
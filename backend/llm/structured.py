@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+構造化出力 - タスクごとのスキーマで JSON を生成させ、Pydantic で検証する
+
+自由形式のテキストを正規表現で解析する代わりに、生成設定で JSON モード
+（response_mime_type="application/json"）とレスポンススキーマを指定する。
+検証に失敗した場合は、エラー内容と元の出力を渡して 1 回だけ修正を依頼する（LLMGateway.generate_structured）。
+"""
+
+import json
+import re
+from typing import Dict, Optional, Type, TypeVar
+
+from pydantic import BaseModel, ValidationError
+
+JSON_MIME_TYPE = "application/json"
+
+# 修正依頼に含める検証エラーの件数の上限
+MAX_REPORTED_ERRORS = 10
+
+# Gemini のレスポンススキーマで使える項目（JSON Schema の名前 -> Schema の名前）
+_SCHEMA_KEYS = {
+    "type": "type",
+    "format": "format",
+    "description": "description",
+    "enum": "enum",
+    "nullable": "nullable",
+    "minItems": "min_items",
+    "maxItems": "max_items",
+    "required": "required",
+}
+
+_CODE_FENCE = re.compile(r"^\s*```(?:json)?\s*\n?(.*?)\n?\s*```\s*$", re.DOTALL)
+
+T = TypeVar("T", bound=BaseModel)
+
+
+def response_schema(model: Type[BaseModel]) -> Dict:
+    """Pydantic モデルから Gemini の response_schema に渡せる dict を作る
+
+    生成設定はキャッシュキーやカセットに JSON として保存するため、クラスではなく dict で渡す。
+    $ref は展開し、title / default など Gemini が受け付けない項目は除く。
+    """
+    schema = model.model_json_schema()
+    return _convert(schema, schema.get("$defs", {}))
+
+
+def _convert(schema: Dict, defs: Dict) -> Dict:
+    if "$ref" in schema:
+        return _convert(defs[schema["$ref"].split("/")[-1]], defs)
+    if "anyOf" in schema:
+        # Optional[X] は X の nullable として表す
+        options = [option for option in schema["anyOf"] if option.get("type") != "null"]
+        converted = _convert(options[0], defs)
+        if len(options) < len(schema["anyOf"]):
+            converted["nullable"] = True
+        return converted
+
+    converted = {_SCHEMA_KEYS[key]: value for key, value in schema.items() if key in _SCHEMA_KEYS}
+    if "properties" in schema:
+        converted["properties"] = {name: _convert(value, defs) for name, value in schema["properties"].items()}
+    if "items" in schema:
+        converted["items"] = _convert(schema["items"], defs)
+    return converted
+
+
+def json_generation_config(model: Type[BaseModel]) -> Dict:
+    """JSON モードで生成するための生成設定の追加分"""
+    return {"response_mime_type": JSON_MIME_TYPE, "response_schema": response_schema(model)}
+
+
+def parse_structured(text: str, model: Type[T]) -> T:
+    """生成されたテキストを JSON として読み、スキーマで検証する
+
+    JSON モードでもコードブロックで囲まれて返ることがあるため、囲みは取り除く。
+    JSON として読めない場合は ValueError、スキーマに合わない場合は ValidationError になる。
+    """
+    return model.model_validate_json(strip_code_fence(text))
+
+
+def strip_code_fence(text: str) -> str:
+    """```json ... ``` の囲みを取り除く"""
+    fenced = _CODE_FENCE.match(text)
+    return (fenced.group(1) if fenced else text).strip()
+
+
+def describe_error(error: Exception) -> str:
+    """修正依頼に含める検証エラーの説明"""
+    if isinstance(error, ValidationError):
+        lines = []
+        for detail in error.errors()[:MAX_REPORTED_ERRORS]:
+            location = ".".join(str(part) for part in detail["loc"]) or "(ルート)"
+            lines.append(f"- {location}: {detail['msg']}")
+        return "\n".join(lines)
+    return f"- JSON として読み込めません: {error}"
+
+
+def repair_prompt(text: str, error: Exception, model: Type[BaseModel]) -> str:
+    """検証に失敗した出力の修正を依頼するプロンプト
+
+    元のプロンプトは再送せず、問題のある出力とエラー箇所だけを渡す。
+    """
+    schema = json.dumps(response_schema(model), ensure_ascii=False)
+    return f"""
+    以下の JSON は指定したスキーマに適合しませんでした。
+    内容はできるだけそのまま残し、エラーの箇所だけを修正した JSON のみを出力してください。
+
+    スキーマ:
+    {schema}
+
+    エラー:
+    {describe_error(error)}
+
+    修正前の出力:
+    {text}
+    """
+
+
+def is_structured_config(generation_config: Optional[Dict]) -> bool:
+    """JSON モードの生成設定かどうか"""
+    return (generation_config or {}).get("response_mime_type") == JSON_MIME_TYPE
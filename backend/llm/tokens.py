@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""
+トークン数の概算
+
+API を呼ぶ前に使う見積もり。英数字はおよそ 4 文字で 1 トークン、
+日本語などの非 ASCII 文字はおよそ 1 文字 1 トークンとして数える。
+"""
+
+import math
+
+
+def estimate_tokens(text: str) -> int:
+    """テキストのトークン数を概算する"""
+    if not text:
+        return 0
+    ascii_count = sum(1 for ch in text if ord(ch) < 128)
+    return math.ceil(ascii_count / 4 + (len(text) - ascii_count))
+
+
+def estimate_contents_tokens(contents) -> int:
+    """チャット履歴（dict または protos.Content のリスト）のトークン数を概算する"""
+    total = 0
+    for content in contents or []:
+        parts = content.get("parts", []) if isinstance(content, dict) else content.parts
+        for part in parts:
+            text = part if isinstance(part, str) else getattr(part, "text", "")
+            total += estimate_tokens(text)
+    return total
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+トレーシング - HTTP リクエストと LLM 呼び出しをスパンとして記録する
+
+- HTTP リクエストごとのスパンの下に、LLM 呼び出し（llm.generate / llm.stream / llm.chat など）と
+  その試行（llm.attempt: レート制限・同時実行数の待機、リトライ・ヘッジの 1 回分）のスパンを入れ子で記録する
+- 各スパンにはエンドポイント・セッション・ペルソナ・テンプレート・モデル・トークン数・待機時間・
+  リトライ回数・所要時間を属性として持たせる
+- 直近のスパンはメモリに保持してデバッグ用エンドポイントから参照でき、JSONL ファイルと
+  OTLP/HTTP（JSON）のコレクターにも書き出せる
+"""
+
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, List, Optional
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = "marketing-interview-app"
+
+_current_span: ContextVar[Optional["Span"]] = ContextVar("llm_current_span", default=None)
+
+
+class Span:
+    """1 つの処理の開始・終了時刻と属性"""
+
+    def __init__(self, name: str, trace_id: str, parent: Optional["Span"] = None,
+                 attributes: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes: Dict[str, Any] = {k: v for k, v in (attributes or {}).items() if v is not None}
+        self.children: List["Span"] = []
+        self.start_time = time.time()
+        self.end_time: Optional[float] = None
+        self.status = "ok"
+        self.error: Optional[str] = None
+        self._started = time.monotonic()
+
+    def set(self, **attributes) -> None:
+        """属性を設定する（None の値は設定しない）"""
+        self.attributes.update({k: v for k, v in attributes.items() if v is not None})
+
+    def add(self, key: str, amount: float) -> None:
+        """数値の属性に加算する"""
+        self.attributes[key] = self.attributes.get(key, 0) + amount
+
+    def sum_children(self, key: str, name: Optional[str] = None) -> float:
+        """子スパン（name を指定すればその名前のもの）の属性の合計"""
+        return sum(child.attributes.get(key, 0) for child in self.children if name is None or child.name == name)
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        self.end_time = time.time()
+        self.attributes["duration_seconds"] = round(time.monotonic() - self._started, 4)
+        if error is not None:
+            self.status = "error"
+            self.error = f"{type(error).__name__}: {error}" if str(error) else type(error).__name__
+
+    def to_dict(self) -> Dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "status": self.status,
+            "error": self.error,
+            "attributes": dict(self.attributes),
+        }
+
+
+def current_span() -> Optional[Span]:
+    """現在のスパンを返す（トレース中でなければ None）"""
+    return _current_span.get()
+
+
+class JsonlSpanExporter:
+    """終了したスパンを 1 行 1 スパンの JSON でファイルに追記する"""
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        line = json.dumps(span.to_dict(), ensure_ascii=False)
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+    def close(self) -> None:
+        pass
+
+
+class OtlpSpanExporter:
+    """終了したスパンを OTLP/HTTP（JSON）でコレクターに送る
+
+    送信は別スレッドでまとめて行い、コレクターに接続できなくても呼び出し側を待たせない。
+    """
+
+    def __init__(self, endpoint: str, batch_size: int = 100, interval_seconds: float = 2.0,
+                 timeout: float = 5.0):
+        self.endpoint = endpoint
+        self.batch_size = batch_size
+        self.interval_seconds = interval_seconds
+        self.timeout = timeout
+        self._queue: "queue.Queue[Optional[Span]]" = queue.Queue(maxsize=10000)
+        self.stats = {"exported": 0, "dropped": 0, "errors": 0}
+        self._thread = threading.Thread(target=self._run, name="otlp-span-exporter", daemon=True)
+        self._thread.start()
+
+    def export(self, span: Span) -> None:
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.stats["dropped"] += 1
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join(timeout=self.timeout)
+
+    def _run(self) -> None:
+        while True:
+            batch: List[Span] = []
+            deadline = time.monotonic() + self.interval_seconds
+            closing = False
+            while len(batch) < self.batch_size:
+                try:
+                    span = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if span is None:
+                    closing = True
+                    break
+                batch.append(span)
+            if batch:
+                self._send(batch)
+            if closing:
+                return
+
+    def _send(self, spans: List[Span]) -> None:
+        try:
+            response = requests.post(self.endpoint, json=otlp_payload(spans), timeout=self.timeout)
+            response.raise_for_status()
+            self.stats["exported"] += len(spans)
+        except Exception as e:
+            self.stats["errors"] += 1
+            self.stats["dropped"] += len(spans)
+            logger.warning(f"トレースをコレクターに送信できませんでした（{self.endpoint}）: {e}")
+
+
+def otlp_payload(spans: List[Span]) -> Dict:
+    """スパンを OTLP/HTTP の JSON（ExportTraceServiceRequest）にする"""
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [_otlp_attribute("service.name", SERVICE_NAME)]},
+            "scopeSpans": [{
+                "scope": {"name": "llm"},
+                "spans": [_otlp_span(span) for span in spans],
+            }],
+        }]
+    }
+
+
+def _otlp_span(span: Span) -> Dict:
+    data = {
+        "traceId": span.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        # HTTP リクエストのスパンは SERVER、それ以外は INTERNAL
+        "kind": 2 if span.parent_id is None else 1,
+        "startTimeUnixNano": str(int(span.start_time * 1e9)),
+        "endTimeUnixNano": str(int((span.end_time or span.start_time) * 1e9)),
+        "attributes": [_otlp_attribute(key, value) for key, value in span.attributes.items()],
+        "status": {"code": 2, "message": span.error or ""} if span.status == "error" else {"code": 1},
+    }
+    if span.parent_id is not None:
+        data["parentSpanId"] = span.parent_id
+    return data
+
+
+def _otlp_attribute(key: str, value: Any) -> Dict:
+    if isinstance(value, bool):
+        typed = {"boolValue": value}
+    elif isinstance(value, int):
+        typed = {"intValue": str(value)}
+    elif isinstance(value, float):
+        typed = {"doubleValue": value}
+    else:
+        typed = {"stringValue": str(value)}
+    return {"key": key, "value": typed}
+
+
+class Tracer:
+    """スパンを作成し、直近のスパンを保持・書き出す"""
+
+    def __init__(self, enabled: bool = True, max_spans: int = 5000, exporters: Optional[List] = None):
+        self.enabled = enabled
+        self.exporters = exporters or []
+        self._spans: Deque[Span] = deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+        self.stats = {"spans": 0, "errors": 0, "export_errors": 0}
+
+    def start_span(self, name: str, attributes: Optional[Dict[str, Any]] = None,
+                   parent: Optional[Span] = None) -> Span:
+        """スパンを開始する（現在のスパンには設定しない）
+
+        parent を省略すると現在のスパンの子、現在のスパンもなければ新しいトレースにする。
+        非同期ジェネレーターのように yield をまたぐ処理は、コンテキストを汚さないようこちらを使う。
+        """
+        if not self.enabled:
+            return Span(name, "", attributes=attributes)
+        parent = parent or _current_span.get()
+        span = Span(name, parent.trace_id if parent is not None else uuid.uuid4().hex,
+                    parent=parent, attributes=attributes)
+        if parent is not None:
+            parent.children.append(span)
+        return span
+
+    def end_span(self, span: Span, error: Optional[BaseException] = None) -> None:
+        """スパンを終了して記録する"""
+        span.finish(error)
+        if self.enabled:
+            self._record(span)
+
+    @contextmanager
+    def span(self, name: str, attributes: Optional[Dict[str, Any]] = None, parent: Optional[Span] = None):
+        """with ブロックをスパンとして記録し、ブロック内では現在のスパンにする"""
+        span = self.start_span(name, attributes, parent)
+        token = _current_span.set(span)
+        error = None
+        try:
+            yield span
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            _current_span.reset(token)
+            self.end_span(span, error)
+
+    def _record(self, span: Span) -> None:
+        with self._lock:
+            self._spans.append(span)
+            self.stats["spans"] += 1
+            if span.status == "error":
+                self.stats["errors"] += 1
+        for exporter in self.exporters:
+            try:
+                exporter.export(span)
+            except Exception as e:
+                self.stats["export_errors"] += 1
+                logger.warning(f"スパンを書き出せませんでした: {e}")
+
+    def spans(self, limit: int = 100, trace_id: Optional[str] = None, **filters) -> List[Dict]:
+        """新しい順にスパンを返す（filters は属性の値で絞り込む）"""
+        with self._lock:
+            spans = list(self._spans)
+        matched = [
+            span.to_dict() for span in reversed(spans)
+            if (trace_id is None or span.trace_id == trace_id)
+            and all(span.attributes.get(key) == value for key, value in filters.items() if value is not None)
+        ]
+        return matched[:limit]
+
+    def traces(self, limit: int = 20, **filters) -> List[Dict]:
+        """新しい順にトレース（ルートのスパンと入れ子の子スパン）を返す"""
+        with self._lock:
+            spans = list(self._spans)
+        roots = [span for span in reversed(spans) if span.parent_id is None
+                 and all(span.attributes.get(key) == value for key, value in filters.items() if value is not None)]
+        return [self._tree(root) for root in roots[:limit]]
+
+    def trace(self, trace_id: str) -> Optional[Dict]:
+        """trace_id のトレースを返す（保持していなければ None）
+
+        ルートのスパンがまだ終わっていない（ストリーミング中など）場合は、終了した最上位のスパンを並べる。
+        """
+        with self._lock:
+            spans = [span for span in self._spans if span.trace_id == trace_id]
+        if not spans:
+            return None
+        ids = {span.span_id for span in spans}
+        tops = [self._tree(span) for span in spans if span.parent_id not in ids]
+        return tops[0] if len(tops) == 1 else {"trace_id": trace_id, "children": tops}
+
+    def _tree(self, span: Span) -> Dict:
+        return {**span.to_dict(), "children": [self._tree(child) for child in span.children
+                                               if child.end_time is not None]}
+
+    def get_stats(self) -> Dict:
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "retained": len(self._spans),
+            "exporters": [type(exporter).__name__ for exporter in self.exporters],
+        }
+
+
+def create_tracer_from_env() -> Tracer:
+    """環境変数 LLM_TRACE_* からトレーサーを作成する
+
+    LLM_TRACE_JSONL_PATH を指定すると JSONL に、LLM_TRACE_OTLP_ENDPOINT
+    （例: http://localhost:4318/v1/traces）を指定すると OTLP のコレクターにも書き出す。
+    """
+    exporters = []
+    jsonl_path = os.getenv("LLM_TRACE_JSONL_PATH")
+    if jsonl_path:
+        exporters.append(JsonlSpanExporter(jsonl_path))
+    otlp_endpoint = os.getenv("LLM_TRACE_OTLP_ENDPOINT")
+    if otlp_endpoint:
+        exporters.append(OtlpSpanExporter(otlp_endpoint))
+    return Tracer(
+        enabled=os.getenv("LLM_TRACE_ENABLED", "true").lower() not in ("0", "false", "no"),
+        max_spans=int(os.getenv("LLM_TRACE_MAX_SPANS", "5000")),
+        exporters=exporters
+    )
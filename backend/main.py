@@ -3,12 +3,14 @@
 マーケティングインタビューシステム - FastAPI バックエンド
 """
 
-from fastapi import FastAPI, HTTPException, UploadFile, File
+from fastapi import FastAPI, HTTPException, UploadFile, File, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
 from typing import List, Dict, Optional
-import google.generativeai as genai
 import textwrap
+import asyncio
 import re
 import time
 import os
@@ -19,6 +21,40 @@ import json
 from datetime import datetime
 import uuid
 
+from llm import (
+    CostLedger,
+    DeadlineExceededError,
+    GenerationResult,
+    LLMError,
+    LLMGateway,
+    LLMOverloadedError,
+    Priority,
+    StructuredOutputError,
+    SectionTracker,
+    StreamSink,
+    bind_stream_sink,
+    call_context,
+    create_budgeter_from_env,
+    create_cache_from_env,
+    create_compactor_from_env,
+    create_concurrency_from_env,
+    create_hedge_policy_from_env,
+    create_packer_from_env,
+    create_profile_registry_from_env,
+    create_provider_from_env,
+    create_scheduler_from_env,
+    create_tracer_from_env,
+    format_interview,
+    get_call_context,
+    get_remaining_time,
+    get_stream_sink,
+    make_context_prefix,
+    request_deadline,
+    score_candidates,
+    sse_event,
+)
+from jobs import add_job_progress, create_job_queue_from_env, update_job_progress
+
 # 環境変数を読み込み
 load_dotenv()
 # プロジェクトルートの.envファイルも読み込み
@@ -48,18 +84,10 @@ app.add_middleware(
     expose_headers=["*"],  # レスポンスヘッダーの公開を許可
 )
 
-# --- APIキーの設定 ---
-try:
-    api_key = os.getenv('GOOGLE_API_KEY')
-    if not api_key:
-        raise ValueError("環境変数 'GOOGLE_API_KEY' が設定されていません。")
-    genai.configure(api_key=api_key)
-except ValueError as e:
-    logger.error(f"エラー: {e}")
-
 # --- 料金計算のための定数 ---
 INPUT_TOKEN_PRICE = 0.0000007 / 1000
 OUTPUT_TOKEN_PRICE = 0.0000021 / 1000
+CACHED_INPUT_TOKEN_PRICE = INPUT_TOKEN_PRICE * 0.25  # コンテキストキャッシュから読まれた入力トークン
 
 # --- データモデル ---
 class ProductService(BaseModel):
@@ -93,6 +121,23 @@ class InterviewRequest(BaseModel):
     persona_index: int
     questions: List[str]
     is_hypothesis_phase: bool = False
+    candidate_count: int = 1  # 2以上でメイン質問の回答を複数候補から選び、回答のばらつきを返す
+    fused_follow_up: Optional[bool] = None  # 回答と更問を1回の呼び出しで生成する（省略時は INTERVIEW_FUSED_FOLLOW_UP）
+    questionnaire: Optional[bool] = None  # 全質問を1回で送り、まとめて回答させる（省略時は INTERVIEW_QUESTIONNAIRE）
+    questionnaire_follow_ups: bool = True  # 質問票形式で、全回答への更問をもう1回まとめて行う
+
+class BatchInterviewRequest(BaseModel):
+    questions: List[str]
+    persona_indices: Optional[List[int]] = None  # 省略時は選択された全ペルソナ
+    candidate_count: int = 1
+    fused_follow_up: Optional[bool] = None
+    questionnaire: Optional[bool] = None
+    questionnaire_follow_ups: bool = True
+
+class AnswerSamplingRequest(BaseModel):
+    persona_index: int
+    question: str
+    candidate_count: int = 5
 
 class QuestionUploadRequest(BaseModel):
     questions: List[str]
@@ -114,6 +159,52 @@ class InterviewSession(BaseModel):
 class AnalysisTypeRequest(BaseModel):
     analysis_types: List[str]  # ["target_analysis", "improvement_analysis"] の組み合わせ
 
+# --- 構造化出力のスキーマ（JSONモードで生成し、Pydanticで検証する） ---
+class PersonaProfile(BaseModel):
+    name: str = Field(description="具体的で現実的な名前（姓 名）")
+    age: str = Field(description="年齢（例: 34歳）")
+    gender: str = Field(description="性別")
+    occupation: str = Field(description="職業")
+    income: str = Field(description="年収帯（例: 400-600万円）")
+    residence: str = Field(description="居住地")
+    family: str = Field(description="家族構成")
+    hobbies: str = Field(description="趣味・余暇の過ごし方")
+    concerns: str = Field(description="関心事・主な悩み")
+
+class PersonaListOutput(BaseModel):
+    personas: List[PersonaProfile] = Field(min_length=1)
+
+class AdditionalQuestionsOutput(BaseModel):
+    additional_questions: List[str] = Field(min_length=1, description="追加インタビュー質問（1要素に1つの質問文）")
+
+class InterviewSummaryOutput(BaseModel):
+    main_findings: str = Field(description="主な発見（4-5行）")
+    main_implications: str = Field(description="主な示唆（4-5行）")
+
+class FusedAnswerOutput(BaseModel):
+    answer: str = Field(description="ペルソナとしての質問への回答（2-3文）")
+    follow_up_question: str = Field(description="インタビュアーとして直前の回答をさらに深掘りする1つの質問")
+
+class QuestionnaireAnswer(BaseModel):
+    number: int = Field(description="質問番号（Q1 なら 1）")
+    answer: str = Field(description="ペルソナとしての質問への回答（2-3文）")
+
+class QuestionnaireFusedAnswer(QuestionnaireAnswer):
+    follow_up_question: str = Field(description="インタビュアーとしてこの回答をさらに深掘りする1つの質問")
+
+class QuestionnaireOutput(BaseModel):
+    answers: List[QuestionnaireAnswer] = Field(min_length=1, description="質問ごとの回答（質問の順）")
+
+class QuestionnaireFusedOutput(BaseModel):
+    answers: List[QuestionnaireFusedAnswer] = Field(min_length=1, description="質問ごとの回答と更問（質問の順）")
+
+class QuestionnaireFollowUp(BaseModel):
+    number: int = Field(description="深掘りする回答の質問番号（Q1 なら 1）")
+    question: str = Field(description="その回答をさらに深掘りする1つの質問")
+
+class QuestionnaireFollowUpsOutput(BaseModel):
+    follow_up_questions: List[QuestionnaireFollowUp] = Field(min_length=1, description="回答ごとの更問")
+
 class HistoryRecord(BaseModel):
     id: str
     timestamp: datetime
@@ -125,6 +216,7 @@ class HistoryRecord(BaseModel):
 
 # --- グローバル変数 ---
 current_session = {
+    "session_id": str(uuid.uuid4()),  # レート制限の公平性などでセッションを識別するためのID
     "personas": [],
     "selected_personas": [],
     "interview_sessions": {},
@@ -139,53 +231,389 @@ current_session = {
 # 履歴保存用（実際のプロダクションではデータベースを使用）
 interview_history = []
 
+# LLM 呼び出しの共通ゲートウェイ（同一プロンプトの結果は永続キャッシュから返す）
+# プロバイダーは LLM_PROVIDER で切り替え（gemini / simulator）、APIキーは GOOGLE_API_KEY から読み込む
+llm_gateway = LLMGateway(
+    provider=create_provider_from_env(),
+    cache=create_cache_from_env(),
+    scheduler=create_scheduler_from_env(),
+    ledger=CostLedger(INPUT_TOKEN_PRICE, OUTPUT_TOKEN_PRICE, cached_token_price=CACHED_INPUT_TOKEN_PRICE),
+    hedging=create_hedge_policy_from_env(),
+    profiles=create_profile_registry_from_env(),
+    packer=create_packer_from_env(),
+    concurrency=create_concurrency_from_env(),
+    tracer=create_tracer_from_env(),
+    compactor=create_compactor_from_env()
+)
+
+# 時間のかかるインタビュー・分析をリクエストから切り離して実行するジョブキュー（結果は SQLite に保存）
+job_queue = create_job_queue_from_env()
+
+# 分析・要約プロンプトに埋め込むインタビュー内容のトークン予算
+interview_budgeter = create_budgeter_from_env()
+
+# ペルソナ・追加質問・インタビューサマリをJSONモードで生成する（false で従来のテキスト解析）
+STRUCTURED_OUTPUT_ENABLED = os.getenv("LLM_STRUCTURED_OUTPUT", "true").lower() not in ("0", "false", "no")
+
+# インタビューで、メイン質問の回答と更問を1回の呼び出しで生成する（リクエストの fused_follow_up で個別に切り替え可能）
+INTERVIEW_FUSED_FOLLOW_UP = os.getenv("INTERVIEW_FUSED_FOLLOW_UP", "false").lower() not in ("0", "false", "no")
+
+# インタビューで、全質問を番号付きの質問票として1回で送り、質問ごとの回答を構造化出力で受け取る
+# （リクエストの questionnaire で個別に切り替え可能）
+INTERVIEW_QUESTIONNAIRE = os.getenv("INTERVIEW_QUESTIONNAIRE", "false").lower() not in ("0", "false", "no")
+
+# リクエストの期限（秒）。フロントエンドのaxiosのタイムアウト（300秒）より前に部分結果を返す
+# X-Request-Timeout ヘッダーで短くできる（既定値より長くはしない）
+DEFAULT_REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE_SECONDS", "280"))
+ENDPOINT_REQUEST_DEADLINES = {
+    "/api/conduct-interview": float(os.getenv("INTERVIEW_DEADLINE_SECONDS", "240")),
+    "/api/conduct-hypothesis-interview": float(os.getenv("INTERVIEW_DEADLINE_SECONDS", "240")),
+    "/api/conduct-interviews": float(os.getenv("INTERVIEW_DEADLINE_SECONDS", "240")),
+    "/api/conduct-hypothesis-interviews": float(os.getenv("INTERVIEW_DEADLINE_SECONDS", "240")),
+}
+
+def resolve_request_deadline(request: Request):
+    """リクエストの期限（秒）を決める（0以下の設定は期限なし）"""
+    deadline = ENDPOINT_REQUEST_DEADLINES.get(request.url.path, DEFAULT_REQUEST_DEADLINE)
+    header = request.headers.get("X-Request-Timeout")
+    if header:
+        try:
+            requested = float(header)
+            if requested > 0:
+                deadline = min(deadline, requested) if deadline > 0 else requested
+        except ValueError:
+            logger.warning(f"X-Request-Timeout ヘッダーの値が不正です: {header}")
+    return deadline if deadline > 0 else None
+
+def deadline_exceeded():
+    """リクエストの期限を過ぎているかどうか"""
+    remaining = get_remaining_time()
+    return remaining is not None and remaining <= 0
+
+# トレースを記録しないパス（トレースの参照やジョブの状態のポーリングでバッファを埋めないため）
+# ジョブ自体はワーカーで実行するときに専用のトレースを記録する
+UNTRACED_PATH_PREFIXES = ("/api/llm-traces", "/api/jobs")
+
+@app.middleware("http")
+async def bind_llm_call_context(request: Request, call_next):
+    """リクエスト内のLLM呼び出しにセッションID・エンドポイント・期限を紐付けるミドルウェア
+    
+    リクエストごとにトレースのスパンを作り、リクエスト内のLLM呼び出しのスパンをその下に記録する
+    （ストリーミングのレスポンスは送信完了より先にリクエストのスパンが終わる）
+    """
+    session_id = request.headers.get("X-Session-ID") or current_session["session_id"]
+    path = request.url.path
+    with call_context(session_id=session_id, endpoint=path), \
+            request_deadline(resolve_request_deadline(request)):
+        if path.startswith(UNTRACED_PATH_PREFIXES):
+            return await call_next(request)
+        with llm_gateway.tracer.span(f"{request.method} {path}",
+                                     {"endpoint": path, "session_id": session_id, "method": request.method}) as span:
+            response = await call_next(request)
+            span.set(status_code=response.status_code)
+            response.headers["X-Trace-ID"] = span.trace_id
+            return response
+
+class CancelOnDisconnectMiddleware:
+    """クライアントが切断したらリクエストの処理を取り消すASGIミドルウェア
+    
+    リクエストの受信はこのミドルウェアが代わりに行い、切断を検知した時点で処理中のタスクを
+    キャンセルする。これにより実行中・待機中のLLM呼び出しも取り消される。
+    """
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        messages = asyncio.Queue()
+        disconnected = False
+        response_complete = False
+        
+        async def send_wrapper(message):
+            nonlocal response_complete
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                response_complete = True
+        
+        app_task = asyncio.ensure_future(self.app(scope, messages.get, send_wrapper))
+        
+        async def watch_disconnect():
+            nonlocal disconnected
+            while True:
+                message = await receive()
+                await messages.put(message)
+                if message["type"] == "http.disconnect":
+                    # レスポンス送信後の切断（通常の終了）では後処理を取り消さない
+                    if not response_complete and not app_task.done():
+                        disconnected = True
+                        logger.info(f"クライアントが切断したため処理を中止します: {scope['path']}")
+                        app_task.cancel()
+                    return
+        
+        watcher = asyncio.ensure_future(watch_disconnect())
+        try:
+            await app_task
+        except asyncio.CancelledError:
+            if not disconnected:
+                raise
+        finally:
+            watcher.cancel()
+            if not app_task.done():
+                app_task.cancel()
+
+app.add_middleware(CancelOnDisconnectMiddleware)
+
 # --- ヘルパー関数 ---
 def to_text(text):
     """テキストを整形するヘルパー関数"""
     text = text.replace('•', ' *')
     return textwrap.dedent(text)
 
-def generate_text(prompt, model_name="models/gemini-2.5-flash-lite", temperature=0.8, max_retries=3):
-    """指定されたプロンプトと設定でテキストを生成する関数（リトライ機能付き）"""
-    retry_count = 0
-    last_error = None
+def llm_error_to_http(error):
+    """LLM呼び出しのエラーを、クライアントに返すHTTPエラーに変換する関数"""
+    if isinstance(error, DeadlineExceededError):
+        return HTTPException(status_code=504, detail="リクエストの期限内に生成が完了しませんでした")
+    if isinstance(error, LLMOverloadedError):
+        return HTTPException(status_code=503, detail=f"APIが過負荷状態です。しばらく待ってから再試行してください。")
+    return HTTPException(status_code=500, detail=f"テキスト生成エラー: {error}")
+
+def record_session_chars(prompt, result):
+    """APIを実際に呼んだ結果の入出力の文字数をセッションに加える関数
     
-    while retry_count < max_retries:
-        try:
-            model = genai.GenerativeModel(model_name=model_name)
-            response = model.generate_content(
-                prompt, 
-                generation_config=genai.types.GenerationConfig(temperature=temperature)
+    キャッシュヒットや同時実行の合流ではAPIを呼んでいないため料金計算の対象外
+    """
+    if result.billable:
+        current_session["total_input_chars"] += len(prompt)
+        current_session["total_output_chars"] += len(result.text or "")
+
+async def generate_text(prompt, model_name=None, temperature=None, max_retries=None, use_cache=True,
+                        priority=Priority.BACKGROUND, template=None, persona=None, context=None, pack=False):
+    """指定されたプロンプトと設定でテキストを生成する関数（非同期・キャッシュ・リトライ機能付き）
+    
+    モデル・temperature・出力上限は template に対応するタスクプロファイルで決まる（引数で上書き可）。
+    template / persona はコスト台帳の集計にも使う
+    context は複数のプロンプトで共通の前置き（コンテキストキャッシュで再送を省く）
+    pack=True の小さなプロンプトは、同時に生成される同じ種類のプロンプトと1回のリクエストにまとめる
+    （model_name / temperature / max_retries / context を指定した場合は、その設定を守るためまとめない）
+    ストリーミング用エンドポイントから呼ばれた場合は、生成中のトークンと見出しをSSEで送る（まとめない）
+    """
+    sink = get_stream_sink()
+    if sink is not None:
+        return await stream_generate_text(sink, prompt, model_name=model_name, temperature=temperature,
+                                          use_cache=use_cache, priority=priority,
+                                          template=template, persona=persona, context=context)
+    # まとめたリクエストはタスクプロファイルの設定で生成するため、個別の設定がある場合はまとめない
+    pack = pack and model_name is None and temperature is None and max_retries is None and context is None
+    try:
+        if pack:
+            result = await llm_gateway.generate_packable(
+                prompt, template=template, persona=persona, use_cache=use_cache, priority=priority
             )
-            
-            current_session["total_input_chars"] += len(prompt)
-            if response.text:
-                current_session["total_output_chars"] += len(response.text)
-            
-            return response.text
-        except Exception as e:
-            last_error = e
-            error_message = str(e)
-            
-            # APIオーバーロードまたは一時的なエラーの場合はリトライ
-            if ("overloaded" in error_message.lower() or 
-                "503" in error_message or 
-                "504" in error_message or
-                "unavailable" in error_message.lower() or
-                "timeout" in error_message.lower()):
-                retry_count += 1
-                wait_time = retry_count * 2  # 2秒、4秒、6秒と待機時間を増やす
-                logger.warning(f"API一時エラー（リトライ {retry_count}/{max_retries}）: {e}。{wait_time}秒待機中...")
-                time.sleep(wait_time)
-                continue
+        else:
+            result = await llm_gateway.generate_text(
+                prompt, model_name=model_name, temperature=temperature,
+                max_retries=max_retries, use_cache=use_cache, priority=priority,
+                template=template, persona=persona, context=context
+            )
+    except LLMError as e:
+        raise llm_error_to_http(e)
+    
+    record_session_chars(prompt, result)
+    return result.text
+
+async def stream_generate_text(sink, prompt, model_name=None, temperature=None, use_cache=True,
+                               priority=Priority.BACKGROUND, template=None, persona=None, context=None):
+    """テキストをストリーミングで生成し、トークンと「### N.」の見出しを sink に送りながら全文を返す"""
+    labels = {"template": template, "persona": persona}
+    tracker = SectionTracker()
+    parts = []
+    first = None
+    sink.emit("start", labels)
+    try:
+        async for delta in llm_gateway.stream_text(
+            prompt, model_name=model_name, temperature=temperature, use_cache=use_cache,
+            priority=priority, template=template, persona=persona, context=context
+        ):
+            first = first or delta
+            parts.append(delta.text)
+            sink.emit("token", {**labels, "text": delta.text})
+            for section in tracker.feed(delta.text):
+                sink.emit("section", {**labels, **section})
+    except LLMError as e:
+        raise llm_error_to_http(e)
+    for section in tracker.flush():
+        sink.emit("section", {**labels, **section})
+    sink.emit("end", labels)
+    
+    text = "".join(parts)
+    if first is not None:
+        # キャッシュヒット・合流かどうかは最初の断片でわかる
+        record_session_chars(prompt, GenerationResult(text=text, model_name=first.model_name,
+                                                      cached=first.cached, coalesced=first.coalesced))
+    return text
+
+async def generate_structured(prompt, schema, use_cache=True, priority=Priority.BACKGROUND,
+                              template=None, persona=None, pack=False):
+    """スキーマに沿ったJSONを生成し、検証済みのインスタンスを返す関数
+    
+    スキーマに適合しない場合は出力とエラー箇所だけを渡して1回だけ修正を依頼する。
+    pack=True の場合は generate_text と同じく同じ種類のプロンプトと1回のリクエストにまとめる
+    ストリーミング用エンドポイントから呼ばれた場合も、JSONは途中経過を送らずにまとめて返す
+    """
+    try:
+        if pack:
+            result = await llm_gateway.generate_packable(
+                prompt, template=template, persona=persona, use_cache=use_cache, priority=priority, schema=schema
+            )
+        else:
+            result = await llm_gateway.generate_structured(
+                prompt, schema, use_cache=use_cache, priority=priority, template=template, persona=persona
+            )
+    except StructuredOutputError as e:
+        raise HTTPException(status_code=502, detail=f"生成結果の形式が不正です: {e}")
+    except LLMError as e:
+        raise llm_error_to_http(e)
+    
+    record_session_chars(prompt, result)
+    return result.parsed
+
+def stream_endpoint(handler):
+    """エンドポイント処理をストリーミングで実行し、生成中のイベントと最終結果をSSEで返す
+    
+    イベント: start / token / section / end（LLM呼び出しごと）、result（レスポンス本体）、error
+    クライアントが切断した場合は処理を中止する
+    """
+    async def events():
+        sink = StreamSink()
+        with bind_stream_sink(sink):
+            task = asyncio.create_task(handler())
+        try:
+            while True:
+                next_event = asyncio.create_task(sink.next_event())
+                done, _ = await asyncio.wait({next_event, task}, return_when=asyncio.FIRST_COMPLETED)
+                if next_event in done:
+                    event, data = next_event.result()
+                    yield sse_event(event, data)
+                    continue
+                next_event.cancel()
+                break
+            # 処理完了までに送られた残りのイベントを送り切る
+            while not sink.empty():
+                event, data = await sink.next_event()
+                yield sse_event(event, data)
+            try:
+                result = task.result()
+            except HTTPException as e:
+                yield sse_event("error", {"status_code": e.status_code, "detail": e.detail})
+            except Exception as e:
+                logger.error(f"ストリーミング処理中にエラーが発生しました: {e}")
+                yield sse_event("error", {"status_code": 500, "detail": str(e)})
             else:
-                # その他のエラーは即座に例外を投げる
-                logger.error(f"テキスト生成中にエラーが発生しました: {e}")
-                raise HTTPException(status_code=500, detail=f"テキスト生成エラー: {e}")
+                yield sse_event("result", jsonable_encoder(result))
+        finally:
+            if not task.done():
+                logger.info("クライアントが切断したためストリーミング処理を中止します")
+                task.cancel()
+    
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+async def send_chat_message(chat, message, template="persona_answer"):
+    """ペルソナのチャットにメッセージを送信し、回答テキストを返す関数"""
+    answer = await llm_gateway.send_message(chat, message, template=template)
+    current_session["total_input_chars"] += len(message)
+    if answer:
+        current_session["total_output_chars"] += len(answer)
+    return answer
+
+# 1回の呼び出しで生成できる候補数の上限（Gemini の candidate_count の上限）
+MAX_CANDIDATE_COUNT = 8
+
+async def sample_chat_message(chat, message, candidate_count, template="persona_answer", commit=True):
+    """ペルソナの回答を1回の呼び出しで複数候補生成し、候補の一致度（回答の分布）を返す関数
+    
+    commit=True の場合は代表の回答（他の候補と最も似ている候補）をチャットの履歴に追加する
+    """
+    if not 1 <= candidate_count <= MAX_CANDIDATE_COUNT:
+        raise HTTPException(status_code=400, detail=f"候補数は1〜{MAX_CANDIDATE_COUNT}で指定してください")
+    result = await llm_gateway.sample_message(chat, message, candidate_count, template=template)
+    distribution = score_candidates(result.candidates)
+    if commit:
+        llm_gateway.append_turn(chat, message, distribution.representative)
+    current_session["total_input_chars"] += len(message)
+    current_session["total_output_chars"] += sum(len(candidate) for candidate in result.candidates)
+    return distribution
+
+async def send_fused_chat_message(chat, main_message, hypothesis=False):
+    """メイン質問への回答と、その回答を深掘りする更問を1回の呼び出しで生成する関数（回答と更問を返す）
+    
+    チャットの履歴には、通常の送信と同じくメイン質問と回答だけを追加する
+    """
+    fused_message = build_fused_message(main_message, hypothesis)
+    result = await llm_gateway.send_structured_message(chat, fused_message, FusedAnswerOutput, template="fused_answer")
+    llm_gateway.append_turn(chat, main_message, result.parsed.answer)
+    record_session_chars(fused_message, result)
+    return result.parsed.answer, result.parsed.follow_up_question
+
+async def build_interview_content(persona, history):
+    """インタビュー履歴をトークン予算内のテキストにする関数（どの圧縮を使ったかも返す）"""
+    async def summarize_chunk(chunk):
+        chunk_prompt = f"""
+        以下はインタビュー対象者「{persona.name}」へのインタビュー内容の一部です。
+        後で全体を分析するため、具体的な発言・数値・感情の表現をできるだけ残しながら、
+        要点を箇条書きで簡潔に要約してください。
+        
+        インタビュー内容:
+        {chunk}
+        """
+        return await generate_text(chunk_prompt, template="chunk_summary", persona=persona.name)
+    
+    return await interview_budgeter.fit(history, summarize_chunk)
+
+async def summarize_personas(build_prompt, template="persona_summary"):
+    """インタビュー済みの各ペルソナの要約を並行して生成する関数（要約と、各ペルソナのトークン予算の情報を返す）
     
-    # 最大リトライ回数に達した場合
-    logger.error(f"テキスト生成が最大リトライ回数（{max_retries}）に達しました: {last_error}")
-    raise HTTPException(status_code=503, detail=f"APIが過負荷状態です。しばらく待ってから再試行してください。")
+    build_prompt(persona, interview_content) で要約のプロンプトを作る。
+    ペルソナごとの要約は小さく独立しているため、1回のリクエストにまとめて生成する
+    """
+    personas = [persona for persona in current_session["selected_personas"]
+                if current_session["interview_sessions"][persona.name]["history"]]
+    update_job_progress(stage="summarizing", personas_total=len(personas), personas_summarized=0)
+    
+    async def summarize(persona):
+        history = current_session["interview_sessions"][persona.name]["history"]
+        # インタビュー内容をトークン予算内に収める（超過時は段階的に圧縮）
+        budgeted = await build_interview_content(persona, history)
+        summary = await generate_text(build_prompt(persona, budgeted.content), template=template,
+                                      persona=persona.name, pack=True)
+        add_job_progress(personas_summarized=1)
+        return summary, budgeted.to_dict()
+    
+    results = await asyncio.gather(*(summarize(persona) for persona in personas))
+    update_job_progress(stage="analyzing")
+    summaries = {persona.name: summary for persona, (summary, _) in zip(personas, results)}
+    context_budget = {persona.name: budget for persona, (_, budget) in zip(personas, results)}
+    return summaries, context_budget
+
+def get_session_stats():
+    """現在のセッションの経過時間・トークン数・料金をまとめる関数（料金はコスト台帳の実トークン数から計算）"""
+    # コスト台帳と同じく、X-Session-ID ヘッダーで指定されたセッションがあればそれで集計する
+    session_id = get_call_context().get("session_id") or current_session["session_id"]
+    usage = llm_gateway.ledger.summarize(session_id=session_id)["total"]
+    return {
+        "elapsed_time": time.time() - current_session["start_time"],
+        "input_chars": current_session["total_input_chars"],
+        "output_chars": current_session["total_output_chars"],
+        "input_tokens": usage["input_tokens"],
+        "output_tokens": usage["output_tokens"],
+        "api_calls": usage["calls"],
+        "estimated_cost": usage["cost"],
+        # チャット履歴の圧縮で送らずに済んだ入力トークン数（概算）
+        "history_tokens_saved": llm_gateway.compactor.tokens_saved(session_id)
+    }
 
 def parse_personas(personas_text):
     """ペルソナテキストを解析する関数"""
@@ -294,6 +722,39 @@ def parse_personas(personas_text):
     
     return parsed_personas
 
+# 構造化出力を使わない場合のインタビューサマリの出力形式
+TEXT_SUMMARY_FORMAT = """出力形式:
+            【主な発見】
+            [発見内容を4-5行で詳細に記述]
+            
+            【主な示唆】
+            [示唆内容を4-5行で具体的に記述]"""
+
+# ペルソナの詳細の表示項目（PersonaProfile の項目名 -> 表示名）
+PERSONA_PROFILE_LABELS = [
+    ("age", "年齢"),
+    ("gender", "性別"),
+    ("occupation", "職業"),
+    ("income", "年収帯"),
+    ("residence", "居住地"),
+    ("family", "家族構成"),
+    ("hobbies", "趣味・余暇"),
+    ("concerns", "関心事・悩み"),
+]
+
+def persona_from_profile(index, profile):
+    """構造化出力のペルソナを、parse_personas() と同じ形式の Persona にする関数"""
+    details = {"ペルソナ名": profile.name}
+    lines = [f"インタビュー対象者{index + 1}: {profile.name}"]
+    for field_name, label in PERSONA_PROFILE_LABELS:
+        value = getattr(profile, field_name).strip()
+        if value:
+            details[label] = value
+            lines.append(f"{label}: {value}")
+    raw_text = "\n".join(lines)
+    details["raw_text"] = raw_text
+    return Persona(name=profile.name, details=details, raw_text=raw_text)
+
 # --- API エンドポイント ---
 
 @app.get("/")
@@ -340,6 +801,19 @@ async def generate_personas(request: PersonaGenerationRequest):
         {request.persona_characteristics}
         """
 
+        if STRUCTURED_OUTPUT_ENABLED:
+            format_instructions = "各インタビュー対象者について、名前・年齢・性別・職業・年収帯・居住地・家族構成・趣味・余暇の過ごし方・関心事・主な悩みを指定されたJSON形式で出力してください。"
+        else:
+            format_instructions = "各インタビュー対象者について、以下の詳細を含めてください。厳密にこの形式で出力してください：\n\n" + "\n\n".join([f"""インタビュー対象者{i+1}: [具体的な名前]
+        年齢: [年齢]
+        性別: [性別]
+        職業: [職業]
+        年収帯: [年収帯]
+        居住地: [居住地]
+        家族構成: [家族構成]
+        趣味・余暇: [趣味・余暇の過ごし方]
+        関心事・悩み: [関心事・主な悩み]""" for i in range(request.persona_count)])
+        
         persona_prompt = f"""
         あなたはマーケティングの専門家です。
         以下の商品・サービスと「{request.project_info.topic}」に関するインタビューのための、多様な価値観とライフスタイルを持つ{request.persona_count}人のインタビュー対象者を作成してください。
@@ -350,17 +824,7 @@ async def generate_personas(request: PersonaGenerationRequest):
         【競合情報】
         {competitors_info}{characteristics_info}
         
-        各インタビュー対象者について、以下の詳細を含めてください。厳密にこの形式で出力してください：
-
-        """ + "\n\n".join([f"""インタビュー対象者{i+1}: [具体的な名前]
-        年齢: [年齢]
-        性別: [性別]
-        職業: [職業]
-        年収帯: [年収帯]
-        居住地: [居住地]
-        家族構成: [家族構成]
-        趣味・余暇: [趣味・余暇の過ごし方]
-        関心事・悩み: [関心事・主な悩み]""" for i in range(request.persona_count)]) + f"""
+        {format_instructions}
 
         注意点：
         - 具体的で現実的な名前を使用してください
@@ -371,14 +835,31 @@ async def generate_personas(request: PersonaGenerationRequest):
         - 各項目は簡潔に記述してください
         """
         
-        personas_text = generate_text(persona_prompt)
-        logger.info(f"生成されたペルソナテキスト: {personas_text[:500]}...")
-        
-        personas = parse_personas(personas_text)
+        # ペルソナの生成から新しいセッションとし、生成の料金も新しいセッションに記録する
+        # （X-Session-ID ヘッダーでセッションを指定されている場合はそのセッションに記録する）
+        previous_session_id = current_session["session_id"]
+        current_session["session_id"] = str(uuid.uuid4())
+        current_session["start_time"] = time.time()
+        bound_session_id = get_call_context().get("session_id")
+        ledger_session_id = (current_session["session_id"] if bound_session_id in (None, previous_session_id)
+                             else bound_session_id)
+        
+        # 再生成のたびに異なるペルソナが欲しいためキャッシュは使わない
+        with call_context(session_id=ledger_session_id):
+            if STRUCTURED_OUTPUT_ENABLED:
+                output = await generate_structured(persona_prompt, PersonaListOutput, use_cache=False,
+                                                   template="persona_generation")
+                if len(output.personas) != request.persona_count:
+                    logger.warning(f"生成されたペルソナ数が指定と異なります: {len(output.personas)}/{request.persona_count}")
+                personas = [persona_from_profile(i, profile) for i, profile in enumerate(output.personas)]
+                personas_text = "\n\n".join(p.raw_text for p in personas)
+            else:
+                personas_text = await generate_text(persona_prompt, use_cache=False, template="persona_generation")
+                logger.info(f"生成されたペルソナテキスト: {personas_text[:500]}...")
+                personas = parse_personas(personas_text)
         logger.info(f"パースされたペルソナ数: {len(personas)}")
         
         current_session["personas"] = personas
-        current_session["start_time"] = time.time()
         
         # レスポンス用のペルソナデータを準備
         persona_list = []
@@ -430,8 +911,6 @@ async def select_personas(request: PersonaSelectionRequest):
         current_session["selected_personas"] = selected_personas
         
         # 各ペルソナのチャットセッションを初期化
-        model = genai.GenerativeModel('models/gemini-2.5-flash-lite')
-        
         for persona in selected_personas:
             # 商品・サービス情報と競合情報を含むプロンプト
             project_info = current_session.get("project_info")
@@ -473,10 +952,12 @@ async def select_personas(request: PersonaSelectionRequest):
             それでは、インタビューを始めます。準備ができたら「はい、準備ができました」と答えてください。
             """
             
-            chat = model.start_chat(history=[
+            # ペルソナ設定と商品情報はすべての質問で送るため、前置きとして登録しキャッシュから参照する
+            persona_context = make_context_prefix(f"persona:{persona.name}", [
                 {'role': 'user', 'parts': [initial_prompt]},
                 {'role': 'model', 'parts': ['はい、準備ができました。何でも聞いてください。']}
             ])
+            chat = llm_gateway.start_chat(history=[], persona=persona.name, context=persona_context)
             
             current_session["interview_sessions"][persona.name] = {
                 "persona": persona,
@@ -625,7 +1106,7 @@ async def get_default_questions(topic: Optional[str] = None):
     
     try:
         # LLMで質問を生成
-        generated_questions_text = generate_text(question_prompt, temperature=0.7)
+        generated_questions_text = await generate_text(question_prompt, template="default_questions")
         
         # 生成されたテキストから質問を抽出
         questions = []
@@ -697,32 +1178,19 @@ async def get_default_questions(topic: Optional[str] = None):
         ]
         return {"questions": fallback_questions}
 
-@app.post("/api/conduct-interview")
-async def conduct_interview(request: InterviewRequest):
-    """インタビューを実行するエンドポイント"""
-    try:
-        if not current_session["selected_personas"]:
-            raise HTTPException(status_code=400, detail="ペルソナが選択されていません")
-        
-        persona = current_session["selected_personas"][request.persona_index]
-        session = current_session["interview_sessions"][persona.name]
-        chat = session["chat"]
-        
-        interview_results = []
-        
-        for i, question in enumerate(request.questions):
-            # メイン質問
-            response = chat.send_message(f"次の質問に簡潔に2-3文で回答してください：{question}")
-            main_answer = response.text
-            
-            question_result = {
-                "question": question,
-                "main_answer": main_answer,
-                "follow_ups": []
-            }
+def build_follow_up_prompt(persona, question, main_answer, hypothesis=False):
+    """更問を作るプロンプト（hypothesis=True は追加インタビュー用）"""
+    if hypothesis:
+        return f"""
+            あなたは戦略的なインタビュアーです。これまでの{persona.name}さんとの会話履歴を読み、
+            より深い洞察を得るために、直前の回答について、より具体的で洞察的な情報を引き出すような、
+            1つの質問を作成してください。
+            質問は「〇〇について、どのように感じますか？」のような対話形式でお願いします。
             
-            # 更問を1回実行（時短のため）
-            follow_up_prompt = f"""
+            直前の質問: {question}
+            直前の回答: {main_answer}
+            """
+    return f"""
             あなたは優秀なインタビュアーです。これまでの{persona.name}さんとの会話を読んで、
             特に直前の回答について、具体的な行動や感情、潜在的なニーズをさらに深掘りするような、
             1つの簡潔で具体的な質問を作成してください。
@@ -731,13 +1199,215 @@ async def conduct_interview(request: InterviewRequest):
             直前の質問: {question}
             直前の回答: {main_answer}
             """
+
+def follow_up_focus(hypothesis=False):
+    """更問の観点と質問の例（build_follow_up_prompt と同じもの）"""
+    if hypothesis:
+        return ("より深い洞察を得るために、より具体的で洞察的な情報を引き出すような",
+                "「〇〇について、どのように感じますか？」")
+    return ("具体的な行動や感情、潜在的なニーズをさらに深掘りするような",
+            "「〇〇について、もう少し詳しく教えていただけますか？」")
+
+def build_fused_message(main_message, hypothesis=False):
+    """回答と更問を1回で生成するためのメッセージ"""
+    focus, example = follow_up_focus(hypothesis)
+    return f"""{main_message}
+
+回答は answer に、これまでどおりあなた自身として書いてください。
+あわせて、インタビュアーの立場から、answer の内容について{focus}1つの簡潔で具体的な質問を
+{example}のような対話形式で作り、follow_up_question に入れてください。"""
+
+def format_numbered(items, suffix=""):
+    """番号（0始まりの位置）ごとのテキストを「Q1: ...」の形式で並べる"""
+    return "\n".join(f"Q{index + 1}{suffix}: {text}" for index, text in sorted(items.items()))
+
+def match_numbered_items(items, count):
+    """質問票の回答を質問の位置（0始まり）ごとにまとめる（番号が重複・範囲外なら順番で対応させる）"""
+    numbers = [item.number for item in items]
+    if len(set(numbers)) == len(numbers) and all(1 <= number <= count for number in numbers):
+        return {item.number - 1: item for item in items}
+    return {index: item for index, item in enumerate(items[:count])}
+
+async def run_questionnaire(persona, chat, questions, hypothesis=False, fused_follow_up=False, follow_ups=True):
+    """全質問を質問票として1回で送り、質問ごとの回答を受け取る関数（位置ごとの結果と、期限で打ち切ったかどうかを返す）
+    
+    follow_ups=True の場合は、全回答への更問をもう1回まとめて送る。更問は fused_follow_up なら回答と同時に、
+    そうでなければ1回の呼び出しで全回答分を生成するため、質問数によらず2〜3回の呼び出しで済む。
+    チャットの履歴には JSON ではなく「Q1の回答: ...」の形式で追加する。回答が欠けた質問は結果に含めない。
+    """
+    main_message = f"""以下の質問リスト全てに、一度に答えてください。各質問には簡潔に2-3文で回答してください。
+---
+{format_numbered(dict(enumerate(questions)))}
+---"""
+    if fused_follow_up:
+        focus, example = follow_up_focus(hypothesis)
+        message = f"""{main_message}
+
+質問ごとに、質問番号を number に、あなた自身としての回答を answer に書いてください。
+あわせて、インタビュアーの立場から、それぞれの回答について{focus}1つの簡潔で具体的な質問を
+{example}のような対話形式で作り、follow_up_question に入れてください。"""
+        schema = QuestionnaireFusedOutput
+    else:
+        message = f"{main_message}\n\n質問ごとに、質問番号を number に、あなた自身としての回答を answer に書いてください。"
+        schema = QuestionnaireOutput
+    
+    result = await llm_gateway.send_structured_message(chat, message, schema, template="questionnaire_answer")
+    answers = match_numbered_items(result.parsed.answers, len(questions))
+    llm_gateway.append_turn(chat, main_message, format_numbered({i: a.answer for i, a in answers.items()}, "の回答"))
+    record_session_chars(message, result)
+    
+    results = {
+        index: {
+            "question": questions[index],
+            "main_answer": answer.answer,
+            "follow_ups": [],
+            "follow_up_mode": "questionnaire"
+        }
+        for index, answer in answers.items()
+    }
+    if not follow_ups:
+        return results, False
+    
+    try:
+        if fused_follow_up:
+            follow_up_questions = {index: answer.follow_up_question for index, answer in answers.items()}
+        else:
+            focus, example = follow_up_focus(hypothesis)
+            qa_text = "\n".join(f"Q{index + 1}: {questions[index]}\nQ{index + 1}の回答: {answer.answer}"
+                                for index, answer in sorted(answers.items()))
+            follow_up_prompt = f"""
+            あなたは優秀なインタビュアーです。以下は{persona.name}さんへの質問票とその回答です。
+            それぞれの回答について、{focus}1つの簡潔で具体的な質問を
+            {example}のような対話形式で作成してください。
+            深掘りする回答の質問番号を number に、質問を question に入れてください。
             
+{qa_text}
+            """
+            generated = await llm_gateway.generate_structured(
+                follow_up_prompt, QuestionnaireFollowUpsOutput, priority=Priority.INTERACTIVE,
+                template="questionnaire_follow_up_question", persona=persona.name
+            )
+            record_session_chars(follow_up_prompt, generated)
+            follow_up_questions = {
+                index: item.question
+                for index, item in match_numbered_items(generated.parsed.follow_up_questions, len(questions)).items()
+                if index in answers
+            }
+        follow_up_questions = {index: q.strip() for index, q in follow_up_questions.items() if q and q.strip()}
+        if not follow_up_questions:
+            return results, False
+        
+        follow_up_main = f"""先ほどの回答について、以下の深掘り質問全てに、一度に答えてください。番号は先ほどの質問番号です。
+---
+{format_numbered(follow_up_questions)}
+---"""
+        follow_up_message = f"{follow_up_main}\n\n質問ごとに、質問番号を number に、あなた自身としての回答を answer に書いてください。"
+        answered = await llm_gateway.send_structured_message(chat, follow_up_message, QuestionnaireOutput,
+                                                             template="questionnaire_follow_up_answer")
+        numbers = sorted(follow_up_questions)
+        # 更問の番号は元の質問番号のため、番号が不正な場合は更問の並び順で対応させる
+        by_number = {item.number - 1: item for item in answered.parsed.answers}
+        if set(by_number) != set(numbers):
+            by_number = dict(zip(numbers, answered.parsed.answers))
+        follow_up_answers = {index: item.answer for index, item in by_number.items() if index in follow_up_questions}
+        llm_gateway.append_turn(chat, follow_up_main, format_numbered(follow_up_answers, "の回答"))
+        record_session_chars(follow_up_message, answered)
+        
+        for index, answer in follow_up_answers.items():
+            results[index]["follow_ups"].append({
+                "question": follow_up_questions[index],
+                "answer": answer
+            })
+    except DeadlineExceededError:
+        return results, True
+    except Exception as e:
+        logger.error(f"質問票形式の更問への回答生成エラー: {e}")
+        # エラーが発生しても回答済みの結果は返す
+    
+    return results, False
+
+async def run_persona_interview(persona, questions, candidate_count=1, hypothesis=False, fused_follow_up=None,
+                                questionnaire=None, questionnaire_follow_ups=True):
+    """1人のペルソナに質問を順番に行い、結果と期限で打ち切ったかどうかを返す関数
+    
+    同じペルソナのチャットは会話の順序が崩れないよう、質問・更問を1つずつ送信する。
+    回答済みの質問は途中でエラーになってもセッション履歴に残す。
+    fused_follow_up=True（省略時は INTERVIEW_FUSED_FOLLOW_UP）ではメイン質問の回答と更問を1回の呼び出しで生成し、
+    1問あたりの呼び出しを3回から2回に減らす（回答の候補を複数生成する場合は使わない）。
+    questionnaire=True（省略時は INTERVIEW_QUESTIONNAIRE）では全質問を1回で送り（run_questionnaire）、
+    回答を得られなかった質問だけを1問ずつ質問する（回答の候補を複数生成する場合は使わない）。
+    """
+    if fused_follow_up is None:
+        fused_follow_up = INTERVIEW_FUSED_FOLLOW_UP
+    if questionnaire is None:
+        questionnaire = INTERVIEW_QUESTIONNAIRE
+    session = current_session["interview_sessions"][persona.name]
+    chat = session["chat"]
+    
+    results_by_index = {}
+    partial = False
+    
+    try:
+        if questionnaire and candidate_count <= 1 and questions:
             try:
-                follow_up_question = generate_text(follow_up_prompt, temperature=0.7)
+                answered, partial = await run_questionnaire(persona, chat, questions, hypothesis, fused_follow_up,
+                                                            questionnaire_follow_ups)
+                results_by_index.update(answered)
+                add_job_progress(questions_answered=len(answered))
+            except DeadlineExceededError:
+                partial = True
+            except LLMError as e:
+                # スキーマ不適合・タイムアウト・過負荷などでは、出力の小さい1問ずつの質問に切り替える
+                logger.warning(f"質問票形式の回答を得られなかったため1問ずつ質問します: {e}")
+        
+        for index, question in enumerate(questions):
+            if index in results_by_index:
+                continue
+            # 期限を過ぎたら残りの質問は行わず、回答済みの分だけ返す
+            if partial or deadline_exceeded():
+                partial = True
+                break
+            
+            # メイン質問（candidate_count が2以上なら複数候補から代表の回答を選び、ばらつきも記録する）
+            main_message = f"次の質問に簡潔に2-3文で回答してください：{question}"
+            distribution = None
+            follow_up_question = None
+            try:
+                if candidate_count > 1:
+                    distribution = await sample_chat_message(chat, main_message, candidate_count)
+                    main_answer = distribution.representative
+                elif fused_follow_up:
+                    try:
+                        main_answer, follow_up_question = await send_fused_chat_message(chat, main_message, hypothesis)
+                    except StructuredOutputError as e:
+                        logger.warning(f"回答と更問を同時に生成できなかったため個別に生成します: {e}")
+                        main_answer = await send_chat_message(chat, main_message)
+                else:
+                    main_answer = await send_chat_message(chat, main_message)
+            except DeadlineExceededError:
+                partial = True
+                break
+            
+            question_result = {
+                "question": question,
+                "main_answer": main_answer,
+                "follow_ups": [],
+                "follow_up_mode": "fused" if follow_up_question is not None else "separate"
+            }
+            if distribution is not None:
+                question_result["answer_distribution"] = distribution.to_dict()
+            
+            # 更問を1回実行（時短のため）
+            try:
+                if follow_up_question is None:
+                    # 更問はインタビュー中にユーザーが待っているため対話レーンで優先処理
+                    follow_up_question = await generate_text(
+                        build_follow_up_prompt(persona, question, main_answer, hypothesis),
+                        priority=Priority.INTERACTIVE, template="follow_up_question", persona=persona.name, pack=True
+                    )
                 
                 if follow_up_question and "エラー" not in follow_up_question:
-                    follow_up_response = chat.send_message(follow_up_question)
-                    follow_up_answer = follow_up_response.text
+                    follow_up_answer = await send_chat_message(chat, follow_up_question, template="follow_up_answer")
                     
                     question_result["follow_ups"].append({
                         "question": follow_up_question,
@@ -747,15 +1417,117 @@ async def conduct_interview(request: InterviewRequest):
                 logger.error(f"更問への回答生成エラー: {e}")
                 # エラーが発生してもインタビューを継続
             
-            interview_results.append(question_result)
-        
-        # セッション履歴を更新
+            results_by_index[index] = question_result
+            add_job_progress(questions_answered=1)
+    finally:
+        # セッション履歴を更新（質問の順に並べる）
+        interview_results = [results_by_index[index] for index in sorted(results_by_index)]
         session["history"].extend(interview_results)
+    
+    if partial:
+        logger.warning(f"リクエストの期限に達したため {persona.name} さんへの質問を {len(interview_results)}/{len(questions)} 問で打ち切りました")
+    
+    return interview_results, partial
+
+# 一括インタビューで同時に進めるペルソナ数の上限
+INTERVIEW_MAX_PARALLEL_PERSONAS = int(os.getenv("INTERVIEW_MAX_PARALLEL_PERSONAS", "3"))
+
+async def run_batch_interview(request, hypothesis, completed_message):
+    """選択された複数のペルソナに並行してインタビューし、ペルソナごとの結果と失敗を返す関数
+    
+    ペルソナ同士は独立しているため同時に進め（同時に進める数は INTERVIEW_MAX_PARALLEL_PERSONAS まで）、
+    全体の所要時間を最も時間のかかるペルソナ1人分に近づける。1人が失敗しても他のペルソナの結果は返す。
+    """
+    if not current_session["selected_personas"]:
+        raise HTTPException(status_code=400, detail="ペルソナが選択されていません")
+    if not 1 <= request.candidate_count <= MAX_CANDIDATE_COUNT:
+        raise HTTPException(status_code=400, detail=f"候補数は1〜{MAX_CANDIDATE_COUNT}で指定してください")
+    
+    selected_personas = current_session["selected_personas"]
+    indices = request.persona_indices if request.persona_indices is not None else list(range(len(selected_personas)))
+    invalid = [index for index in indices if not 0 <= index < len(selected_personas)]
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"ペルソナの番号が不正です: {invalid}")
+    indices = list(dict.fromkeys(indices))
+    update_job_progress(personas_total=len(indices), personas_done=0, personas_failed=0,
+                        questions_total=len(indices) * len(request.questions), questions_answered=0)
+    
+    semaphore = asyncio.Semaphore(max(1, INTERVIEW_MAX_PARALLEL_PERSONAS))
+    
+    async def interview(index):
+        persona = selected_personas[index]
+        history = current_session["interview_sessions"][persona.name]["history"]
+        answered_before = len(history)
+        async with semaphore:
+            try:
+                with llm_gateway.tracer.span("interview.persona", {"persona": persona.name, "persona_index": index}):
+                    interview_results, partial = await run_persona_interview(
+                        persona, request.questions, request.candidate_count, hypothesis, request.fused_follow_up,
+                        request.questionnaire, request.questionnaire_follow_ups
+                    )
+            except Exception as e:
+                logger.error(f"{persona.name} さんへのインタビュー実行エラー: {e}")
+                add_job_progress(personas_done=1, personas_failed=1)
+                # 失敗するまでに回答済みの質問は履歴に残っているため、その分も返す
+                interview_results = history[answered_before:]
+                return {
+                    "persona_index": index,
+                    "persona_name": persona.name,
+                    "status": "failed",
+                    "error": str(e.detail) if isinstance(e, HTTPException) else str(e),
+                    "interview_results": interview_results,
+                    "partial": True,
+                    "completed_questions": len(interview_results),
+                }
+        add_job_progress(personas_done=1)
+        return {
+            "persona_index": index,
+            "persona_name": persona.name,
+            "status": "partial" if partial else "completed",
+            "error": None,
+            "interview_results": interview_results,
+            "partial": partial,
+            "completed_questions": len(interview_results),
+        }
+    
+    results = await asyncio.gather(*(interview(index) for index in indices))
+    failed = [result for result in results if result["status"] == "failed"]
+    partial = any(result["partial"] for result in results)
+    
+    if failed:
+        message = f"{len(results) - len(failed)}/{len(results)} 人のインタビューが完了しました（失敗: {', '.join(result['persona_name'] for result in failed)}）"
+    elif partial:
+        message = "時間切れのため、回答済みの質問までの結果を返します"
+    else:
+        message = completed_message
+    
+    return {
+        "results": results,
+        "succeeded": len(results) - len(failed),
+        "failed": len(failed),
+        "partial": partial,
+        "message": message
+    }
+
+@app.post("/api/conduct-interview")
+async def conduct_interview(request: InterviewRequest):
+    """インタビューを実行するエンドポイント"""
+    try:
+        if not current_session["selected_personas"]:
+            raise HTTPException(status_code=400, detail="ペルソナが選択されていません")
+        
+        persona = current_session["selected_personas"][request.persona_index]
+        interview_results, partial = await run_persona_interview(
+            persona, request.questions, request.candidate_count, fused_follow_up=request.fused_follow_up,
+            questionnaire=request.questionnaire, questionnaire_follow_ups=request.questionnaire_follow_ups
+        )
         
         return {
             "persona_name": persona.name,
             "interview_results": interview_results,
-            "message": "インタビューが完了しました"
+            "partial": partial,
+            "completed_questions": len(interview_results),
+            "message": "インタビューが完了しました" if not partial else "時間切れのため、回答済みの質問までの結果を返します"
         }
     
     except Exception as e:
@@ -764,6 +1536,17 @@ async def conduct_interview(request: InterviewRequest):
         logger.error(f"詳細エラー: {traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"インタビューの実行に失敗しました: {str(e)}")
 
+@app.post("/api/conduct-interviews")
+async def conduct_interviews(request: BatchInterviewRequest):
+    """選択された全ペルソナ（persona_indices で指定したペルソナ）に並行してインタビューするエンドポイント"""
+    try:
+        return await run_batch_interview(request, False, "インタビューが完了しました")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"一括インタビュー実行エラー: {e}")
+        raise HTTPException(status_code=500, detail=f"インタビューの実行に失敗しました: {str(e)}")
+
 @app.post("/api/generate-analysis")
 async def generate_analysis():
     """インサイト分析を生成するエンドポイント"""
@@ -772,25 +1555,8 @@ async def generate_analysis():
             raise HTTPException(status_code=400, detail="インタビューデータがありません")
         
         # 各ペルソナのインタビュー要約を作成
-        summaries = {}
-        for persona in current_session["selected_personas"]:
-            session = current_session["interview_sessions"][persona.name]
-            history = session["history"]
-            
-            if not history:
-                continue
-            
-            # インタビュー内容を要約
-            interview_content = ""
-            for result in history:
-                interview_content += f"質問: {result['question']}\n"
-                interview_content += f"回答: {result['main_answer']}\n"
-                for follow_up in result.get('follow_ups', []):
-                    interview_content += f"更問: {follow_up['question']}\n"
-                    interview_content += f"更問回答: {follow_up['answer']}\n"
-                interview_content += "\n"
-            
-            summary_prompt = f"""
+        def build_prompt(persona, interview_content):
+            return f"""
             以下のペルソナへのインタビュー内容を読み、重要なポイントを簡潔に要約してください。
             
             ペルソナ情報:
@@ -799,9 +1565,8 @@ async def generate_analysis():
             インタビュー内容:
             {interview_content}
             """
-            
-            summary = generate_text(summary_prompt, temperature=0.5)
-            summaries[persona.name] = summary
+        
+        summaries, context_budget = await summarize_personas(build_prompt)
         
         # 総合分析を生成
         all_summaries = '\n\n'.join([f"--- {name}さんの要約 ---\n{summary}" for name, summary in summaries.items()])
@@ -900,12 +1665,7 @@ async def generate_analysis():
         - 各象限のペルソナに対する具体的なアプローチ方法を記載
         """
         
-        analysis_result = generate_text(analysis_prompt)
-        
-        # コスト計算
-        end_time = time.time()
-        elapsed_time = end_time - current_session["start_time"]
-        estimated_cost = (current_session["total_input_chars"] * INPUT_TOKEN_PRICE) + (current_session["total_output_chars"] * OUTPUT_TOKEN_PRICE)
+        analysis_result = await generate_text(analysis_prompt, template="analysis")
         
         # 分析結果をセッションに保存
         current_session["analysis"] = analysis_result
@@ -913,12 +1673,8 @@ async def generate_analysis():
         return {
             "summaries": summaries,
             "analysis": analysis_result,
-            "stats": {
-                "elapsed_time": elapsed_time,
-                "input_chars": current_session["total_input_chars"],
-                "output_chars": current_session["total_output_chars"],
-                "estimated_cost": estimated_cost
-            }
+            "context_budget": context_budget,
+            "stats": get_session_stats()
         }
     
     except Exception as e:
@@ -937,25 +1693,8 @@ async def generate_hypothesis():
             raise HTTPException(status_code=400, detail="インタビューデータがありません")
         
         # 各ペルソナのインタビュー要約を作成
-        summaries = {}
-        for persona in current_session["selected_personas"]:
-            session = current_session["interview_sessions"][persona.name]
-            history = session["history"]
-            
-            if not history:
-                continue
-            
-            # インタビュー内容を要約
-            interview_content = ""
-            for result in history:
-                interview_content += f"質問: {result['question']}\n"
-                interview_content += f"回答: {result['main_answer']}\n"
-                for follow_up in result.get('follow_ups', []):
-                    interview_content += f"更問: {follow_up['question']}\n"
-                    interview_content += f"更問回答: {follow_up['answer']}\n"
-                interview_content += "\n"
-            
-            summary_prompt = f"""
+        def build_prompt(persona, interview_content):
+            return f"""
             以下のペルソナへのインタビュー内容を読み、重要なポイントを簡潔に要約してください。
             
             ペルソナ情報:
@@ -964,9 +1703,8 @@ async def generate_hypothesis():
             インタビュー内容:
             {interview_content}
             """
-            
-            summary = generate_text(summary_prompt, temperature=0.5)
-            summaries[persona.name] = summary
+        
+        summaries, context_budget = await summarize_personas(build_prompt)
         
         # 商品・サービス情報と競合情報を取得
         products_context = ""
@@ -1014,9 +1752,13 @@ async def generate_hypothesis():
         4. **未解決の疑問点**: インタビューだけでは明確にならなかった、さらなる調査が必要な点を挙げます。
         """
         
-        initial_analysis_result = generate_text(analysis_prompt)
+        initial_analysis_result = await generate_text(analysis_prompt, template="initial_analysis")
         
         # 仮説と追加質問を生成
+        if STRUCTURED_OUTPUT_ENABLED:
+            questions_format = "追加インタビュー質問を5個、指定されたJSON形式で出力してください。"
+        else:
+            questions_format = "**追加インタビュー質問**:\n" + "\n".join(f"        - [質問内容{i}]" for i in range(1, 6))
         hypothesis_prompt = f"""
         あなたは戦略プランナーです。
         先ほどのインサイト分析レポートを基に、さらに深掘りするための追加質問を作成してください。
@@ -1029,12 +1771,7 @@ async def generate_hypothesis():
         - 「仮説」「検証」などの分析的な文言は一切使用しないでください
         - 各質問は独立した質問として生成してください
         
-        **追加インタビュー質問**:
-        - [質問内容1]
-        - [質問内容2]
-        - [質問内容3]
-        - [質問内容4]
-        - [質問内容5]
+        {questions_format}
         
         質問は以下の観点から生成してください：
         - より具体的な利用シーンや状況について
@@ -1044,17 +1781,23 @@ async def generate_hypothesis():
         - 推奨意向や口コミ行動について
         """
         
-        hypothesis_and_questions_text = generate_text(hypothesis_prompt)
-        
-        # 追加質問を抽出
-        new_questions_match = re.search(r'追加インタビュー質問[：:]\s*\n(.+)', hypothesis_and_questions_text, re.DOTALL)
-        extracted_new_questions = []
-        if new_questions_match:
-            raw_questions_block = new_questions_match.group(1).strip()
-            extracted_new_questions = re.findall(r'^[*-]\s*(.+)', raw_questions_block, re.MULTILINE)
-            if not extracted_new_questions:
-                extracted_new_questions = re.findall(r'^(?:Q\d+|#\d+|\d+\.|[*-])\s*(.+)', raw_questions_block, re.MULTILINE)
-            extracted_new_questions = [q.strip() for q in extracted_new_questions if q.strip()]
+        if STRUCTURED_OUTPUT_ENABLED:
+            output = await generate_structured(hypothesis_prompt, AdditionalQuestionsOutput, template="hypothesis")
+            extracted_new_questions = [q.strip() for q in output.additional_questions if q.strip()]
+            # 履歴・セッションには従来と同じ形式のテキストで残す
+            hypothesis_and_questions_text = "**追加インタビュー質問**:\n" + "\n".join(f"- {q}" for q in extracted_new_questions)
+        else:
+            hypothesis_and_questions_text = await generate_text(hypothesis_prompt, template="hypothesis")
+            
+            # 追加質問を抽出
+            new_questions_match = re.search(r'追加インタビュー質問[：:]\s*\n(.+)', hypothesis_and_questions_text, re.DOTALL)
+            extracted_new_questions = []
+            if new_questions_match:
+                raw_questions_block = new_questions_match.group(1).strip()
+                extracted_new_questions = re.findall(r'^[*-]\s*(.+)', raw_questions_block, re.MULTILINE)
+                if not extracted_new_questions:
+                    extracted_new_questions = re.findall(r'^(?:Q\d+|#\d+|\d+\.|[*-])\s*(.+)', raw_questions_block, re.MULTILINE)
+                extracted_new_questions = [q.strip() for q in extracted_new_questions if q.strip()]
 
         if not extracted_new_questions:
             extracted_new_questions = [
@@ -1072,7 +1815,8 @@ async def generate_hypothesis():
             "summaries": summaries,
             "initial_analysis": initial_analysis_result,
             "hypothesis_and_questions": hypothesis_and_questions_text,
-            "additional_questions": extracted_new_questions
+            "additional_questions": extracted_new_questions,
+            "context_budget": context_budget
         }
     
     except Exception as e:
@@ -1087,57 +1831,18 @@ async def conduct_hypothesis_interview(request: InterviewRequest):
             raise HTTPException(status_code=400, detail="ペルソナが選択されていません")
         
         persona = current_session["selected_personas"][request.persona_index]
-        session = current_session["interview_sessions"][persona.name]
-        chat = session["chat"]
-        
-        interview_results = []
-        
-        for i, question in enumerate(request.questions):
-            # メイン質問
-            response = chat.send_message(f"次の質問に簡潔に2-3文で回答してください：{question}")
-            main_answer = response.text
-            
-            question_result = {
-                "question": question,
-                "main_answer": main_answer,
-                "follow_ups": []
-            }
-            
-            # 更問を1回実行（時短のため）
-            follow_up_prompt = f"""
-            あなたは戦略的なインタビュアーです。これまでの{persona.name}さんとの会話履歴を読み、
-            より深い洞察を得るために、直前の回答について、より具体的で洞察的な情報を引き出すような、
-            1つの質問を作成してください。
-            質問は「〇〇について、どのように感じますか？」のような対話形式でお願いします。
-            
-            直前の質問: {question}
-            直前の回答: {main_answer}
-            """
-            
-            try:
-                follow_up_question = generate_text(follow_up_prompt, temperature=0.7)
-                
-                if follow_up_question and "エラー" not in follow_up_question:
-                    follow_up_response = chat.send_message(follow_up_question)
-                    follow_up_answer = follow_up_response.text
-                    
-                    question_result["follow_ups"].append({
-                        "question": follow_up_question,
-                        "answer": follow_up_answer
-                    })
-            except Exception as e:
-                logger.error(f"更問への回答生成エラー: {e}")
-                # エラーが発生してもインタビューを継続
-            
-            interview_results.append(question_result)
-        
-        # セッション履歴を更新
-        session["history"].extend(interview_results)
+        interview_results, partial = await run_persona_interview(
+            persona, request.questions, request.candidate_count, hypothesis=True,
+            fused_follow_up=request.fused_follow_up, questionnaire=request.questionnaire,
+            questionnaire_follow_ups=request.questionnaire_follow_ups
+        )
         
         return {
             "persona_name": persona.name,
             "interview_results": interview_results,
-            "message": "追加インタビューが完了しました"
+            "partial": partial,
+            "completed_questions": len(interview_results),
+            "message": "追加インタビューが完了しました" if not partial else "時間切れのため、回答済みの質問までの結果を返します"
         }
     
     except Exception as e:
@@ -1146,6 +1851,45 @@ async def conduct_hypothesis_interview(request: InterviewRequest):
         logger.error(f"詳細エラー: {traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"追加インタビューの実行に失敗しました: {str(e)}")
 
+@app.post("/api/conduct-hypothesis-interviews")
+async def conduct_hypothesis_interviews(request: BatchInterviewRequest):
+    """選択された全ペルソナ（persona_indices で指定したペルソナ）に並行して追加インタビューするエンドポイント"""
+    try:
+        return await run_batch_interview(request, True, "追加インタビューが完了しました")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"一括追加インタビュー実行エラー: {e}")
+        raise HTTPException(status_code=500, detail=f"追加インタビューの実行に失敗しました: {str(e)}")
+
+@app.post("/api/sample-persona-answer")
+async def sample_persona_answer(request: AnswerSamplingRequest):
+    """ペルソナの回答を複数候補生成し、回答の安定度を返すエンドポイント（インタビュー履歴は変更しない）"""
+    try:
+        if not current_session["selected_personas"]:
+            raise HTTPException(status_code=400, detail="ペルソナが選択されていません")
+        
+        persona = current_session["selected_personas"][request.persona_index]
+        chat = current_session["interview_sessions"][persona.name]["chat"]
+        
+        distribution = await sample_chat_message(
+            chat, f"次の質問に簡潔に2-3文で回答してください：{request.question}",
+            request.candidate_count, commit=False
+        )
+        
+        return {
+            "persona_name": persona.name,
+            "question": request.question,
+            "answer": distribution.representative,
+            "answer_distribution": distribution.to_dict()
+        }
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"回答サンプリングエラー: {e}")
+        raise HTTPException(status_code=500, detail=f"回答のサンプリングに失敗しました: {str(e)}")
+
 @app.post("/api/generate-custom-final-analysis")
 async def generate_custom_final_analysis():
     """選択された分析タイプに基づく最終分析を生成するエンドポイント"""
@@ -1158,25 +1902,8 @@ async def generate_custom_final_analysis():
             raise HTTPException(status_code=400, detail="分析タイプが選択されていません")
         
         # 全インタビュー結果を要約
-        final_summaries = {}
-        for persona in current_session["selected_personas"]:
-            session = current_session["interview_sessions"][persona.name]
-            history = session["history"]
-            
-            if not history:
-                continue
-            
-            # インタビュー内容を要約
-            interview_content = ""
-            for result in history:
-                interview_content += f"質問: {result['question']}\n"
-                interview_content += f"回答: {result['main_answer']}\n"
-                for follow_up in result.get('follow_ups', []):
-                    interview_content += f"更問: {follow_up['question']}\n"
-                    interview_content += f"更問回答: {follow_up['answer']}\n"
-                interview_content += "\n"
-            
-            summary_prompt = f"""
+        def build_prompt(persona, interview_content):
+            return f"""
             以下のインタビュー対象者への全インタビュー内容を読み、重要なポイントを統合的に要約してください。
             
             インタビュー対象者情報:
@@ -1185,9 +1912,8 @@ async def generate_custom_final_analysis():
             全インタビュー内容:
             {interview_content}
             """
-            
-            summary = generate_text(summary_prompt, temperature=0.5)
-            final_summaries[persona.name] = summary
+        
+        final_summaries, context_budget = await summarize_personas(build_prompt)
         
         # 選択された分析タイプに基づく分析を生成
         all_final_summaries = '\n\n'.join([f"--- {name}さんの要約 ---\n{summary}" for name, summary in final_summaries.items()])
@@ -1216,20 +1942,22 @@ async def generate_custom_final_analysis():
                         products_context += f" (特徴: {competitor.features})"
                     products_context += "\n"
         
+        # 各分析で共通の商品・サービス情報と要約は前置きとして登録し、分析ごとに再送しない
+        analysis_context = make_context_prefix("analysis:custom_final", [{
+            'role': 'user',
+            'parts': [f"以下は調査対象の商品・サービス情報と、インタビュー対象者のインタビュー要約です。\n"
+                      f"{products_context}\n全インタビュー要約:\n{all_final_summaries}"]
+        }])
+        
         # 分析タイプに応じた分析を生成
         analysis_results = {}
         
         if "market_structure" in analysis_types:
             market_analysis_prompt = f"""
             あなたはトップクラスのマーケティングアナリストです。
-            以下の商品・サービス情報とインタビュー対象者のインタビュー要約を深く読み解き、
+            上記の商品・サービス情報とインタビュー対象者のインタビュー要約を深く読み解き、
             「市場構造の理解」に焦点を当てた分析を行ってください。
             
-            {products_context}
-            
-            全インタビュー要約:
-            {all_final_summaries}
-            
             【重要】各分析項目では、必ず具体的な発言内容を根拠として引用し、「〜という発言があることから〜と読み取れる」という形式で記載してください。
             
             ### 1. 市場全体の動向と構造
@@ -1249,20 +1977,15 @@ async def generate_custom_final_analysis():
             - 具体的な発言を根拠としたビジネスチャンスの提案
             """
             
-            market_analysis = generate_text(market_analysis_prompt)
+            market_analysis = await generate_text(market_analysis_prompt, template="market_structure", context=analysis_context)
             analysis_results["market_structure"] = market_analysis
         
         if "customer_needs" in analysis_types:
             customer_needs_analysis_prompt = f"""
             あなたはトップクラスのマーケティングアナリストです。
-            以下の商品・サービス情報とインタビュー対象者のインタビュー要約を深く読み解き、
+            上記の商品・サービス情報とインタビュー対象者のインタビュー要約を深く読み解き、
             「特定の消費者ニーズの確認」に焦点を当てた分析を行ってください。
             
-            {products_context}
-            
-            全インタビュー要約:
-            {all_final_summaries}
-            
             【重要】各分析項目では、必ず具体的な発言内容を根拠として引用し、「〜という発言があることから〜と読み取れる」という形式で記載してください。
             
             ### 1. 顕在ニーズの深掘り
@@ -1282,20 +2005,15 @@ async def generate_custom_final_analysis():
             - 各顧客セグメントへのアプローチ方法
             """
             
-            customer_needs_analysis = generate_text(customer_needs_analysis_prompt)
+            customer_needs_analysis = await generate_text(customer_needs_analysis_prompt, template="customer_needs", context=analysis_context)
             analysis_results["customer_needs"] = customer_needs_analysis
         
         if "product_improvement" in analysis_types:
             product_improvement_analysis_prompt = f"""
             あなたはトップクラスのマーケティングアナリストです。
-            以下の商品・サービス情報とインタビュー対象者のインタビュー要約を深く読み解き、
+            上記の商品・サービス情報とインタビュー対象者のインタビュー要約を深く読み解き、
             「商品・サービスのブラッシュアップ」に焦点を当てた分析を行ってください。
             
-            {products_context}
-            
-            全インタビュー要約:
-            {all_final_summaries}
-            
             【重要】各分析項目では、必ず具体的な発言内容を根拠として引用し、「〜という発言があることから〜と読み取れる」という形式で記載してください。
             
             ### 1. 現状の商品・サービスの評価
@@ -1316,20 +2034,15 @@ async def generate_custom_final_analysis():
             - 優先順位付けと実行計画の示唆
             """
             
-            product_improvement_analysis = generate_text(product_improvement_analysis_prompt)
+            product_improvement_analysis = await generate_text(product_improvement_analysis_prompt, template="product_improvement", context=analysis_context)
             analysis_results["product_improvement"] = product_improvement_analysis
         
         if "target_analysis" in analysis_types:
             target_analysis_prompt = f"""
             あなたはトップクラスのマーケティングアナリストです。
-            以下の商品・サービス情報とインタビュー対象者のインタビュー要約を深く読み解き、
+            上記の商品・サービス情報とインタビュー対象者のインタビュー要約を深く読み解き、
             「商品/サービスが誰に刺さるか？なんで刺さるか？」の分析を行ってください。
             
-            {products_context}
-            
-            全インタビュー要約:
-            {all_final_summaries}
-            
             【重要】各分析項目では、必ず具体的な発言内容を根拠として引用し、「〜という発言があることから〜と読み取れる」という形式で記載してください。
             
             ### 1. このサービスは特に誰に刺さるか？
@@ -1342,20 +2055,15 @@ async def generate_custom_final_analysis():
             例）インスタグラムでｘｘｘという広告をｘｘｘ円で出す。等、具体的手法をいくつか提示。
             """
             
-            target_analysis = generate_text(target_analysis_prompt)
+            target_analysis = await generate_text(target_analysis_prompt, template="target_analysis", context=analysis_context)
             analysis_results["target_analysis"] = target_analysis
         
         if "improvement_analysis" in analysis_types:
             improvement_analysis_prompt = f"""
             あなたはトップクラスのマーケティングアナリストです。
-            以下の商品・サービス情報とインタビュー対象者のインタビュー要約を深く読み解き、
+            上記の商品・サービス情報とインタビュー対象者のインタビュー要約を深く読み解き、
             「こういう人に刺さるようにするためには今の商品/サービスをどうしたらよいか？」の分析を行ってください。
             
-            {products_context}
-            
-            全インタビュー要約:
-            {all_final_summaries}
-            
             【重要】各分析項目では、必ず具体的な発言内容を根拠として引用し、「〜という発言があることから〜と読み取れる」という形式で記載してください。
             
             ### 1. マーケットイン視点：今の市場・顧客のどんな"未充足ニーズ"を満たすべきか？
@@ -1365,14 +2073,9 @@ async def generate_custom_final_analysis():
             ### 3. マーケティング戦略視点：どのように伝え、広げるか？
             """
             
-            improvement_analysis = generate_text(improvement_analysis_prompt)
+            improvement_analysis = await generate_text(improvement_analysis_prompt, template="improvement_analysis", context=analysis_context)
             analysis_results["improvement_analysis"] = improvement_analysis
         
-        # コスト計算
-        end_time = time.time()
-        elapsed_time = end_time - current_session["start_time"]
-        estimated_cost = (current_session["total_input_chars"] * INPUT_TOKEN_PRICE) + (current_session["total_output_chars"] * OUTPUT_TOKEN_PRICE)
-        
         # 分析結果をセッションに保存
         current_session["custom_final_analysis"] = analysis_results
         
@@ -1380,12 +2083,8 @@ async def generate_custom_final_analysis():
             "final_summaries": final_summaries,
             "analysis_results": analysis_results,
             "analysis_types": analysis_types,
-            "stats": {
-                "elapsed_time": elapsed_time,
-                "input_chars": current_session["total_input_chars"],
-                "output_chars": current_session["total_output_chars"],
-                "estimated_cost": estimated_cost
-            }
+            "context_budget": context_budget,
+            "stats": get_session_stats()
         }
     
     except Exception as e:
@@ -1400,25 +2099,8 @@ async def generate_final_analysis():
             raise HTTPException(status_code=400, detail="インタビューデータがありません")
         
         # 全インタビュー結果を要約
-        final_summaries = {}
-        for persona in current_session["selected_personas"]:
-            session = current_session["interview_sessions"][persona.name]
-            history = session["history"]
-            
-            if not history:
-                continue
-            
-            # インタビュー内容を要約
-            interview_content = ""
-            for result in history:
-                interview_content += f"質問: {result['question']}\n"
-                interview_content += f"回答: {result['main_answer']}\n"
-                for follow_up in result.get('follow_ups', []):
-                    interview_content += f"更問: {follow_up['question']}\n"
-                    interview_content += f"更問回答: {follow_up['answer']}\n"
-                interview_content += "\n"
-            
-            summary_prompt = f"""
+        def build_prompt(persona, interview_content):
+            return f"""
             以下のペルソナへの全インタビュー内容（初回+追加質問）を読み、重要なポイントを統合的に要約してください。
             
             ペルソナ情報:
@@ -1427,9 +2109,8 @@ async def generate_final_analysis():
             全インタビュー内容:
             {interview_content}
             """
-            
-            summary = generate_text(summary_prompt, temperature=0.5)
-            final_summaries[persona.name] = summary
+        
+        final_summaries, context_budget = await summarize_personas(build_prompt)
         
         # 最終分析を生成
         all_final_summaries = '\n\n'.join([f"--- {name}さんの要約 ---\n{summary}" for name, summary in final_summaries.items()])
@@ -1527,12 +2208,7 @@ async def generate_final_analysis():
         - 価格戦略の方向性
         """
         
-        final_analysis_result = generate_text(final_analysis_prompt)
-        
-        # コスト計算
-        end_time = time.time()
-        elapsed_time = end_time - current_session["start_time"]
-        estimated_cost = (current_session["total_input_chars"] * INPUT_TOKEN_PRICE) + (current_session["total_output_chars"] * OUTPUT_TOKEN_PRICE)
+        final_analysis_result = await generate_text(final_analysis_prompt, template="final_analysis")
         
         # 最終分析をセッションに保存
         current_session["final_analysis"] = final_analysis_result
@@ -1540,18 +2216,182 @@ async def generate_final_analysis():
         return {
             "final_summaries": final_summaries,
             "final_analysis": final_analysis_result,
-            "stats": {
-                "elapsed_time": elapsed_time,
-                "input_chars": current_session["total_input_chars"],
-                "output_chars": current_session["total_output_chars"],
-                "estimated_cost": estimated_cost
-            }
+            "context_budget": context_budget,
+            "stats": get_session_stats()
         }
     
     except Exception as e:
         logger.error(f"最終分析生成エラー: {e}")
         raise HTTPException(status_code=500, detail=f"最終分析の生成に失敗しました: {e}")
 
+@app.get("/api/llm-cache/stats")
+async def get_llm_cache_stats():
+    """LLMレスポンスキャッシュの統計を取得するエンドポイント"""
+    if llm_gateway.cache is None:
+        return {"enabled": False}
+    stats = await asyncio.to_thread(llm_gateway.cache.get_stats)
+    return {"enabled": True, **stats}
+
+@app.delete("/api/llm-cache")
+async def clear_llm_cache():
+    """LLMレスポンスキャッシュを全削除するエンドポイント"""
+    if llm_gateway.cache is None:
+        raise HTTPException(status_code=400, detail="LLMレスポンスキャッシュは無効です")
+    deleted = await asyncio.to_thread(llm_gateway.cache.clear)
+    return {"deleted": deleted, "message": "LLMレスポンスキャッシュを削除しました"}
+
+@app.get("/api/llm-metrics")
+async def get_llm_metrics():
+    """LLM 呼び出しレイヤーの各種メトリクスを取得するエンドポイント"""
+    metrics = await asyncio.to_thread(llm_gateway.get_metrics)
+    metrics["interview_budget"] = interview_budgeter.get_stats()
+    return metrics
+
+@app.get("/api/llm-traces")
+async def get_llm_traces(limit: int = 20, session_id: Optional[str] = None, endpoint: Optional[str] = None):
+    """直近のリクエストのトレース（LLM呼び出しのスパンを入れ子にしたもの）を新しい順に取得するエンドポイント"""
+    return {
+        "traces": llm_gateway.tracer.traces(limit=limit, session_id=session_id, endpoint=endpoint),
+        "stats": llm_gateway.tracer.get_stats()
+    }
+
+@app.get("/api/llm-traces/{trace_id}")
+async def get_llm_trace(trace_id: str):
+    """トレースIDを指定してトレースを取得するエンドポイント（レスポンスの X-Trace-ID ヘッダーの値）"""
+    trace = llm_gateway.tracer.trace(trace_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail="トレースが見つかりませんでした")
+    return trace
+
+async def submit_job(kind, run):
+    """run() をジョブとして投入し、ジョブの状態を返す関数
+
+    ジョブは投入したリクエストのセッションで、リクエストの期限に縛られずに実行する。
+    ジョブごとにトレースを記録し、結果は JSON にして保存する。
+    待機中にペルソナの生成・選択が行われた場合は、別のペルソナにインタビューしないよう実行せずに失敗にする。
+    """
+    session_id = get_call_context().get("session_id") or current_session["session_id"]
+    endpoint = f"job:{kind}"
+    submitted_session = (current_session["session_id"], current_session["selected_personas"])
+    job = None
+
+    async def handler():
+        if (current_session["session_id"] != submitted_session[0]
+                or current_session["selected_personas"] is not submitted_session[1]):
+            raise HTTPException(status_code=409,
+                                detail="ジョブの投入後にペルソナが生成・選択し直されたため実行しませんでした")
+        with call_context(session_id=session_id, endpoint=endpoint), \
+                llm_gateway.tracer.span(f"JOB {kind}", {"endpoint": endpoint, "session_id": session_id,
+                                                        "job_id": job.id}):
+            return jsonable_encoder(await run())
+
+    job = await job_queue.submit(kind, handler, session_id)
+    return job.to_dict()
+
+async def require_job(job_id):
+    job = await asyncio.to_thread(job_queue.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="ジョブが見つかりませんでした")
+    return job
+
+@app.post("/api/jobs/conduct-interview")
+async def submit_conduct_interview_job(request: InterviewRequest):
+    """1人のペルソナへのインタビュー（conduct-interview / conduct-hypothesis-interview）をジョブとして投入するエンドポイント"""
+    if not current_session["selected_personas"]:
+        raise HTTPException(status_code=400, detail="ペルソナが選択されていません")
+    if not 0 <= request.persona_index < len(current_session["selected_personas"]):
+        raise HTTPException(status_code=400, detail=f"ペルソナの番号が不正です: {request.persona_index}")
+
+    async def run():
+        update_job_progress(questions_total=len(request.questions), questions_answered=0)
+        if request.is_hypothesis_phase:
+            return await conduct_hypothesis_interview(request)
+        return await conduct_interview(request)
+
+    return await submit_job("conduct-hypothesis-interview" if request.is_hypothesis_phase else "conduct-interview", run)
+
+@app.post("/api/jobs/conduct-interviews")
+async def submit_conduct_interviews_job(request: BatchInterviewRequest):
+    """選択された全ペルソナへのインタビューをジョブとして投入するエンドポイント"""
+    if not current_session["selected_personas"]:
+        raise HTTPException(status_code=400, detail="ペルソナが選択されていません")
+    return await submit_job("conduct-interviews", lambda: conduct_interviews(request))
+
+@app.post("/api/jobs/conduct-hypothesis-interviews")
+async def submit_conduct_hypothesis_interviews_job(request: BatchInterviewRequest):
+    """選択された全ペルソナへの追加インタビューをジョブとして投入するエンドポイント"""
+    if not current_session["selected_personas"]:
+        raise HTTPException(status_code=400, detail="ペルソナが選択されていません")
+    return await submit_job("conduct-hypothesis-interviews", lambda: conduct_hypothesis_interviews(request))
+
+@app.post("/api/jobs/generate-final-analysis")
+async def submit_final_analysis_job():
+    """最終分析をジョブとして投入するエンドポイント"""
+    if not current_session["selected_personas"]:
+        raise HTTPException(status_code=400, detail="インタビューデータがありません")
+    return await submit_job("generate-final-analysis", generate_final_analysis)
+
+@app.post("/api/jobs/generate-custom-final-analysis")
+async def submit_custom_final_analysis_job():
+    """選択された分析タイプに基づく最終分析をジョブとして投入するエンドポイント"""
+    if not current_session["selected_personas"]:
+        raise HTTPException(status_code=400, detail="インタビューデータがありません")
+    if not current_session.get("analysis_types"):
+        raise HTTPException(status_code=400, detail="分析タイプが選択されていません")
+    return await submit_job("generate-custom-final-analysis", generate_custom_final_analysis)
+
+@app.get("/api/jobs")
+async def list_jobs(limit: int = 50, session_id: Optional[str] = None, status: Optional[str] = None,
+                    kind: Optional[str] = None):
+    """ジョブの状態と進捗を新しい順に取得するエンドポイント（結果は含まない）"""
+    jobs = await asyncio.to_thread(job_queue.list, limit, session_id, status, kind)
+    return {
+        "jobs": [job.to_dict() for job in jobs],
+        "stats": job_queue.get_stats()
+    }
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    """ジョブの状態と進捗を取得するエンドポイント"""
+    return (await require_job(job_id)).to_dict()
+
+@app.get("/api/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    """終了したジョブの結果を取得するエンドポイント（失敗・取り消しの場合は result が null）"""
+    job = await require_job(job_id)
+    if not job.finished:
+        raise HTTPException(status_code=409, detail="ジョブはまだ完了していません")
+    return job.to_dict(include_result=True)
+
+@app.post("/api/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    """待機中・実行中のジョブを取り消すエンドポイント（実行中の LLM 呼び出しも取り消す）"""
+    job = await job_queue.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="ジョブが見つかりませんでした")
+    if job.finished and job.status != "cancelled":
+        raise HTTPException(status_code=409, detail="ジョブはすでに終了しています")
+    return job.to_dict()
+
+@app.get("/api/cost-ledger")
+async def get_cost_ledger(group_by: Optional[str] = None, session_id: Optional[str] = None,
+                          endpoint: Optional[str] = None, persona: Optional[str] = None,
+                          template: Optional[str] = None):
+    """コスト台帳を集計して取得するエンドポイント（group_by はカンマ区切り、例: endpoint,persona）"""
+    fields = [field.strip() for field in group_by.split(",")] if group_by else []
+    return llm_gateway.ledger.summarize(
+        group_by=fields, session_id=session_id, endpoint=endpoint, persona=persona, template=template
+    )
+
+@app.get("/api/cost-ledger/entries")
+async def get_cost_ledger_entries(limit: int = 100, session_id: Optional[str] = None,
+                                  endpoint: Optional[str] = None, persona: Optional[str] = None,
+                                  template: Optional[str] = None):
+    """コスト台帳の明細を新しい順に取得するエンドポイント"""
+    return {"entries": llm_gateway.ledger.entries(
+        limit=limit, session_id=session_id, endpoint=endpoint, persona=persona, template=template
+    )}
+
 @app.get("/api/session-status")
 async def get_session_status():
     """現在のセッション状態を取得するエンドポイント"""
@@ -1561,7 +2401,8 @@ async def get_session_status():
         "selected_persona_count": len(current_session["selected_personas"]),
         "personas": [{"id": i, "name": p.name} for i, p in enumerate(current_session["personas"])],
         "selected_personas": [{"name": p.name} for p in current_session["selected_personas"]],
-        "project_info": current_session.get("project_info")
+        "project_info": current_session.get("project_info"),
+        "session_id": current_session["session_id"]
     }
 
 @app.post("/api/upload-excel-questions")
@@ -1614,17 +2455,8 @@ async def save_interview_history():
             if not session or not session.get("history"):
                 continue
             
-            # インタビュー内容を要約
-            interview_content = ""
-            for result in session["history"]:
-                interview_content += f"質問: {result['question']}\n"
-                interview_content += f"回答: {result['main_answer']}\n"
-                for follow_up in result.get('follow_ups', []):
-                    interview_content += f"更問: {follow_up['question']}\n"
-                    interview_content += f"更問回答: {follow_up['answer']}\n"
-                interview_content += "\n"
-            
-            summaries[persona.name] = interview_content
+            # 履歴には圧縮せずに全内容を保存する
+            summaries[persona.name] = format_interview(session["history"])
         
         # 商品・サービス情報と競合情報を含む最終分析
         products_info = ""
@@ -1730,24 +2562,21 @@ async def generate_interview_summary():
         if not current_session["selected_personas"]:
             raise HTTPException(status_code=400, detail="インタビューデータがありません")
         
-        summaries = []
+        personas = [persona for persona in current_session["selected_personas"]
+                    if current_session["interview_sessions"].get(persona.name, {}).get("history")]
         
-        for persona in current_session["selected_personas"]:
-            session = current_session["interview_sessions"].get(persona.name)
-            if not session or not session.get("history"):
-                continue
-            
-            # インタビュー内容を要約
-            interview_content = ""
-            for result in session["history"]:
-                interview_content += f"質問: {result['question']}\n"
-                interview_content += f"回答: {result['main_answer']}\n"
-                for follow_up in result.get('follow_ups', []):
-                    interview_content += f"更問: {follow_up['question']}\n"
-                    interview_content += f"更問回答: {follow_up['answer']}\n"
-                interview_content += "\n"
+        # ペルソナごとのサマリは並行して生成する（同時に生成するサマリは1回のリクエストにまとめる）
+        async def summarize(persona):
+            history = current_session["interview_sessions"][persona.name]["history"]
+            # インタビュー内容をトークン予算内に収める（超過時は段階的に圧縮）
+            budgeted = await build_interview_content(persona, history)
+            interview_content = budgeted.content
             
             # LLMでサマリを生成
+            if STRUCTURED_OUTPUT_ENABLED:
+                summary_format = "主な発見と主な示唆を、指定されたJSON形式で出力してください。"
+            else:
+                summary_format = TEXT_SUMMARY_FORMAT
             summary_prompt = f"""
             以下のペルソナへのインタビュー内容を読み、2つの観点からサマリを作成してください：
             
@@ -1760,40 +2589,72 @@ async def generate_interview_summary():
             インタビュー内容:
             {interview_content}
             
-            出力形式:
-            【主な発見】
-            [発見内容を4-5行で詳細に記述]
-            
-            【主な示唆】
-            [示唆内容を4-5行で具体的に記述]
+            {summary_format}
             """
             
-            summary_text = generate_text(summary_prompt, temperature=0.6)
-            
-            # サマリをパース
-            main_findings = ""
-            main_implications = ""
-            
-            if "【主な発見】" in summary_text:
-                findings_part = summary_text.split("【主な発見】")[1]
-                if "【主な示唆】" in findings_part:
-                    main_findings = findings_part.split("【主な示唆】")[0].strip()
-                    main_implications = findings_part.split("【主な示唆】")[1].strip()
-                else:
-                    main_findings = findings_part.strip()
-            
-            summaries.append({
+            if STRUCTURED_OUTPUT_ENABLED:
+                output = await generate_structured(summary_prompt, InterviewSummaryOutput,
+                                                   template="interview_summary", persona=persona.name, pack=True)
+                main_findings = output.main_findings.strip()
+                main_implications = output.main_implications.strip()
+            else:
+                summary_text = await generate_text(summary_prompt, template="interview_summary", persona=persona.name,
+                                                   pack=True)
+                
+                # サマリをパース
+                main_findings = ""
+                main_implications = ""
+                
+                if "【主な発見】" in summary_text:
+                    findings_part = summary_text.split("【主な発見】")[1]
+                    if "【主な示唆】" in findings_part:
+                        main_findings = findings_part.split("【主な示唆】")[0].strip()
+                        main_implications = findings_part.split("【主な示唆】")[1].strip()
+                    else:
+                        main_findings = findings_part.strip()
+            
+            return {
                 "persona_name": persona.name,
                 "main_findings": main_findings,
                 "main_implications": main_implications
-            })
+            }, budgeted.to_dict()
+        
+        results = await asyncio.gather(*(summarize(persona) for persona in personas))
+        summaries = [summary for summary, _ in results]
+        context_budget = {persona.name: budget for persona, (_, budget) in zip(personas, results)}
         
-        return {"summaries": summaries}
+        return {"summaries": summaries, "context_budget": context_budget}
     
     except Exception as e:
         logger.error(f"インタビューサマリ生成エラー: {e}")
         raise HTTPException(status_code=500, detail=f"インタビューサマリの生成に失敗しました: {e}")
 
+# --- ストリーミング版エンドポイント（SSE） ---
+@app.post("/api/generate-analysis/stream")
+async def generate_analysis_stream():
+    """分析レポートをSSEでストリーミング生成するエンドポイント"""
+    return stream_endpoint(generate_analysis)
+
+@app.post("/api/generate-hypothesis/stream")
+async def generate_hypothesis_stream():
+    """仮説をSSEでストリーミング生成するエンドポイント"""
+    return stream_endpoint(generate_hypothesis)
+
+@app.post("/api/generate-final-analysis/stream")
+async def generate_final_analysis_stream():
+    """最終分析レポートをSSEでストリーミング生成するエンドポイント"""
+    return stream_endpoint(generate_final_analysis)
+
+@app.post("/api/generate-custom-final-analysis/stream")
+async def generate_custom_final_analysis_stream():
+    """カスタム最終分析レポートをSSEでストリーミング生成するエンドポイント"""
+    return stream_endpoint(generate_custom_final_analysis)
+
+@app.post("/api/generate-interview-summary/stream")
+async def generate_interview_summary_stream():
+    """インタビューサマリをSSEでストリーミング生成するエンドポイント"""
+    return stream_endpoint(generate_interview_summary)
+
 if __name__ == "__main__":
     import uvicorn
     import os
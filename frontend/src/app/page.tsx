@@ -1,7 +1,7 @@
 'use client';
 
 import React, { useState, useEffect } from 'react';
-import { apiClient, Persona, InterviewResult, ProductService, Competitor, ProjectInfo } from '@/lib/api';
+import { apiClient, Persona, InterviewResult, ProductService, Competitor, ProjectInfo, BatchInterviewResponse, Job, StreamHandlers } from '@/lib/api';
 import PersonaCard from '@/components/PersonaCard';
 import InterviewCard from '@/components/InterviewCard';
 import LoadingSpinner from '@/components/LoadingSpinner';
@@ -13,6 +13,39 @@ import InterviewResults from '@/components/InterviewResults';
 import InsightAnalysis from '@/components/InsightAnalysis';
 import ComprehensiveAnalysisView from '@/components/ComprehensiveAnalysisView';
 
+// 一括インタビューの結果をペルソナ名ごとにまとめる（全員が失敗した場合のみエラーにする）
+const collectInterviewResults = (response: BatchInterviewResponse): Record<string, InterviewResult[]> => {
+  if (response.results.length > 0 && response.succeeded === 0) {
+    throw new Error(response.results[0].error || response.message);
+  }
+  const results: Record<string, InterviewResult[]> = {};
+  for (const result of response.results) {
+    results[result.persona_name] = result.interview_results;
+  }
+  return results;
+};
+
+// ジョブの進捗（回答済みの質問数）を start〜end の進捗率に換算する
+const jobProgressPercent = (job: Job, start: number, end: number): number => {
+  const { questions_answered: answered = 0, questions_total: total = 0 } = job.progress;
+  return total > 0 ? Math.round(start + (end - start) * Math.min(answered / total, 1)) : start;
+};
+
+// ストリーミング生成中の見出しと生成済みの文字数を進捗メッセージに表示する
+const streamProgressHandlers = (message: string, setMessage: (message: string) => void): StreamHandlers => {
+  let chars = 0;
+  let section = '';
+  return {
+    onSection: ({ number, title }) => {
+      section = `${number}. ${title} / `;
+    },
+    onToken: ({ text }) => {
+      chars += text.length;
+      setMessage(`${message}（${section}${chars}文字）`);
+    },
+  };
+};
+
 export default function Home() {
   const [step, setStep] = useState(0); // 0: プロジェクト情報入力から開始
   const [topic, setTopic] = useState('');
@@ -294,66 +327,46 @@ export default function Home() {
       // ステップ1: 初回インタビューを実行
       const results: Record<string, InterviewResult[]> = {};
       const totalPersonas = selectedPersonas.length;
-      const totalQuestions = questions.length;
       
-      setProgressMessage('初回インタビューを実行中...');
-      for (let i = 0; i < selectedPersonas.length; i++) {
-        const baseProgress = Math.round((i / (totalPersonas * 5)) * 100);
-        setProgress(baseProgress);
-        setProgressMessage(`ペルソナ ${i + 1}/${totalPersonas} の初回インタビュー中...`);
-        
-        let detailedProgress = baseProgress;
-        const progressPerQuestion = Math.round((1 / (totalPersonas * 5)) * 100 / totalQuestions);
-        
-        const questionCount = questions.length;
-        const estimatedTimePerQuestion = 1000;
-        
-        const updateProgressInterval = setInterval(() => {
-          if (detailedProgress < baseProgress + Math.round((1 / (totalPersonas * 5)) * 90)) {
-            detailedProgress += 2;
-            setProgress(detailedProgress);
-            const currentQuestionEstimate = Math.min(
-              Math.floor(((detailedProgress - baseProgress) / (100 / (totalPersonas * 5))) * questionCount) + 1,
-              questionCount
-            );
-            setProgressMessage(
-              `ペルソナ ${i + 1}/${totalPersonas}: 質問 ${currentQuestionEstimate}/${questionCount} を処理中...`
-            );
-          }
-        }, estimatedTimePerQuestion);
-        
-        try {
-          const response = await apiClient.conductInterview(i, questions);
-          results[response.persona_name] = response.interview_results;
-          
-          clearInterval(updateProgressInterval);
-          const completedProgress = Math.round(((i + 1) / (totalPersonas * 5)) * 100);
-          setProgress(completedProgress);
-          setProgressMessage(`ペルソナ ${i + 1}/${totalPersonas} の初回インタビュー完了`);
-          
-        } catch (personaError) {
-          clearInterval(updateProgressInterval);
-          throw personaError;
+      // 全ペルソナを並行してインタビューするため、所要時間は最も時間のかかる1人分になる
+      // ジョブとして実行し、HTTPのタイムアウトに縛られずに回答済みの質問数で進捗を表示する
+      setProgressMessage(`${totalPersonas}人のペルソナに並行して初回インタビュー中...`);
+      const interviewJob = await apiClient.submitInterviewsJob(questions);
+      const response = await apiClient.waitForJob(interviewJob, (job) => {
+        setProgress(jobProgressPercent(job, 0, 20));
+        if (job.progress.questions_total) {
+          setProgressMessage(`${totalPersonas}人のペルソナに並行して初回インタビュー中...（${job.progress.questions_answered ?? 0}/${job.progress.questions_total}問）`);
         }
+      });
+      Object.assign(results, collectInterviewResults(response));
+      if (response.failed > 0) {
+        setError(response.message);
       }
+      setProgressMessage(response.message);
       
       setInterviewResults(results);
       setProgress(20);
       
       // ステップ2: インタビューサマリを生成
       setProgressMessage('インタビューサマリを生成中...');
-      const summaryResponse = await apiClient.generateInterviewSummary();
+      const summaryResponse = await apiClient.generateInterviewSummaryStream(
+        streamProgressHandlers('インタビューサマリを生成中...', setProgressMessage)
+      );
       setProgress(30);
       
       // ステップ3: 初回分析を生成
       setProgressMessage('初回インサイト分析を生成中...');
-      const analysisResponse = await apiClient.generateAnalysis();
+      const analysisResponse = await apiClient.generateAnalysisStream(
+        streamProgressHandlers('初回インサイト分析を生成中...', setProgressMessage)
+      );
       setAnalysis(analysisResponse.analysis);
       setProgress(40);
       
       // ステップ4: 仮説を生成
       setProgressMessage('マーケティング仮説と追加質問を生成中...');
-      const hypothesisResponse = await apiClient.generateHypothesis();
+      const hypothesisResponse = await apiClient.generateHypothesisStream(
+        streamProgressHandlers('マーケティング仮説と追加質問を生成中...', setProgressMessage)
+      );
       setHypothesisData(hypothesisResponse);
       setProgress(50);
       
@@ -372,25 +385,25 @@ export default function Home() {
         line.replace(/^[Q\d\.\s\-\*]+/, '').trim()
       ).filter(q => q.length > 5);
       
-      for (let i = 0; i < selectedPersonas.length; i++) {
-        const baseProgress = 50 + Math.round((i / totalPersonas) * 30);
-        setProgress(baseProgress);
-        setProgressMessage(`ペルソナ ${i + 1}/${totalPersonas} の仮説検証インタビュー中...`);
-        
-        const response = await apiClient.conductHypothesisInterview(i, extractedQuestions);
-        hypothesisResults[response.persona_name] = response.interview_results;
-        
-        const completedProgress = 50 + Math.round(((i + 1) / totalPersonas) * 30);
-        setProgress(completedProgress);
-        setProgressMessage(`ペルソナ ${i + 1}/${totalPersonas} の仮説検証完了`);
+      setProgress(50);
+      setProgressMessage(`${totalPersonas}人のペルソナに並行して仮説検証インタビュー中...`);
+      const hypothesisJob = await apiClient.submitInterviewsJob(extractedQuestions, undefined, true);
+      const hypothesisInterviewResponse = await apiClient.waitForJob(hypothesisJob, (job) => {
+        setProgress(jobProgressPercent(job, 50, 80));
+      });
+      Object.assign(hypothesisResults, collectInterviewResults(hypothesisInterviewResponse));
+      if (hypothesisInterviewResponse.failed > 0) {
+        setError(hypothesisInterviewResponse.message);
       }
+      setProgressMessage(hypothesisInterviewResponse.message);
       
       setHypothesisInterviewResults(hypothesisResults);
       setProgress(80);
       
       // ステップ6: カスタム最終分析を生成
       setProgressMessage('選択された分析タイプに基づく分析を生成中...');
-      const customFinalResponse = await apiClient.generateCustomFinalAnalysis();
+      const customFinalJob = await apiClient.submitCustomFinalAnalysisJob();
+      const customFinalResponse = await apiClient.waitForJob(customFinalJob);
       setCustomAnalysisResults(customFinalResponse);
       setFinalStats(customFinalResponse.stats);
       setProgress(90);
@@ -442,7 +455,9 @@ export default function Home() {
 
     try {
       setProgress(50);
-      const response = await apiClient.generateAnalysis();
+      const response = await apiClient.generateAnalysisStream(
+        streamProgressHandlers('初回インサイト分析を生成中...', setProgressMessage)
+      );
       setProgress(100);
       setProgressMessage('初回分析完了');
       setAnalysis(response.analysis);
@@ -464,7 +479,9 @@ export default function Home() {
 
     try {
       setProgress(50);
-      const response = await apiClient.generateHypothesis();
+      const response = await apiClient.generateHypothesisStream(
+        streamProgressHandlers('仮説と追加質問を生成中...', setProgressMessage)
+      );
       setProgress(100);
       setProgressMessage('仮説生成完了');
       setHypothesisData(response);
@@ -500,17 +517,14 @@ export default function Home() {
         line.replace(/^[Q\d\.\s\-\*]+/, '').trim()
       ).filter(q => q.length > 5); // 短すぎる質問を除外
       
-      for (let i = 0; i < selectedPersonas.length; i++) {
-        const baseProgress = Math.round((i / totalPersonas) * 100);
-        setProgress(baseProgress);
-        setProgressMessage(`ペルソナ ${i + 1}/${totalPersonas} の仮説検証インタビューを実行中...`);
-        
-        const response = await apiClient.conductHypothesisInterview(i, extractedQuestions);
-        results[response.persona_name] = response.interview_results;
-        
-        const completedProgress = Math.round(((i + 1) / totalPersonas) * 100);
-        setProgress(completedProgress);
-        setProgressMessage(`ペルソナ ${i + 1}/${totalPersonas} の仮説検証完了`);
+      setProgressMessage(`${totalPersonas}人のペルソナに並行して仮説検証インタビューを実行中...`);
+      const job = await apiClient.submitInterviewsJob(extractedQuestions, undefined, true);
+      const response = await apiClient.waitForJob(job, (current) => {
+        setProgress(jobProgressPercent(current, 0, 95));
+      });
+      Object.assign(results, collectInterviewResults(response));
+      if (response.failed > 0) {
+        setError(response.message);
       }
       
       setProgress(100);
@@ -534,7 +548,8 @@ export default function Home() {
 
     try {
       setProgress(50);
-      const response = await apiClient.generateFinalAnalysis();
+      const finalJob = await apiClient.submitFinalAnalysisJob();
+      const response = await apiClient.waitForJob(finalJob);
       setProgress(100);
       setProgressMessage('最終分析完了');
       setFinalAnalysis(response.final_analysis);
@@ -1267,15 +1282,14 @@ export default function Home() {
                                 return;
                               }
 
-                              const newResults: Record<string, InterviewResult[]> = {};
-                              const totalPersonas = selectedPersonas.length;
-
-                              for (let i = 0; i < selectedPersonas.length; i++) {
-                                setProgress(Math.round((i / totalPersonas) * 100));
-                                setProgressMessage(`ペルソナ ${i + 1}/${totalPersonas} の追加インタビュー中...`);
-
-                                const response = await apiClient.conductHypothesisInterview(i, validQuestions);
-                                newResults[response.persona_name] = response.interview_results;
+                              setProgressMessage(`${selectedPersonas.length}人のペルソナに並行して追加インタビュー中...`);
+                              const job = await apiClient.submitInterviewsJob(validQuestions, undefined, true);
+                              const response = await apiClient.waitForJob(job, (current) => {
+                                setProgress(jobProgressPercent(current, 0, 95));
+                              });
+                              const newResults = collectInterviewResults(response);
+                              if (response.failed > 0) {
+                                setError(response.message);
                               }
 
                               setAdditionalInterviewResults(newResults);
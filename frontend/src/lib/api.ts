@@ -76,6 +76,16 @@ export interface PersonaGenerationResponse {
   raw_text: string;
 }
 
+// 複数候補から推定した回答の分布（agreement が1に近いほど回答が安定）
+export interface AnswerDistribution {
+  candidates: string[];
+  representative_index: number;
+  agreement: number;
+  dispersion: number;
+  support: number[];
+  clusters: { representative_index: number; members: number[]; share: number }[];
+}
+
 export interface InterviewResult {
   question: string;
   main_answer: string;
@@ -83,11 +93,29 @@ export interface InterviewResult {
     question: string;
     answer: string;
   }[];
+  answer_distribution?: AnswerDistribution; // candidate_count が2以上の場合のみ
+  follow_up_mode?: 'fused' | 'separate' | 'questionnaire'; // 更問を回答と同時に生成したか（fused）、別に生成したか、質問票形式か
 }
 
 export interface InterviewResponse {
   persona_name: string;
   interview_results: InterviewResult[];
+  partial: boolean; // リクエストの期限に達し、一部の質問のみ回答した
+  completed_questions: number;
+  message: string;
+}
+
+export interface PersonaInterviewResult extends InterviewResponse {
+  persona_index: number;
+  status: 'completed' | 'partial' | 'failed';
+  error: string | null; // 失敗した場合のエラー内容（失敗までに回答済みの質問は interview_results に含まれる）
+}
+
+export interface BatchInterviewResponse {
+  results: PersonaInterviewResult[];
+  succeeded: number;
+  failed: number;
+  partial: boolean;
   message: string;
 }
 
@@ -98,6 +126,9 @@ export interface AnalysisResponse {
     elapsed_time: number;
     input_chars: number;
     output_chars: number;
+    input_tokens: number;
+    output_tokens: number;
+    api_calls: number;
     estimated_cost: number;
   };
 }
@@ -116,6 +147,9 @@ export interface FinalAnalysisResponse {
     elapsed_time: number;
     input_chars: number;
     output_chars: number;
+    input_tokens: number;
+    output_tokens: number;
+    api_calls: number;
     estimated_cost: number;
   };
 }
@@ -128,10 +162,153 @@ export interface CustomFinalAnalysisResponse {
     elapsed_time: number;
     input_chars: number;
     output_chars: number;
+    input_tokens: number;
+    output_tokens: number;
+    api_calls: number;
     estimated_cost: number;
   };
 }
 
+// バックグラウンドジョブ（長いインタビュー・分析をHTTPリクエストから切り離して実行する）
+export type JobStatus = 'queued' | 'running' | 'succeeded' | 'failed' | 'cancelled';
+
+export interface JobProgress {
+  stage?: 'summarizing' | 'analyzing';
+  personas_total?: number;
+  personas_done?: number;
+  personas_failed?: number;
+  personas_summarized?: number;
+  questions_total?: number;
+  questions_answered?: number;
+}
+
+export interface Job<T = unknown> {
+  job_id: string;
+  kind: string;
+  session_id: string;
+  status: JobStatus;
+  progress: JobProgress;
+  error: string | null;
+  created_at: number;
+  started_at: number | null;
+  finished_at: number | null;
+  result?: T | null; // 結果の取得（getJobResult）でのみ含まれる
+}
+
+const JOB_FINISHED_STATUSES: JobStatus[] = ['succeeded', 'failed', 'cancelled'];
+
+const JOB_POLL_MAX_RETRIES = 5;
+const JOB_POLL_MAX_BACKOFF_MS = 15000;
+
+// 通信エラー・タイムアウト・5xx・429 は一時的な失敗とみなしてポーリングを続ける
+const isTransientPollError = (error: any): boolean => {
+  if (axios.isCancel(error)) return false;
+  const status = error?.response?.status;
+  return status === undefined || status === 429 || status >= 500;
+};
+
+// 一時的な失敗は間隔を倍にしながら再試行し、続けて失敗した回数が上限を超えたら例外にする
+const getJobWithRetry = async <T>(path: string, intervalMs: number, signal?: AbortSignal): Promise<Job<T>> => {
+  for (let attempt = 0; ; attempt++) {
+    try {
+      const { data } = await api.get<Job<T>>(path, { signal });
+      return data;
+    } catch (error: any) {
+      if (!isTransientPollError(error) || attempt >= JOB_POLL_MAX_RETRIES) throw error;
+      const backoffMs = Math.min(intervalMs * 2 ** (attempt + 1), JOB_POLL_MAX_BACKOFF_MS);
+      console.warn(`ジョブの状態を取得できませんでした。${backoffMs}ms 後に再試行します:`, error?.message);
+      await new Promise(resolve => setTimeout(resolve, backoffMs));
+    }
+  }
+};
+
+// ジョブが終わるまで状態をポーリングし、進捗をonProgressに渡して結果を返す
+// （失敗・取り消しの場合は例外。接続が切れても同じジョブIDで再開できる）
+const waitForJob = async <T>(
+  jobOrId: Job<T> | string,
+  onProgress?: (job: Job<T>) => void,
+  intervalMs = 1000,
+  signal?: AbortSignal
+): Promise<T> => {
+  const jobId = typeof jobOrId === 'string' ? jobOrId : jobOrId.job_id;
+  while (true) {
+    const job = await getJobWithRetry<T>(`/api/jobs/${jobId}`, intervalMs, signal);
+    onProgress?.(job);
+    if (JOB_FINISHED_STATUSES.includes(job.status)) break;
+    await new Promise(resolve => setTimeout(resolve, intervalMs));
+  }
+  const finished = await getJobWithRetry<T>(`/api/jobs/${jobId}/result`, intervalMs, signal);
+  if (finished.status !== 'succeeded') {
+    throw new Error(finished.error || (finished.status === 'cancelled' ? 'ジョブが取り消されました' : 'ジョブが失敗しました'));
+  }
+  return finished.result as T;
+};
+
+// ストリーミング生成（SSE）のイベントハンドラー
+export interface StreamEventLabels {
+  template: string | null;
+  persona: string | null;
+}
+
+export interface StreamHandlers {
+  onStart?: (labels: StreamEventLabels) => void;
+  onToken?: (event: StreamEventLabels & { text: string }) => void;
+  onSection?: (event: StreamEventLabels & { number: number; title: string }) => void;
+  onEnd?: (labels: StreamEventLabels) => void;
+}
+
+// POSTのSSEエンドポイントを読み、生成中のイベントをハンドラーに渡して最終結果を返す
+// （EventSourceはPOSTに対応していないためfetchで読む）
+const streamPost = async <T>(path: string, handlers: StreamHandlers = {}, signal?: AbortSignal): Promise<T> => {
+  const response = await fetch(`${API_BASE_URL}${path}`, {
+    method: 'POST',
+    headers: { 'Accept': 'text/event-stream' },
+    signal,
+  });
+  if (!response.ok || !response.body) {
+    throw new Error(`APIエラー(${response.status}): ストリーミングを開始できません`);
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  let result: T | undefined;
+
+  const dispatch = (block: string) => {
+    let event = 'message';
+    let data = '';
+    for (const line of block.split('\n')) {
+      if (line.startsWith('event: ')) event = line.slice(7);
+      else if (line.startsWith('data: ')) data += line.slice(6);
+    }
+    if (!data) return;
+    const payload = JSON.parse(data);
+    switch (event) {
+      case 'start': handlers.onStart?.(payload); break;
+      case 'token': handlers.onToken?.(payload); break;
+      case 'section': handlers.onSection?.(payload); break;
+      case 'end': handlers.onEnd?.(payload); break;
+      case 'result': result = payload; break;
+      case 'error': throw new Error(payload.detail || `ストリーミングエラー(${payload.status_code})`);
+    }
+  };
+
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    let index;
+    while ((index = buffer.indexOf('\n\n')) >= 0) {
+      dispatch(buffer.slice(0, index));
+      buffer = buffer.slice(index + 2);
+    }
+  }
+  if (result === undefined) {
+    throw new Error('ストリーミングが結果を受け取る前に終了しました');
+  }
+  return result;
+};
+
 export const apiClient = {
   // API接続テスト（長めのタイムアウトを設定）
   testConnection: async (): Promise<{ status: string; message: string }> => {
@@ -189,11 +366,39 @@ export const apiClient = {
   },
 
   // インタビューを実行
-  conductInterview: async (personaIndex: number, questions: string[], isHypothesisPhase = false): Promise<InterviewResponse> => {
+  conductInterview: async (personaIndex: number, questions: string[], isHypothesisPhase = false, candidateCount = 1): Promise<InterviewResponse> => {
     const response = await api.post('/api/conduct-interview', {
       persona_index: personaIndex,
       questions,
       is_hypothesis_phase: isHypothesisPhase,
+      candidate_count: candidateCount,
+    });
+    return response.data;
+  },
+
+  // 選択された全ペルソナ（personaIndices で指定したペルソナ）に並行してインタビューを実行
+  // fusedFollowUp を省略するとサーバーの設定（INTERVIEW_FUSED_FOLLOW_UP）に従う
+  conductInterviews: async (questions: string[], personaIndices?: number[], candidateCount = 1, fusedFollowUp?: boolean): Promise<BatchInterviewResponse> => {
+    const response = await api.post('/api/conduct-interviews', {
+      questions,
+      persona_indices: personaIndices,
+      candidate_count: candidateCount,
+      fused_follow_up: fusedFollowUp,
+    });
+    return response.data;
+  },
+
+  // ペルソナの回答を複数候補生成して安定度を調べる（インタビュー履歴は変更しない）
+  samplePersonaAnswer: async (personaIndex: number, question: string, candidateCount = 5): Promise<{
+    persona_name: string;
+    question: string;
+    answer: string;
+    answer_distribution: AnswerDistribution;
+  }> => {
+    const response = await api.post('/api/sample-persona-answer', {
+      persona_index: personaIndex,
+      question,
+      candidate_count: candidateCount,
     });
     return response.data;
   },
@@ -220,6 +425,16 @@ export const apiClient = {
     return response.data;
   },
 
+  // 選択された全ペルソナに並行して仮説検証インタビューを実行
+  conductHypothesisInterviews: async (questions: string[], personaIndices?: number[], fusedFollowUp?: boolean): Promise<BatchInterviewResponse> => {
+    const response = await api.post('/api/conduct-hypothesis-interviews', {
+      questions,
+      persona_indices: personaIndices,
+      fused_follow_up: fusedFollowUp,
+    });
+    return response.data;
+  },
+
   // 最終分析を生成
   generateFinalAnalysis: async (): Promise<FinalAnalysisResponse> => {
     const response = await api.post('/api/generate-final-analysis');
@@ -285,6 +500,67 @@ export const apiClient = {
     const response = await api.post('/api/generate-interview-summary');
     return response.data;
   },
+
+  // ジョブとして投入（すぐにジョブIDを返し、waitForJob で進捗と結果を受け取る）
+  submitInterviewsJob: async (questions: string[], personaIndices?: number[], isHypothesisPhase = false, fusedFollowUp?: boolean): Promise<Job<BatchInterviewResponse>> => {
+    const path = isHypothesisPhase ? '/api/jobs/conduct-hypothesis-interviews' : '/api/jobs/conduct-interviews';
+    const response = await api.post(path, {
+      questions,
+      persona_indices: personaIndices,
+      fused_follow_up: fusedFollowUp,
+    });
+    return response.data;
+  },
+
+  submitFinalAnalysisJob: async (): Promise<Job<FinalAnalysisResponse>> => {
+    const response = await api.post('/api/jobs/generate-final-analysis');
+    return response.data;
+  },
+
+  submitCustomFinalAnalysisJob: async (): Promise<Job<CustomFinalAnalysisResponse>> => {
+    const response = await api.post('/api/jobs/generate-custom-final-analysis');
+    return response.data;
+  },
+
+  getJob: async (jobId: string): Promise<Job> => {
+    const response = await api.get(`/api/jobs/${jobId}`);
+    return response.data;
+  },
+
+  getJobResult: async <T>(jobId: string): Promise<Job<T>> => {
+    const response = await api.get(`/api/jobs/${jobId}/result`);
+    return response.data;
+  },
+
+  cancelJob: async (jobId: string): Promise<Job> => {
+    const response = await api.post(`/api/jobs/${jobId}/cancel`);
+    return response.data;
+  },
+
+  listJobs: async (status?: JobStatus): Promise<{ jobs: Job[]; stats: Record<string, number> }> => {
+    const response = await api.get('/api/jobs', { params: { status } });
+    return response.data;
+  },
+
+  waitForJob,
+
+  // ストリーミング版（生成中のトークンと「### N.」の見出しをハンドラーで受け取る）
+  generateAnalysisStream: (handlers?: StreamHandlers, signal?: AbortSignal): Promise<AnalysisResponse> =>
+    streamPost<AnalysisResponse>('/api/generate-analysis/stream', handlers, signal),
+
+  generateHypothesisStream: (handlers?: StreamHandlers, signal?: AbortSignal): Promise<HypothesisResponse> =>
+    streamPost<HypothesisResponse>('/api/generate-hypothesis/stream', handlers, signal),
+
+  generateFinalAnalysisStream: (handlers?: StreamHandlers, signal?: AbortSignal): Promise<FinalAnalysisResponse> =>
+    streamPost<FinalAnalysisResponse>('/api/generate-final-analysis/stream', handlers, signal),
+
+  generateCustomFinalAnalysisStream: (handlers?: StreamHandlers, signal?: AbortSignal): Promise<CustomFinalAnalysisResponse> =>
+    streamPost<CustomFinalAnalysisResponse>('/api/generate-custom-final-analysis/stream', handlers, signal),
+
+  generateInterviewSummaryStream: (handlers?: StreamHandlers, signal?: AbortSignal) =>
+    streamPost<{ summaries: { persona_name: string; main_findings: string; main_implications: string }[] }>(
+      '/api/generate-interview-summary/stream', handlers, signal
+    ),
 };
 
 export default apiClient;